@@ -81,6 +81,8 @@ pt_apt_get build-dep gnupg2 pinentry
 # as the most portable (albeit _wrong_) way to get sqlite and readline libs
 # of the correct versions installed.
 pt_apt_get install libsqlite3-dev libncurses5-dev lzip jq xz-utils sqlite3
+# Only used if a compiler cache dir is given to the build (PT_CCACHE_DIR)
+pt_apt_get install ccache
 # ruby-dev for fpm;
 #
 # python-pip for our build scripts; probably xenial?  trusty wants python3-pip
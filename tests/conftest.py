@@ -0,0 +1,100 @@
+# The scripts under test are not modules (nor all named *.py), so are loaded
+# from their paths, without running their _main.
+
+import importlib.machinery
+import importlib.util
+import json
+import pathlib
+
+import pytest
+
+TOP = pathlib.Path(__file__).resolve().parent.parent
+BOX = 'testbox'
+
+
+def load_script(name, path):
+  loader = importlib.machinery.SourceFileLoader(name, str(path))
+  spec = importlib.util.spec_from_loader(name, loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  return module
+
+
+@pytest.fixture(scope='session')
+def deps():
+  return load_script('deps', TOP / 'vscripts' / 'deps.py')
+
+
+@pytest.fixture(scope='session')
+def build_boxes():
+  return load_script('build_boxes', TOP / 'tools' / 'build-boxes')
+
+
+@pytest.fixture(scope='session')
+def bench_deps():
+  return load_script('bench_deps', TOP / 'tools' / 'bench-deps')
+
+
+@pytest.fixture(scope='session')
+def caching_invalidate():
+  pytest.importorskip('boto3')
+  return load_script('caching_invalidate', TOP / 'tools' / 'caching_invalidate')
+
+
+@pytest.fixture
+def third_party(tmp_path):
+  """Three third-party products, app needing libb needing liba; app is
+  pinned to exactly the libb we'd build, as gnupg22 is to libgcrypt."""
+  for d in ('confs', 'in', 'src', 'out', 'patches', 'repo'):
+    (tmp_path / d).mkdir()
+  (tmp_path / 'confs' / 'dependencies.tsort-in').write_text('liba liba\nliba libb\nlibb app\n')
+  (tmp_path / 'confs' / 'mutual-exclude').write_text('')
+  (tmp_path / 'in' / 'swdb.lst').write_text('')
+  names = ('liba', 'libb', 'app')
+  versions = {
+    'products': {n: {'version': '1.0', 'compress': 'gz', 'urlbase': 'http://127.0.0.1:1/'} for n in names},
+    'overrides': {
+      'libb': {'pkg_version': '2'},
+      'app': {'depends': {'libb': '= 1.0-pt2'}},
+      },
+    }
+  (tmp_path / 'confs' / 'versions.json').write_text(json.dumps(versions))
+  configures = {'prefix': '/opt/gnupg', 'common_params': ['--prefix=#{prefix}'],
+                'packages': {n: {'params': []} for n in names}}
+  (tmp_path / 'confs' / 'configures.json').write_text(json.dumps(configures))
+  for n in names:
+    (tmp_path / 'in' / f'{n}-1.0.tar.gz').write_bytes(f'{n} source\n'.encode())
+  return tmp_path
+
+
+def edit_json(path, edit):
+  data = json.loads(path.read_text())
+  edit(data)
+  path.write_text(json.dumps(data))
+
+
+def new_plan(deps, world, *args):
+  """A BuildPlan for the third_party world, as far as its input keys."""
+  c = world / 'confs'
+  options = deps._options_parser().parse_args([
+      '--base-dir', str(world / 'src'),
+      '--dependencies-file', str(c / 'dependencies.tsort-in'),
+      '--mutex-file', str(c / 'mutual-exclude'),
+      '--versions-file', str(c / 'versions.json'),
+      '--configures-file', str(c / 'configures.json'),
+      '--swdb-file', str(world / 'in' / 'swdb.lst'),
+      '--tarballs-dir', str(world / 'in'),
+      '--results-dir', str(world / 'out'),
+      '--patches-dir', str(world / 'patches'),
+      '--pkg-prefix', 'optgnupg',
+      '--pkg-version-ext', 'pt',
+      '--boxname', BOX,
+      ] + list(args))
+  plan = deps.BuildPlan(options)
+  plan.process_swdb()
+  plan.process_versions_conf()
+  plan.process_configures()
+  for name in plan.ordered:
+    plan.ensure_3rdparty_product(name, options.tarballs_dir)
+  plan.compute_input_keys()
+  return plan
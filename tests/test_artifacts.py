@@ -0,0 +1,113 @@
+# The artifact store, shared by boxes of one ABI: the fingerprint of the ABI,
+# the tree keys which leave packaging out, and storing and linking trees.
+
+import argparse
+import json
+import os
+import sys
+
+import pytest
+
+from conftest import TOP, edit_json, new_plan
+
+FAKE_CC = '''#!/bin/sh
+case "$1" in
+  --version) echo "{version}" ;;
+  -dumpmachine) echo x86_64-linux-gnu ;;
+esac
+'''
+
+
+@pytest.fixture
+def compilers(deps, tmp_path):
+  deps._abi_fingerprint.cache_clear()
+  for name, version in (('cc-a', 'cc (Fake) 12.2.0'), ('cc-b', 'cc (Fake) 13.1.0')):
+    (tmp_path / name).write_text(FAKE_CC.format(version=version))
+    (tmp_path / name).chmod(0o755)
+  yield tmp_path
+  deps._abi_fingerprint.cache_clear()
+
+
+def test_abi_fingerprint(deps, compilers):
+  abi, parts = deps._abi_fingerprint(str(compilers / 'cc-a'), 'ccache', ())
+  assert parts['compiler'] == 'cc (Fake) 12.2.0' and parts['target'] == 'x86_64-linux-gnu'
+  assert parts['os_deps'] == {}
+  # the compiler cache makes no difference; another compiler does
+  assert deps._abi_fingerprint('ccache ' + str(compilers / 'cc-a'), 'ccache', ())[0] == abi
+  assert deps._abi_fingerprint(str(compilers / 'cc-b'), 'ccache', ())[0] != abi
+  other, parts = deps._abi_fingerprint(str(compilers / 'cc-a'), 'ccache', ('no-such-os-package',))
+  assert other != abi and parts['os_deps'] == {'no-such-os-package': None}
+
+
+def test_tree_keys_leave_packaging_out(deps, third_party):
+  before = new_plan(deps, third_party)
+  edit_json(third_party / 'confs' / 'versions.json',
+            lambda v: v['overrides'].setdefault('liba', {}).update(pkg_version='5'))
+  after = new_plan(deps, third_party, '--pkg-version-ext', 'ours')
+  assert all(before.input_keys[n] != after.input_keys[n] for n in before.ordered)
+  assert after.tree_keys == before.tree_keys
+  (third_party / 'patches' / 'libb_fix.patch').write_text('--- a\n+++ b\n')
+  patched = new_plan(deps, third_party)
+  assert [n for n in before.ordered if patched.tree_keys[n] != before.tree_keys[n]] == ['libb', 'app']
+
+
+def make_tree(root, files):
+  for arcname, content in files.items():
+    (root / arcname).parent.mkdir(parents=True, exist_ok=True)
+    (root / arcname).write_text(content)
+  return root
+
+
+def test_put_and_link_tree(deps, tmp_path):
+  tree = make_tree(tmp_path / 'tree', {'opt/gnupg/bin/app': 'program\n', 'opt/gnupg/share/doc/README': 'read me\n'})
+  os.link(str(tree / 'opt/gnupg/bin/app'), str(tree / 'opt/gnupg/bin/app-alias'))
+  debug = make_tree(tmp_path / 'debug', {'opt/gnupg/bin/.debug/app.debug': 'symbols\n'})
+  store = deps.ArtifactStore(str(tmp_path / 'store'), 'ab' * 32, {'arch': 'amd64'}, 'box1')
+  key = 'cd' * 32
+  assert store.tree_entry(key) is None
+  store.put_tree(key, 'app', str(tree), str(debug))
+  entry = store.tree_entry(key)
+  assert entry['product'] == 'app' and entry['box'] == 'box1' and entry['check'] is None
+  assert entry['bytes'] == store.tree_bytes(key, dict(entry, bytes=None)) == 8 + 8 + 8
+  assert json.load(open(str(tmp_path / 'store' / ('ab' * 16) / 'abi.json'))) == {'arch': 'amd64'}
+
+  # tested on another box: the result is added; nothing else changes
+  (tree / 'opt/gnupg/share/doc/README').unlink()
+  other = deps.ArtifactStore(str(tmp_path / 'store'), 'ab' * 32, {'arch': 'amd64'}, 'box2')
+  other.put_tree(key, 'app', str(tree), str(debug), check={'passed': True})
+  assert other.tree_entry(key)['check'] == {'passed': True} and other.tree_entry(key)['box'] == 'box1'
+  other.put_tree(key, 'app', str(tree), str(debug), check={'passed': False})
+  assert other.tree_entry(key)['check'] == {'passed': True}
+
+  other.link_tree(key, str(tmp_path / 'linked'), str(tmp_path / 'linked-debug'))
+  linked = tmp_path / 'linked' / 'opt' / 'gnupg'
+  assert (linked / 'share/doc/README').read_text() == 'read me\n'
+  assert (linked / 'bin/app').samefile(linked / 'bin/app-alias')
+  assert (tmp_path / 'linked-debug' / 'opt/gnupg/bin/.debug/app.debug').read_text() == 'symbols\n'
+  assert not [d for d in os.listdir(str(tmp_path / 'store' / ('ab' * 16) / 'trees' / 'cd')) if d.startswith('.incoming.')]
+
+
+def test_packaging_from_shared_tree(tmp_path, bench_deps):
+  options = argparse.Namespace(
+      seed=1, source_files=1, swdb_fraction=0.0, latency={}, packager='native', make_jobs=1,
+      python=sys.executable, deps=str(TOP / 'vscripts' / 'deps.py'))
+  scenario = bench_deps.Scenario(options, 'chain', 2, tmp_path)
+  scenario.generate()
+  store = ('--artifact-store', str(tmp_path / 'store'))
+  scenario.run('plan', '--prepare-outside', *store)
+  scenario.run('build', '--run-inside', *store)
+  first, second = scenario.names
+
+  # as a box packaging it differently would: the tree will do
+  edit_json(tmp_path / 'confs' / 'versions.json',
+            lambda v: v['overrides'].setdefault(second, {}).update(pkg_version='7'))
+  scenario.run('plan-again', '--prepare-outside', *store)
+  scenario.run('again', '--run-inside', *store)
+  log = (tmp_path / 'again.log').read_text()
+  assert f'Using tree built on bench: \x1b[1m{second}' in log
+  assert f'Already have: \x1b[1m{first}' in log
+  records = [json.loads(l) for l in (tmp_path / 'out' / 'build-report.jsonl').read_text().splitlines()]
+  ran = [r['stage'] for r in records if r['type'] == 'stage' and r['product'] == second and not r['already']]
+  assert 'shared_tree' in ran and 'package' in ran
+  assert 'compile' not in ran and 'run_configure' not in ran
+  assert list((tmp_path / 'out').glob(f'optgnupg-{second}_1.0-*7_*.deb'))
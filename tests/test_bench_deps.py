@@ -0,0 +1,69 @@
+# tools/bench-deps: its synthetic graphs, a whole small benchmark run, and
+# comparing results.
+
+import json
+
+import pytest
+
+
+def test_parse_latency(bench_deps):
+  assert bench_deps.parse_latency('configure=0.5,make=2') == {'configure': 0.5, 'make': 2.0}
+  assert bench_deps.parse_latency('') == {}
+  with pytest.raises(bench_deps.Error, match="unknown latency 'link'"):
+    bench_deps.parse_latency('link=1')
+
+
+@pytest.mark.parametrize('shape, levels', [('chain', 12), ('wide', 2), ('layered', 4)])
+def test_make_graph(deps, bench_deps, shape, levels):
+  names, pairs = bench_deps.make_graph(shape, 12, seed=1)
+  assert len(names) == 12 and all((n, n) in pairs for n in names)
+  graph = deps.DependencyGraph(pairs)
+  assert sorted(graph.order) == names
+  assert len(graph.levels()) == levels
+  assert bench_deps.make_graph(shape, 12, seed=1) == (names, pairs)
+
+
+def test_layered_seeded(bench_deps):
+  assert bench_deps.make_graph('layered', 30, seed=1) != bench_deps.make_graph('layered', 30, seed=2)
+  with pytest.raises(bench_deps.Error, match='unknown shape'):
+    bench_deps.make_graph('star', 3, seed=1)
+
+
+def test_run_and_compare(bench_deps, tmp_path, capsys):
+  results = tmp_path / 'results.json'
+  assert bench_deps._main(['--shapes', 'chain', '--sizes', '3', '--latency', '', '--repeat', '1', '--source-files', '1',
+                           '--work-dir', str(tmp_path / 'work'), '-o', str(results)], argv0='bench-deps') == 0
+  data = json.loads(results.read_text())
+  assert data['format'] == 1 and data['meta']['params']['jobs'] == 4
+  phases = data['scenarios']['chain-3']['phases']
+  assert sorted(phases) == ['build', 'cache', 'graph', 'incremental', 'noop', 'plan', 'plan-warm']
+  assert phases['build']['built'] == 3 and phases['build']['installed'] == 3
+  # all from the build cache; then the first product changed, and all needing it
+  assert phases['cache']['built'] == 0 and phases['cache']['installed'] == 3
+  assert phases['incremental']['built'] == 3
+  assert all(p['wall'] > 0 for p in phases.values())
+  assert not (tmp_path / 'work' / 'chain-3').exists()
+
+  capsys.readouterr()
+  assert bench_deps._main(['--compare', str(results), str(results)], argv0='bench-deps') == 0
+  assert 'REGRESSION' not in capsys.readouterr().out
+
+
+def results(phases):
+  return {'format': 1, 'scenarios': {'chain-3': {'phases': {p: {'wall': w} for p, w in phases.items()}}}}
+
+
+def test_compare(bench_deps, tmp_path, capsys):
+  old, new = tmp_path / 'old.json', tmp_path / 'new.json'
+  old.write_text(json.dumps(results({'build': 1.0, 'noop': 0.1, 'graph': 0.001, 'cache': 2.0})))
+  new.write_text(json.dumps(results({'build': 1.5, 'noop': 0.105, 'graph': 0.005, 'cache': 1.0})))
+  assert bench_deps.compare(str(old), str(new), 0.10) == 1
+  out = capsys.readouterr().out.splitlines()
+  flagged = {l.split()[1]: l.split()[-1] for l in out[1:]}
+  # a 5x slower graph phase is within the noise
+  assert flagged == {'build': 'REGRESSION', 'noop': '+5.0%', 'graph': '+400.0%', 'cache': 'improved'}
+  assert bench_deps._main(['--compare', str(old), str(new)], argv0='bench-deps') == 1
+
+  new.write_text(json.dumps(dict(results({}), format=2)))
+  with pytest.raises(bench_deps.Error, match='format 2, want 1'):
+    bench_deps.compare(str(old), str(new), 0.10)
@@ -0,0 +1,60 @@
+# tools/build-boxes with the local runner, building two boxes at once with
+# the real vscripts/deps.py over one of bench-deps' synthetic builds.
+
+import argparse
+import json
+import os
+
+import pytest
+
+from conftest import TOP
+
+BOXES = ('boxa', 'boxb')
+
+
+@pytest.fixture
+def world(tmp_path, bench_deps, monkeypatch):
+  options = argparse.Namespace(seed=1, source_files=1, swdb_fraction=0.5, latency={})
+  scenario = bench_deps.Scenario(options, 'chain', 3, tmp_path)
+  scenario.generate()
+  (tmp_path / 'confs' / 'machines.json').write_text(json.dumps([
+      {'name': name, 'docker': [f'ptgnupg-{name}'], 'base_script': 'debian-family'} for name in BOXES]))
+  (tmp_path / 'vscripts').symlink_to(TOP / 'vscripts')
+  for k in list(os.environ):
+    if k.startswith(('PT_', 'PKG_', 'BENCH_')):
+      monkeypatch.delenv(k)
+  for k, v in scenario._env().items():
+    monkeypatch.setenv(k, v)
+  # run from the top of the tree, with relative paths, as we would
+  monkeypatch.chdir(tmp_path)
+  return scenario
+
+
+def test_local_runner(world, build_boxes, capsys):
+  bindir = world.root / 'bin'
+  rc = build_boxes._main([
+      '--runner', 'local', '-c', '2', '--cpu-budget', '2', '--mem-budget', '2G',
+      '--indir', 'in', '--outdir', 'out', '--local-workdir', str(world.root / 'work'),
+      '--local-cmd', build_boxes._DEF_LOCAL_CMD + f' --pkg-install-cmd {bindir}/pkg-install'
+                     f' --pkg-uninstall-cmd {bindir}/pkg-uninstall',
+      ], argv0='build-boxes')
+  out = capsys.readouterr().out
+  assert rc == 0, out
+
+  # box output is all prefixed, up to the table at the end
+  box_output, _, table = out.partition('\n\n')
+  for line in box_output.splitlines():
+    assert line.startswith(('[boxa] ', '[boxb] ')), line
+  for name in BOXES:
+    assert f'[{name}] succeeded' in box_output
+    assert (world.root / 'out' / name / 'build.log').exists()
+  assert 'Success: 2  Failure: 0' in table
+
+  summary = json.loads((world.root / 'out' / 'build-summary.json').read_text())
+  assert summary['succeeded'] == list(BOXES)
+  assert summary['failed'] == []
+  for name in BOXES:
+    box = summary['boxes'][name]
+    assert box['returncode'] == 0
+    assert sorted(box['installed']) == sorted(world.names)
+    assert box['failed'] == []
@@ -0,0 +1,94 @@
+# Input keys, the BuildCache they index and the StageManifest of stages done
+# under them.
+
+import json
+
+from conftest import edit_json, new_plan
+
+
+def test_keys_stable(deps, third_party):
+  first, again = new_plan(deps, third_party), new_plan(deps, third_party)
+  assert first.input_keys == again.input_keys
+  assert first.build_keys == again.build_keys
+
+
+def changed(before, after):
+  return sorted(p for p in before if before[p] != after[p])
+
+
+def test_patch_changes_downstream_keys(deps, third_party):
+  before = new_plan(deps, third_party)
+  (third_party / 'patches' / 'libb_fix-crash.patch').write_text('--- a\n+++ b\n')
+  after = new_plan(deps, third_party)
+  assert changed(before.input_keys, after.input_keys) == ['app', 'libb']
+  assert changed(before.build_keys, after.build_keys) == ['app', 'libb']
+  (third_party / 'patches' / 'libb_fix-crash.patch').write_text('--- a\n+++ b\n@@ changed\n')
+  assert new_plan(deps, third_party).input_keys['libb'] != after.input_keys['libb']
+
+
+def test_dependency_changes_downstream_keys(deps, third_party):
+  before = new_plan(deps, third_party)
+  edit_json(third_party / 'confs' / 'configures.json',
+            lambda c: c['packages']['liba'].update(params=['--disable-asm']))
+  after = new_plan(deps, third_party)
+  assert changed(before.input_keys, after.input_keys) == ['app', 'liba', 'libb']
+
+
+def test_pkg_version_changes_input_key_only(deps, third_party):
+  before = new_plan(deps, third_party)
+  edit_json(third_party / 'confs' / 'versions.json',
+            lambda v: v['overrides'].setdefault('liba', {}).update(pkg_version='5'))
+  after = new_plan(deps, third_party)
+  assert changed(before.input_keys, after.input_keys) == ['app', 'liba', 'libb']
+  assert changed(before.build_keys, after.build_keys) == []
+
+
+def test_build_cache(deps, tmp_path):
+  pkg = tmp_path / 'optgnupg-liba_1.0-pt1_amd64.deb'
+  pkg.write_text('package')
+  dbg = tmp_path / 'optgnupg-liba-dbg_1.0-pt1_amd64.deb'
+  dbg.write_text('debug package')
+  cache = deps.BuildCache(str(tmp_path / 'cache'))
+  key = 'ab' * 32
+  assert cache.lookup(key) is None
+  cache.store(key, 'liba', str(pkg), {'product': 'liba'}, extras=[str(dbg)], check={'passed': True})
+  cache.record_used('liba', key)
+  assert open(cache.lookup(key)).read() == 'package'
+  assert [open(p).read() for p in cache.extras(key)] == ['debug package']
+  assert cache.check_result(key) == {'passed': True}
+  assert cache.lookup('cd' * 32) is None
+  assert deps.BuildCache(str(tmp_path / 'cache')).last_keys == {'liba': key}
+
+
+def test_stage_manifest(deps, tmp_path):
+  path = str(tmp_path / '.stage-state.json')
+  stages = deps.StageManifest(path)
+  stages.record('liba', 'k1', 'untar', '/src/liba-1.0')
+  stages.record('liba', 'k1', 'configure', None)
+  assert deps.StageManifest(path).get('liba', 'k1', 'untar') == '/src/liba-1.0'
+  assert stages.get('liba', 'k2', 'untar') is None
+  assert stages.discard_stale('liba', 'k1') == {}
+  assert stages.discard_stale('liba', 'k2') == {'untar': '/src/liba-1.0', 'configure': None}
+  assert stages.get('liba', 'k1', 'untar') is None
+  # a stage done under new inputs replaces everything done under the old
+  stages.record('libb', 'k1', 'untar', 'x')
+  stages.record('libb', 'k2', 'patch', 'y')
+  assert json.load(open(path))['libb'] == {'key': 'k2', 'stages': {'patch': 'y'}}
+
+
+def test_adopt_flag_files(deps, tmp_path):
+  keys = {'libgpg': 'a' * 64, 'libgpg_error': 'b' * 64}
+  for fn, content in (('.done.libgpg.untar', '/src/libgpg-1.0\n'),
+                      ('.done.libgpg_error.untar', ''),
+                      ('.done.libgpg_error.{}.configure'.format('b' * 16), ''),
+                      ('.done.libgpg_error.{}.compile'.format('c' * 16), '')):
+    (tmp_path / fn).write_text(content)
+  stages = deps.StageManifest(str(tmp_path / '.stage-state.json'))
+  stages.adopt_flag_files(str(tmp_path), keys)
+  assert stages.get('libgpg', keys['libgpg'], 'untar') == '/src/libgpg-1.0'
+  assert stages.get('libgpg', keys['libgpg'], 'error.untar') is None
+  assert stages.get('libgpg_error', keys['libgpg_error'], 'untar') == ''
+  assert stages.get('libgpg_error', keys['libgpg_error'], 'configure') == ''
+  # done with other inputs
+  assert stages.get('libgpg_error', keys['libgpg_error'], 'compile') is None
+  assert not list(tmp_path.glob('.done.*'))
@@ -0,0 +1,162 @@
+# tools/caching_invalidate, with a stub in place of the CloudFront client.
+
+import argparse
+import json
+import threading
+
+import pytest
+
+
+class StubCloudFront(object):
+  """Records create_invalidation calls, failing the first few with throttled
+  (per distribution); each invalidation completes after pending polls."""
+
+  def __init__(self, throttled=0, pending=1, error='Throttling'):
+    import botocore.exceptions
+    self._client_error = botocore.exceptions.ClientError
+    self.throttled = throttled
+    self.pending = pending
+    self.error = error
+    self.created = []
+    self.polls = {}
+    self._failures = {}
+    self._lock = threading.Lock()
+
+  def create_invalidation(self, DistributionId, InvalidationBatch):
+    with self._lock:
+      self.created.append((DistributionId, InvalidationBatch))
+      failed = self._failures.get(DistributionId, 0)
+      if failed < self.throttled:
+        self._failures[DistributionId] = failed + 1
+        raise self._client_error({'Error': {'Code': self.error, 'Message': 'slow down'}}, 'CreateInvalidation')
+    return {'Invalidation': {'Id': 'I' + DistributionId, 'Status': 'InProgress'}}
+
+  def get_invalidation(self, DistributionId, Id):
+    with self._lock:
+      self.polls[Id] = self.polls.get(Id, 0) + 1
+      status = 'Completed' if self.polls[Id] > self.pending else 'InProgress'
+    return {'Invalidation': {'Id': Id, 'Status': status}}
+
+
+def endpoint(path, distribution):
+  return {'spec': f's3:pennocktech:{path}', 'aws_profile': 'pennocktech', 'aws_cloudfront': distribution}
+
+
+@pytest.fixture
+def machines(tmp_path):
+  config = [
+    {'name': 'focal', 'repo_endpoints': [{'spec': 'filesystem:morales:pt/ubuntu/focal'},
+                                         endpoint('pt/ubuntu/focal', 'DIST1')]},
+    {'name': 'jammy', 'repo_endpoints': [endpoint('pt/ubuntu/jammy', 'DIST1')]},
+    {'name': 'buster', 'repo_endpoints': [endpoint('pt/debian/buster', 'DIST2')]},
+    {'name': 'local'},
+    ]
+  fn = tmp_path / 'machines.json'
+  fn.write_text(json.dumps(config))
+  return fn
+
+
+def config(caching_invalidate, fn, max_paths=15):
+  return caching_invalidate.MachinesConfig(argparse.Namespace(deploy_config_file=str(fn), verbose=0, max_paths=max_paths))
+
+
+def test_one_invalidation_per_distribution(caching_invalidate, machines):
+  invs = config(caching_invalidate, machines).invalidations(['focal', 'jammy', 'buster', 'local'])
+  assert [(inv.distribution, inv.profile, sorted(inv.machines), inv.items) for inv in invs] == [
+      ('DIST1', 'pennocktech-website', ['focal', 'jammy'], ['/pt/ubuntu/focal/*', '/pt/ubuntu/jammy/*']),
+      ('DIST2', 'pennocktech-website', ['buster'], ['/pt/debian/buster/*']),
+      ]
+
+
+def test_invalidations_coalesced(caching_invalidate, machines):
+  invs = config(caching_invalidate, machines, max_paths=1).invalidations(['focal', 'jammy', 'buster'])
+  assert [inv.items for inv in invs] == [['/pt/ubuntu/*'], ['/pt/debian/buster/*']]
+
+
+@pytest.mark.parametrize('paths, limit, want', [
+    (['/pt/a/*', '/pt/b/*'], 15, ['/pt/a/*', '/pt/b/*']),
+    # covered by another's wildcard
+    (['/pt/*', '/pt/ubuntu/focal/*', '/pt/x'], 15, ['/pt/*']),
+    (['/pt/ubuntu/focal/*', '/pt/ubuntu/jammy/*', '/pt/debian/buster/*', '/pt/debian/bullseye/*'], 2,
+     ['/pt/debian/*', '/pt/ubuntu/*']),
+    # the deepest shared directory goes first
+    (['/pt/ubuntu/focal/*', '/pt/ubuntu/jammy/*', '/pt/debian/buster/*'], 2,
+     ['/pt/debian/buster/*', '/pt/ubuntu/*']),
+    (['/pt/ubuntu/focal/*', '/pt/debian/buster/*', '/other/*'], 1, ['/*']),
+    ])
+def test_coalesce_paths(caching_invalidate, paths, limit, want):
+  assert caching_invalidate.coalesce_paths(paths, limit) == want
+
+
+def invalidations(caching_invalidate, machines):
+  return config(caching_invalidate, machines).invalidations(['focal', 'jammy', 'buster'])
+
+
+def test_submit_and_wait(caching_invalidate, machines):
+  stub = StubCloudFront(pending=2)
+  sleeps = []
+  invalidator = caching_invalidate.Invalidator(lambda profile: stub, 0, 'ref-',
+      poll_initial=1.0, poll_cap=4.0, sleep=sleeps.append)
+  invs = invalidations(caching_invalidate, machines)
+  invalidator.run(invs)
+  assert sorted(d for d, _ in stub.created) == ['DIST1', 'DIST2']
+  batch = dict(stub.created)['DIST1']
+  assert batch['Paths'] == {'Quantity': 2, 'Items': ['/pt/ubuntu/focal/*', '/pt/ubuntu/jammy/*']}
+  assert [inv.status for inv in invs] == ['Completed', 'Completed']
+  assert stub.polls == {'IDIST1': 3, 'IDIST2': 3}
+  assert len(sleeps) == 6
+
+
+def test_throttled_retries_back_off(caching_invalidate, machines):
+  stub = StubCloudFront(throttled=3)
+  sleeps = []
+  invalidator = caching_invalidate.Invalidator(lambda profile: stub, 0, 'ref-',
+      poll_initial=1.0, poll_cap=4.0, sleep=sleeps.append)
+  invs = invalidations(caching_invalidate, machines)[:1]
+  invalidator.run(invs, wait=False)
+  assert len(stub.created) == 4
+  # the one reference throughout, so a retry of one which did get through
+  # can't make a second invalidation
+  assert len(set(batch['CallerReference'] for _, batch in stub.created)) == 1
+  # exponential, with jitter, up to the cap
+  assert len(sleeps) == 3
+  for delay, (low, high) in zip(sleeps, [(0.5, 1.0), (1.0, 2.0), (2.0, 4.0)]):
+    assert low <= delay <= high
+  assert invs[0].id == 'IDIST1'
+
+
+def test_other_errors_not_retried(caching_invalidate, machines):
+  import botocore.exceptions
+  stub = StubCloudFront(throttled=1, error='AccessDenied')
+  invalidator = caching_invalidate.Invalidator(lambda profile: stub, 0, 'ref-', sleep=lambda s: None)
+  invs = invalidations(caching_invalidate, machines)
+  with pytest.raises(botocore.exceptions.ClientError):
+    invalidator.run(invs, wait=False)
+  # each distribution was tried, once
+  assert sorted(d for d, _ in stub.created) == ['DIST1', 'DIST2']
+
+
+def test_credentials_fetched_once(caching_invalidate):
+  fetched = []
+  def fetch(profile):
+    fetched.append(profile)
+    return {'AWS_PROFILE': profile, 'AWS_SESSION_EXPIRATION': '2999-01-01T00:00:00Z'}
+  credentials = caching_invalidate.CredentialCache(fetch=fetch)
+  threads = [threading.Thread(target=credentials.get, args=('p',)) for _ in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  credentials.get('q')
+  assert sorted(fetched) == ['p', 'q']
+
+
+def test_credentials_refetched_near_expiry(caching_invalidate):
+  fetched = []
+  def fetch(profile):
+    fetched.append(profile)
+    return {'AWS_CREDENTIAL_EXPIRATION': '2000-01-01T00:00:00Z'}
+  credentials = caching_invalidate.CredentialCache(fetch=fetch)
+  credentials.get('p')
+  credentials.get('p')
+  assert fetched == ['p', 'p']
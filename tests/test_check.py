@@ -0,0 +1,89 @@
+# The make check stage: what needs a product waits for its tests to pass,
+# unless they're only to warn, and results are cached with the package.
+
+import argparse
+import json
+import sys
+
+import pytest
+
+from conftest import TOP
+
+# logs each check, and fails it for products named in fail-<dirname> files
+CHECKING_MAKE = '''#!/bin/sh
+for arg; do
+  if [ "$arg" = check ]; then
+    name="$(basename "$PWD")"
+    echo "$name" >> "{root}/checks.log"
+    sleep 0.5
+    if [ -e "{root}/fail-$name" ]; then exit 1; fi
+  fi
+done
+exec "{root}/bin/make.fake" "$@"
+'''
+
+
+@pytest.fixture
+def world(tmp_path, bench_deps):
+  options = argparse.Namespace(
+      seed=1, source_files=1, swdb_fraction=0.0, latency={}, packager='native', make_jobs=1,
+      python=sys.executable, deps=str(TOP / 'vscripts' / 'deps.py'))
+  scenario = bench_deps.Scenario(options, 'chain', 3, tmp_path)
+  scenario.generate()
+  (tmp_path / 'bin' / 'make').rename(tmp_path / 'bin' / 'make.fake')
+  (tmp_path / 'bin' / 'make').write_text(CHECKING_MAKE.format(root=tmp_path))
+  (tmp_path / 'bin' / 'make').chmod(0o755)
+  return scenario
+
+
+def build(world, bench_deps, phase):
+  world.run('plan-' + phase, '--prepare-outside')
+  try:
+    world.run(phase, '--run-inside', '--jobs', '3', '--check')
+    return True
+  except bench_deps.Error:
+    return False
+
+
+def checks(world):
+  path = world.root / 'checks.log'
+  return path.read_text().split() if path.exists() else []
+
+
+def built(world, name):
+  return (world.root / 'out').glob(f'optgnupg-{name}_*.deb')
+
+
+def test_failed_check_holds_back_dependents(world, bench_deps):
+  first, second, third = world.names
+  (world.root / f'fail-{first}-1.0').touch()
+  assert not build(world, bench_deps, 'build')
+  assert checks(world) == [f'{first}-1.0']
+  log = (world.root / 'build.log').read_text()
+  assert f'Skipping, needs failed {first!r}: \x1b[3m{second}' in log
+  assert f'Build: \x1b[3m{second}' not in log
+  assert not list(built(world, second)) and not list(built(world, third))
+
+
+def test_warn_goes_ahead(world, bench_deps):
+  first, second, third = world.names
+  configures = json.loads((world.root / 'confs' / 'configures.json').read_text())
+  configures['packages'][first]['check'] = 'warn'
+  (world.root / 'confs' / 'configures.json').write_text(json.dumps(configures))
+  (world.root / f'fail-{first}-1.0').touch()
+  assert build(world, bench_deps, 'build')
+  assert sorted(checks(world)) == sorted(f'{n}-1.0' for n in world.names)
+  assert list(built(world, third))
+
+
+def test_cached_results_not_checked_again(world, bench_deps):
+  assert build(world, bench_deps, 'build')
+  assert sorted(checks(world)) == sorted(f'{n}-1.0' for n in world.names)
+  (world.root / 'checks.log').unlink()
+  for stage_state in (world.root / 'src').glob('.stage-state*'):
+    stage_state.unlink()
+  assert build(world, bench_deps, 'again')
+  assert checks(world) == []
+  log = (world.root / 'again.log').read_text()
+  assert 'Build:' not in log
+  assert log.count('Already have:') == len(world.names)
@@ -0,0 +1,56 @@
+# Compiling through the compiler cache: every configure gets CC/CXX wrapped
+# and the cache settings, whatever the product sets for itself.
+
+import pytest
+
+from conftest import edit_json, new_plan
+
+
+@pytest.fixture(autouse=True)
+def environ(monkeypatch):
+  monkeypatch.setenv('CC', 'gcc-12')
+  for var in ('CXX', 'CFLAGS'):
+    monkeypatch.delenv(var, raising=False)
+
+
+def cached_plan(deps, world):
+  return new_plan(deps, world, '--compiler-cache-dir', str(world / 'ccache'), '--compiler-cache', 'ccache')
+
+
+def configure_env(plan, name):
+  return plan._configure_env(plan.products[name], plan._params_and_env(name)[1])
+
+
+def test_wrapped(deps, third_party):
+  plan = cached_plan(deps, third_party)
+  env = configure_env(plan, 'liba')
+  assert env['CC'] == 'ccache gcc-12' and env['CXX'] == 'ccache g++'
+  assert env['CCACHE_DIR'] == str(third_party / 'ccache')
+  assert env['CCACHE_BASEDIR'] == str(third_party / 'src')
+
+
+def test_product_compiler_wrapped(deps, third_party):
+  edit_json(third_party / 'confs' / 'configures.json',
+            lambda c: c['packages']['libb'].update(env=['CC=clang -m64', 'CXX=/usr/lib/ccache/ccache clang++', 'CFLAGS=-O1']))
+  plan = cached_plan(deps, third_party)
+  env = configure_env(plan, 'libb')
+  assert env['CC'] == 'ccache clang -m64'
+  # already wrapped
+  assert env['CXX'] == '/usr/lib/ccache/ccache clang++'
+  assert env['CFLAGS'] == '-O1'
+
+
+def test_product_unsets_compiler(deps, third_party):
+  edit_json(third_party / 'confs' / 'configures.json',
+            lambda c: c['packages']['app'].update(env=['CC=', 'CFLAGS']))
+  plan = cached_plan(deps, third_party)
+  assert configure_env(plan, 'app')['CC'] == 'ccache gcc'
+
+
+def test_no_cache_no_wrapping(deps, third_party):
+  edit_json(third_party / 'confs' / 'configures.json',
+            lambda c: c['packages']['libb'].update(env=['CC=clang']))
+  plan = new_plan(deps, third_party, '--compiler-cache-dir', '')
+  assert configure_env(plan, 'liba')['CC'] == 'gcc-12'
+  assert configure_env(plan, 'libb')['CC'] == 'clang'
+  assert 'CCACHE_DIR' not in configure_env(plan, 'libb')
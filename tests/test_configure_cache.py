@@ -0,0 +1,113 @@
+# The shared autoconf cache: which configures may share results, and how
+# what each learns is merged back.
+
+import os
+
+import pytest
+
+from conftest import edit_json, new_plan
+
+
+@pytest.fixture
+def world(third_party, monkeypatch):
+  # libb and app both need only liba, so may share
+  (third_party / 'confs' / 'dependencies.tsort-in').write_text('liba liba\nliba libb\nliba app\n')
+  edit_json(third_party / 'confs' / 'versions.json', lambda v: v['overrides'].pop('app'))
+  for var in ('CC', 'CFLAGS', 'LDFLAGS'):
+    monkeypatch.delenv(var, raising=False)
+  return third_party
+
+
+def keys(deps, world, *args):
+  plan = new_plan(deps, world, *args)
+  plan.configure_cache = deps.ConfigureCache(str(world / 'configure-cache'))
+  result = {}
+  for name in plan.ordered:
+    product = plan.products[name]
+    params, envs = plan._params_and_env(name)
+    result[name] = plan._configure_cache_key(product, params, envs, plan._configure_env(product, envs))
+  return result
+
+
+def test_shared_by_same_settings(deps, world):
+  before = keys(deps, world)
+  assert before['libb'] == before['app'] != before['liba']
+  assert keys(deps, world) == before
+  # nor do options for the product's own features matter
+  edit_json(world / 'confs' / 'configures.json',
+            lambda c: c['packages']['app'].update(params=['--with-libb-prefix=/opt/gnupg', '--enable-foo']))
+  assert keys(deps, world)['app'] == before['libb']
+
+
+@pytest.mark.parametrize('env', [['CFLAGS=-O0'], ['LDFLAGS=-static'], ['CC=cc'], ['ac_cv_func_fork=no']])
+def test_not_shared_across_env(deps, world, env):
+  edit_json(world / 'confs' / 'configures.json', lambda c: c['packages']['app'].update(env=env))
+  after = keys(deps, world)
+  assert after['app'] != after['libb']
+
+
+def test_not_shared_across_inherited_flags(deps, world, monkeypatch):
+  before = keys(deps, world)
+  monkeypatch.setenv('CFLAGS', '-O3 -march=native')
+  after = keys(deps, world)
+  assert all(before[n] != after[n] for n in before)
+
+
+def test_not_shared_across_platforms(deps, world):
+  edit_json(world / 'confs' / 'configures.json',
+            lambda c: c['packages']['app'].update(params=['--host=aarch64-linux-gnu']))
+  after = keys(deps, world)
+  assert after['app'] != after['libb']
+
+
+def test_not_shared_across_dependencies(deps, world):
+  before = keys(deps, world)
+  # another liba build; and app needing libb as well
+  edit_json(world / 'confs' / 'configures.json', lambda c: c['packages']['liba'].update(params=['--disable-asm']))
+  after = keys(deps, world)
+  assert after['liba'] == before['liba']
+  assert after['libb'] != before['libb'] and after['app'] != before['app']
+  (world / 'confs' / 'dependencies.tsort-in').write_text('liba liba\nliba libb\nliba app\nlibb app\n')
+  assert keys(deps, world)['app'] != after['app']
+
+
+def test_opted_out(deps, world):
+  edit_json(world / 'confs' / 'configures.json', lambda c: c['packages']['libb'].update(configure_cache=False))
+  assert keys(deps, world)['libb'] is None
+  assert keys(deps, world, '--configure-cache')['app'] is not None
+
+
+LIBA_LEARNED = '''\
+# This file is a shell script that caches the results of configure
+ac_cv_func_fork=${ac_cv_func_fork=yes}
+test "${ac_cv_header_stdio_h+set}" = set || ac_cv_header_stdio_h=yes
+: ${lt_cv_sys_global_symbol_pipe='sed -n -e '\\''s/^T //p'\\''
+'}
+'''
+
+LIBB_LEARNED = '''\
+ac_cv_func_fork=${ac_cv_func_fork=yes}
+ac_cv_lib_a_init=${ac_cv_lib_a_init=yes}
+'''
+
+
+def test_merge(deps, tmp_path):
+  cache = deps.ConfigureCache(str(tmp_path / 'cache'))
+  key = 'ab' * 32
+  liba, libb = tmp_path / 'liba.cache', tmp_path / 'libb.cache'
+  assert cache.checkout(key, str(liba)) == 0
+  assert liba.read_text() == ''
+  liba.write_text(LIBA_LEARNED)
+  # taken out before liba's results were in
+  assert cache.checkout(key, str(libb)) == 0
+  assert cache.merge(key, str(liba)) == 3
+  libb.write_text(LIBB_LEARNED)
+  assert cache.merge(key, str(libb)) == 1
+
+  app = tmp_path / 'app.cache'
+  assert cache.checkout(key, str(app)) == 4
+  text = app.read_text()
+  assert "lt_cv_sys_global_symbol_pipe='sed -n -e '\\''s/^T //p'\\''\n'}\n" in text
+  assert text.count('ac_cv_func_fork') == 2 and 'ac_cv_lib_a_init' in text
+  assert not [f for f in os.listdir(str(tmp_path / 'cache')) if f.startswith('.tmp.')]
+  assert cache.checkout('cd' * 32, str(app)) == 0
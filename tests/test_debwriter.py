@@ -0,0 +1,117 @@
+# DebWriter: the Depends field, as fpm -d would write it, and the .deb as
+# dpkg-deb reads it.
+
+import hashlib
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+@pytest.mark.parametrize('dep, want', [
+    ('optgnupg_libgcrypt', 'optgnupg-libgcrypt'),
+    ('optgnupg_libgcrypt = 1.8.7-pt6', 'optgnupg-libgcrypt (= 1.8.7-pt6)'),
+    ('libunbound2 | libunbound8', 'libunbound2 | libunbound8'),
+    ('libc6 (>= 2.17)', 'libc6 (>= 2.17)'),
+    ('libc6(>=2.17) | libc6.1 >> 2', 'libc6 (>= 2.17) | libc6.1 (>> 2)'),
+    ])
+def test_deb_dependency(deps, dep, want):
+  assert deps.DebWriter.deb_dependency(dep) == want
+
+
+def test_deb_dependency_unparseable(deps):
+  with pytest.raises(deps.Error):
+    deps.DebWriter.deb_dependency('libc6 ((>= 2.17))')
+
+
+@pytest.fixture
+def tree(tmp_path):
+  top = tmp_path / 'tree' / 'opt' / 'gnupg'
+  for d in ('bin', 'lib', 'share/info'):
+    (top / d).mkdir(parents=True)
+  (top / 'bin' / 'tool').write_text('#!/bin/sh\necho tool\n')
+  (top / 'bin' / 'tool').chmod(0o755)
+  (top / 'lib' / 'libx.so.1').write_bytes(b'\x7fELF' + b'x' * 3000)
+  os.link(str(top / 'lib' / 'libx.so.1'), str(top / 'lib' / 'libx.so.1.0'))
+  (top / 'lib' / 'libx.so').symlink_to('libx.so.1')
+  (top / 'share' / 'info' / 'dir').write_text('left out\n')
+  return tmp_path / 'tree'
+
+
+def dpkg_deb(*args):
+  return subprocess.run(['dpkg-deb'] + list(args), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+@pytest.mark.skipif(shutil.which('dpkg-deb') is None, reason='needs dpkg-deb')
+@pytest.mark.parametrize('compression', ['xz', 'zstd'])
+def test_deb_written(deps, tree, tmp_path, compression):
+  if shutil.which(deps.DEB_COMPRESSORS[compression][1][0]) is None:
+    pytest.skip('needs ' + deps.DEB_COMPRESSORS[compression][1][0])
+  writer = deps.DebWriter(str(tree), 'opt', exclude=['opt/gnupg/share/info/dir'], compression=compression)
+  writer.fields['Package'] = 'optgnupg-libx'
+  writer.fields['Version'] = '1.0-pt1'
+  writer.fields['Architecture'] = 'amd64'
+  writer.fields['Maintainer'] = 'unknown@localhost'
+  writer.fields['Installed-Size'] = ''
+  writer.fields['Depends'] = ''
+  writer.fields['Description'] = 'no description given'
+  writer.fields[deps.BUILD_KEY_FIELD] = 'f' * 64
+  writer.depends = ['optgnupg_liba = 1.0-pt2', 'libc6 (>= 2.17)']
+  deb = writer.write(str(tmp_path / 'optgnupg-libx_1.0-pt1_amd64.deb'))
+
+  md5sums = dict(reversed(line.split('  ')) for line in dpkg_deb('-I', deb, 'md5sums').splitlines())
+  assert sorted(md5sums) == ['opt/gnupg/bin/tool', 'opt/gnupg/lib/libx.so.1', 'opt/gnupg/lib/libx.so.1.0']
+  assert md5sums['opt/gnupg/bin/tool'] == hashlib.md5(b'#!/bin/sh\necho tool\n').hexdigest()
+  fields = dict(line.split(': ', 1) for line in dpkg_deb('-f', deb).splitlines())
+  assert fields == {
+      'Package': 'optgnupg-libx',
+      'Version': '1.0-pt1',
+      'Architecture': 'amd64',
+      'Maintainer': 'unknown@localhost',
+      # 1 KiB for the script, 3 for the library (once), 1 each for the link and 6 dirs
+      'Installed-Size': '11',
+      'Depends': 'optgnupg-liba (= 1.0-pt2), libc6 (>= 2.17)',
+      'Description': 'no description given',
+      deps.BUILD_KEY_FIELD: 'f' * 64,
+      }
+
+  listing = {}
+  for line in dpkg_deb('-c', deb).splitlines():
+    mode, owner, _, _, _, name = line.split(None, 5)
+    assert owner == 'root/root', line
+    listing[name] = mode
+  assert listing == {
+      './': 'drwxr-xr-x',
+      './opt/': 'drwxr-xr-x',
+      './opt/gnupg/': 'drwxr-xr-x',
+      './opt/gnupg/bin/': 'drwxr-xr-x',
+      './opt/gnupg/bin/tool': '-rwxr-xr-x',
+      './opt/gnupg/lib/': 'drwxr-xr-x',
+      './opt/gnupg/lib/libx.so -> libx.so.1': 'lrwxrwxrwx',
+      './opt/gnupg/lib/libx.so.1': '-rw-r--r--',
+      './opt/gnupg/lib/libx.so.1.0 link to ./opt/gnupg/lib/libx.so.1': 'hrw-r--r--',
+      './opt/gnupg/share/': 'drwxr-xr-x',
+      './opt/gnupg/share/info/': 'drwxr-xr-x',
+      }
+
+  out = tmp_path / 'out'
+  dpkg_deb('-x', deb, str(out))
+  lib = out / 'opt' / 'gnupg' / 'lib'
+  assert (lib / 'libx.so.1').read_bytes() == (tree / 'opt' / 'gnupg' / 'lib' / 'libx.so.1').read_bytes()
+  assert (lib / 'libx.so.1').stat().st_ino == (lib / 'libx.so.1.0').stat().st_ino
+  assert ar_members(deb) == ['debian-binary', 'control.tar.gz', 'data.tar' + deps.DEB_COMPRESSORS[compression][0]]
+
+
+def ar_members(path):
+  with open(path, 'rb') as fh:
+    assert fh.read(8) == b'!<arch>\n'
+    names = []
+    while True:
+      header = fh.read(60)
+      if not header:
+        return names
+      assert header[58:] == b'`\n'
+      names.append(header[:16].decode('ascii').strip())
+      size = int(header[48:58])
+      fh.seek(size + size % 2, 1)
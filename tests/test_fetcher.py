@@ -0,0 +1,135 @@
+# Fetcher against a local http.server: resuming, servers which ignore
+# Range, checksums, and downloads cut short.
+
+import hashlib
+import http.server
+import re
+import threading
+
+import pytest
+
+DATA = bytes(range(256)) * (3 << 12)  # 3 MiB: a few of Fetcher's chunks
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    server = self.server
+    server.ranges.append(self.headers.get('Range'))
+    data = server.files.get(self.path.lstrip('/'))
+    if data is None:
+      self.send_error(404)
+      return
+    m = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+    if m and server.honour_range:
+      start = int(m.group(1))
+      if start >= len(data):
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+      data = data[start:]
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    if server.cut_after is not None:
+      # the connection drops part way
+      self.wfile.write(data[:server.cut_after])
+      self.wfile.flush()
+      self.close_connection = True
+      return
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def server():
+  httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  httpd.files = {'foo.tar.gz': DATA}
+  httpd.honour_range = True
+  httpd.cut_after = None
+  httpd.ranges = []
+  httpd.url = 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield httpd
+  httpd.shutdown()
+  httpd.server_close()
+
+
+@pytest.fixture
+def fetcher(deps):
+  return deps.Fetcher(jobs=2)
+
+
+def test_fetch(server, fetcher, tmp_path):
+  out = tmp_path / 'foo.tar.gz'
+  assert fetcher.fetch_many([(server.url + 'foo.tar.gz', str(out), SHA256)]) == [str(out)]
+  assert out.read_bytes() == DATA
+  assert not (tmp_path / 'foo.tar.gz.part').exists()
+  assert server.ranges == [None]
+
+
+def test_resume(server, fetcher, tmp_path):
+  out = tmp_path / 'foo.tar.gz'
+  (tmp_path / 'foo.tar.gz.part').write_bytes(DATA[:1000])
+  fetcher.fetch(server.url + 'foo.tar.gz', str(out), SHA256)
+  assert server.ranges == ['bytes=1000-']
+  assert out.read_bytes() == DATA
+
+
+def test_range_ignored(server, fetcher, tmp_path):
+  server.honour_range = False
+  out = tmp_path / 'foo.tar.gz'
+  (tmp_path / 'foo.tar.gz.part').write_bytes(b'x' * 1000)
+  fetcher.fetch(server.url + 'foo.tar.gz', str(out), SHA256)
+  # a 200 is the whole file: start again, rather than append it
+  assert server.ranges == ['bytes=1000-']
+  assert out.read_bytes() == DATA
+
+
+def test_already_complete(server, fetcher, tmp_path):
+  out = tmp_path / 'foo.tar.gz'
+  (tmp_path / 'foo.tar.gz.part').write_bytes(DATA)
+  fetcher.fetch(server.url + 'foo.tar.gz', str(out), SHA256)
+  assert server.ranges == ['bytes={}-'.format(len(DATA))]
+  assert out.read_bytes() == DATA
+
+
+def test_sha256_mismatch(deps, server, fetcher, tmp_path):
+  out = tmp_path / 'foo.tar.gz'
+  with pytest.raises(deps.Error, match='sha256 mismatch'):
+    fetcher.fetch(server.url + 'foo.tar.gz', str(out), '0' * 64)
+  assert not out.exists()
+  assert not (tmp_path / 'foo.tar.gz.part').exists()
+
+
+def test_interrupted(server, fetcher, tmp_path):
+  server.cut_after = len(DATA) // 2
+  out = tmp_path / 'foo.tar.gz'
+  with pytest.raises(Exception):
+    fetcher.fetch_many([(server.url + 'foo.tar.gz', str(out), SHA256)])
+  assert not out.exists()
+  # what arrived, up to the last whole chunk
+  have = (tmp_path / 'foo.tar.gz.part').read_bytes()
+  assert have and DATA.startswith(have)
+
+  # and the next run picks up from there
+  server.cut_after = None
+  fetcher.fetch(server.url + 'foo.tar.gz', str(out), SHA256)
+  assert server.ranges == [None, 'bytes={}-'.format(len(have))]
+  assert out.read_bytes() == DATA
+
+
+def test_not_found(server, fetcher, tmp_path):
+  out = tmp_path / 'bar.tar.gz'
+  with pytest.raises(Exception):
+    fetcher.fetch_many([(server.url + 'bar.tar.gz', str(out), None)])
+  assert not out.exists()
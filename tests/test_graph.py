@@ -0,0 +1,75 @@
+# DependencyGraph, which stands in for tsort(1).
+
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import TOP
+
+DEPENDENCIES = TOP / 'confs' / 'dependencies.tsort-in'
+
+
+def pairs(text):
+  words = text.split()
+  return list(zip(words[0::2], words[1::2]))
+
+
+def test_real_order(deps):
+  graph = deps.DependencyGraph.from_file(str(DEPENDENCIES))
+  words = [w for l in DEPENDENCIES.read_text().splitlines() for w in l.split('#', 1)[0].split()]
+  assert sorted(graph.order) == sorted(set(words))
+  for before, after in zip(words[0::2], words[1::2]):
+    assert graph.index[before] <= graph.index[after], (before, after)
+
+
+@pytest.mark.skipif(shutil.which('tsort') is None, reason='needs tsort')
+def test_same_products_as_tsort(deps):
+  graph = deps.DependencyGraph.from_file(str(DEPENDENCIES))
+  text = '\n'.join(l.split('#', 1)[0] for l in DEPENDENCIES.read_text().splitlines())
+  out = subprocess.run(['tsort'], input=text, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+  assert sorted(out.split()) == sorted(graph.order)
+
+
+@pytest.fixture
+def graph(deps):
+  # a diamond, a chain off it, and one standing alone
+  return deps.DependencyGraph(pairs('''
+      lone lone
+      base left  base right  left top  right top
+      top app  app plugin
+      '''))
+
+
+def test_order(graph):
+  assert graph.order == ['lone', 'base', 'left', 'right', 'top', 'app', 'plugin']
+
+
+def test_closures(graph):
+  assert graph.direct_needs['top'] == ['left', 'right']
+  assert graph.needs('base') == set()
+  assert graph.needs('top') == {'base', 'left', 'right'}
+  assert graph.needs('plugin') == {'base', 'left', 'right', 'top', 'app'}
+  assert graph.invalidates('base') == {'left', 'right', 'top', 'app', 'plugin'}
+  assert graph.invalidates('left') == {'top', 'app', 'plugin'}
+  assert graph.invalidates('plugin') == set()
+  assert graph.needs('lone') == graph.invalidates('lone') == set()
+
+
+def test_levels_and_ready(graph):
+  assert graph.levels() == [['lone', 'base'], ['left', 'right'], ['top'], ['app'], ['plugin']]
+  assert graph.ready(set()) == ['lone', 'base']
+  assert graph.ready({'base', 'left'}) == ['lone', 'right']
+  assert graph.ready({'base', 'left', 'right'}) == ['lone', 'top']
+
+
+def test_cycle_named(deps):
+  with pytest.raises(deps.Error, match='^dependency cycle: a -> b -> c -> a$'):
+    deps.DependencyGraph(pairs('x a  a b  b c  c a  c d'))
+
+
+def test_odd_file(deps, tmp_path):
+  fn = tmp_path / 'deps.tsort-in'
+  fn.write_text('a b\nc # d\n')
+  with pytest.raises(deps.Error, match='odd number'):
+    deps.DependencyGraph.from_file(str(fn))
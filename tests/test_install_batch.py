@@ -0,0 +1,96 @@
+# Installing prebuilt packages in batches: together when nothing stands in
+# the way, one at a time to find the culprit when the batch fails.
+
+import json
+
+import pytest
+
+from conftest import edit_json, new_plan
+
+# logs each command; fails when given a package named in the fail file
+FAKE_PKG = '''#!/bin/sh
+echo "$(basename "$0") $*" >> "{root}/pkg.log"
+for pkg; do
+  if grep -qx "$(basename "$pkg")" "{root}/fail" 2>/dev/null; then exit 1; fi
+done
+'''
+
+
+@pytest.fixture
+def world(third_party):
+  """third_party, and appng: another app, which can't be installed with it."""
+  with open(third_party / 'confs' / 'dependencies.tsort-in', 'a') as fh:
+    fh.write('libb appng\n')
+  (third_party / 'confs' / 'mutual-exclude').write_text('app appng\n')
+  edit_json(third_party / 'confs' / 'versions.json',
+            lambda v: v['products'].update(appng=dict(v['products']['app'])))
+  edit_json(third_party / 'confs' / 'configures.json', lambda c: c['packages'].update(appng={'params': []}))
+  (third_party / 'in' / 'appng-1.0.tar.gz').write_text('appng source\n')
+  for cmd in ('pkg-install', 'pkg-uninstall'):
+    (third_party / cmd).write_text(FAKE_PKG.format(root=third_party))
+    (third_party / cmd).chmod(0o755)
+  return third_party
+
+
+def prebuilt(deps, world, names=('liba', 'libb', 'app', 'appng')):
+  plan = new_plan(deps, world, '--pkg-install-cmd', str(world / 'pkg-install'),
+                  '--pkg-uninstall-cmd', str(world / 'pkg-uninstall'))
+  for name in names:
+    plan.prebuilt[name] = str(world / 'out' / f'{name}.deb')
+  return plan
+
+
+def pkg_log(world):
+  path = world / 'pkg.log'
+  lines = path.read_text().splitlines() if path.exists() else []
+  path.write_text('')
+  return [l.replace(str(world / 'out') + '/', '') for l in lines]
+
+
+def test_next_batch(deps, world):
+  plan = prebuilt(deps, world)
+  pending = set(plan.prebuilt)
+  # dependencies installed in the same batch, but only one of app and appng
+  batch = plan._next_install_batch(pending, set(), {})
+  assert {'liba', 'libb'} <= set(batch) and len({'app', 'appng'} & set(batch)) == 1
+  # nor one while the other is building
+  assert plan._next_install_batch({'app'}, {'liba', 'libb'}, {'future': 'appng'}) == []
+  assert plan._next_install_batch({'app'}, {'liba', 'libb'}, {'future': 'liba'}) == ['app']
+
+
+def test_next_batch_waits_for_builds(deps, world):
+  plan = prebuilt(deps, world, names=('liba', 'app'))
+  assert plan._next_install_batch({'liba', 'libb', 'app'}, set(), {}) == ['liba']
+  assert plan._next_install_batch({'app'}, {'liba', 'libb'}, {}) == ['app']
+
+
+def test_one_command(deps, world):
+  plan = prebuilt(deps, world)
+  results = plan.install_prebuilt(['liba', 'libb', 'app'])
+  assert results == [('liba', None), ('libb', None), ('app', None)]
+  assert pkg_log(world) == ['pkg-install liba.deb libb.deb app.deb']
+  assert plan.installed == {'liba', 'libb', 'app'}
+  record = json.loads((world / 'out' / deps.BUILD_REPORT_FN).read_text())
+  assert record['type'] == 'install_batch' and record['products'] == ['liba', 'libb', 'app']
+  # done already
+  assert prebuilt(deps, world).install_prebuilt(['liba', 'libb', 'app']) == results
+  assert pkg_log(world) == []
+
+
+def test_conflicts_removed_first(deps, world):
+  plan = prebuilt(deps, world)
+  plan.install_prebuilt(['liba', 'libb', 'appng'])
+  pkg_log(world)
+  plan.install_prebuilt(['app'])
+  assert pkg_log(world) == ['pkg-uninstall optgnupg-appng', 'pkg-install app.deb']
+  assert 'appng' not in plan.installed
+
+
+def test_failed_batch_one_at_a_time(deps, world):
+  (world / 'fail').write_text('libb.deb\n')
+  plan = prebuilt(deps, world)
+  results = plan.install_prebuilt(['liba', 'libb', 'app'])
+  assert [(name, e is not None) for name, e in results] == [('libb', True), ('liba', False)]
+  # app needs libb, so isn't tried
+  assert pkg_log(world) == ['pkg-install liba.deb libb.deb app.deb', 'pkg-install liba.deb', 'pkg-install libb.deb']
+  assert plan.installed == {'liba'}
@@ -0,0 +1,68 @@
+# The make jobserver shared by products compiling at once: however many
+# makes run, together they run no more jobs than it has slots.
+
+import shutil
+import threading
+
+import pytest
+
+from conftest import new_plan
+
+# each job notes how many jobs, of any make, are running as it starts
+MAKEFILE = '''\
+all: j1 j2 j3 j4
+j1 j2 j3 j4:
+\t@touch {running}/$$$$ && ls {running} | wc -l >> {running}.log && sleep 0.3 && rm {running}/$$$$
+'''
+
+pytestmark = pytest.mark.skipif(shutil.which('make') is None, reason='needs make')
+
+
+def run_makes(plan, tmp_path, count):
+  running = tmp_path / 'running'
+  running.mkdir()
+  threads = []
+  for i in range(count):
+    builddir = tmp_path / f'product{i}'
+    builddir.mkdir()
+    (builddir / 'Makefile').write_text(MAKEFILE.format(running=running))
+    env = plan.jobserver.env({'PATH': '/usr/bin:/bin'})
+    threads.append(threading.Thread(target=plan._make_call, args=(['make'],),
+        kwargs=dict(env=env, pass_fds=plan.jobserver.pass_fds(), cwd=str(builddir))))
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  counts = [int(n) for n in (tmp_path / 'running.log').read_text().split()]
+  assert len(counts) == 4 * count
+  return max(counts)
+
+
+@pytest.fixture
+def plan(deps, third_party):
+  plan = new_plan(deps, third_party)
+  plan.jobserver = deps.MakeJobserver(3)
+  yield plan
+  plan.jobserver.close()
+
+
+def test_makes_share_slots(plan, tmp_path):
+  assert 2 <= run_makes(plan, tmp_path, 3) <= 3
+
+
+def test_one_make_gets_them_all(plan, tmp_path):
+  assert run_makes(plan, tmp_path, 1) == 3
+
+
+def test_slots_come_back(deps):
+  jobserver = deps.MakeJobserver(2)
+  first, second = jobserver.acquire(), jobserver.acquire()
+  waiting = threading.Thread(target=lambda: jobserver.release(jobserver.acquire()))
+  waiting.start()
+  waiting.join(0.2)
+  assert waiting.is_alive()
+  jobserver.release(first)
+  waiting.join(5)
+  assert not waiting.is_alive()
+  jobserver.release(second)
+  jobserver.close()
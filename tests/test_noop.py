@@ -0,0 +1,41 @@
+# The no-op path: a rerun with nothing changed should say so and exit within
+# NOOP_BUDGET of starting Python and compiling deps.py (which, being run as a
+# script, is compiled afresh every time, whatever it then does).  Timed with
+# bench-deps' fakes, as its noop phase is; the best of several runs, as the
+# others only measure how busy the machine is.
+
+import argparse
+import subprocess
+import sys
+import time
+
+from conftest import TOP
+
+NOOP_BUDGET = 0.05  # seconds: half the 100ms the whole of a no-op run should take
+RUNS = 7
+
+
+def test_noop_within_budget(tmp_path, bench_deps):
+  options = argparse.Namespace(
+      seed=1, source_files=1, swdb_fraction=0.5, latency={}, packager='native', make_jobs=1,
+      python=sys.executable, deps=str(TOP / 'vscripts' / 'deps.py'))
+  scenario = bench_deps.Scenario(options, 'layered', 20, tmp_path)
+  scenario.generate()
+  scenario.run('plan', '--prepare-outside')
+  scenario.run('build', '--run-inside')
+
+  noop = []
+  for _ in range(RUNS):
+    wall, _ = scenario.run('noop', '--run-inside')
+    noop.append(wall)
+  compile_only = [sys.executable, '-c', 'import sys; compile(open(sys.argv[1]).read(), sys.argv[1], "exec")', options.deps]
+  startup = []
+  for _ in range(RUNS):
+    started = time.perf_counter()
+    subprocess.run(compile_only, env=scenario._env(), check=True)
+    startup.append(time.perf_counter() - started)
+  log = (tmp_path / 'noop.log').read_text()
+  assert 'Nothing to do' in log
+  assert 'Build:' not in log
+  overhead = min(noop) - min(startup)
+  assert overhead < NOOP_BUDGET, f'no-op run took {overhead:.3f}s beyond starting up; runs {noop}, startup {startup}'
@@ -0,0 +1,93 @@
+# TreeOptimizer: stripping, with the debug info split out, and hardlinking
+# identical files together, before a tree is packaged.
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+TOPDIR = 'opt/gnupg'
+
+needs_toolchain = pytest.mark.skipif(
+    not all(shutil.which(c) for c in ('gcc', 'strip', 'objcopy', 'readelf')), reason='needs gcc and binutils')
+
+
+def write(tree, arcname, content, mode=0o644):
+  path = tree / arcname
+  path.parent.mkdir(parents=True, exist_ok=True)
+  path.write_bytes(content)
+  path.chmod(mode)
+  return path
+
+
+def test_dedupe(deps, tmp_path):
+  a = write(tmp_path, f'{TOPDIR}/share/a', b'same\n')
+  b = write(tmp_path, f'{TOPDIR}/share/doc/b', b'same\n')
+  c = write(tmp_path, f'{TOPDIR}/bin/c', b'same\n', mode=0o755)
+  d = write(tmp_path, f'{TOPDIR}/share/d', b'other\n')
+  excluded = write(tmp_path, f'{TOPDIR}/share/info/dir', b'same\n')
+  empty, also_empty = write(tmp_path, f'{TOPDIR}/share/e1', b''), write(tmp_path, f'{TOPDIR}/share/e2', b'')
+  os.link(str(b), str(tmp_path / TOPDIR / 'share' / 'b2'))
+  optimizer = deps.TreeOptimizer(str(tmp_path), TOPDIR, exclude=[f'{TOPDIR}/share/info/dir'])
+  optimizer.dedupe()
+  # onto b, which had two names already
+  assert a.samefile(b) and a.samefile(tmp_path / TOPDIR / 'share' / 'b2')
+  assert not a.samefile(c) and not a.samefile(excluded) and not empty.samefile(also_empty)
+  assert a.read_bytes() == b'same\n' and d.read_bytes() == b'other\n'
+  assert optimizer.stats['deduped'] == 1 and optimizer.stats['dedupe_saved'] == 5
+  optimizer.dedupe()
+  assert optimizer.stats['deduped'] == 1
+
+
+def test_elf_kind(deps, tmp_path):
+  assert deps.TreeOptimizer._elf_kind(str(write(tmp_path, 'text', b'#!/bin/sh\n' * 10))) == (None, False)
+  assert deps.TreeOptimizer._elf_kind(str(write(tmp_path, 'lib.a', b'!<arch>\n'))) == ('archive', True)
+  assert deps.TreeOptimizer._elf_kind(shutil.which('sh')) in (('exec', False), ('exec', True))
+
+
+def cc(src, out, *args):
+  subprocess.run(['gcc', '-g', '-O0', '-o', str(out)] + list(args) + [str(src)], check=True)
+
+
+def sections(path):
+  # nb: readelf complains of a debug file's missing interpreter
+  out = subprocess.run(['readelf', '-S', '-W', str(path)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       universal_newlines=True).stdout
+  return {w for w in out.split() if w.startswith('.')}
+
+
+@needs_toolchain
+def test_strip_and_split(deps, tmp_path):
+  tree, debug_tree = tmp_path / 'tree', tmp_path / 'debug'
+  (tmp_path / 'hello.c').write_text('int hello(void) { return 42; }\nint main(void) { return hello() - 42; }\n')
+  (tmp_path / 'lib.c').write_text('int answer(void) { return 42; }\n')
+  bindir, libdir = tree / TOPDIR / 'bin', tree / TOPDIR / 'lib'
+  bindir.mkdir(parents=True)
+  libdir.mkdir()
+  cc(tmp_path / 'hello.c', bindir / 'hello')
+  cc(tmp_path / 'lib.c', libdir / 'libanswer.so.1', '-shared', '-fPIC')
+  os.link(str(libdir / 'libanswer.so.1'), str(libdir / 'libanswer.so'))
+  cc(tmp_path / 'lib.c', libdir / 'answer.o', '-c')
+  (bindir / 'hello').chmod(0o555)
+  sizes = {p: p.stat().st_size for p in (bindir / 'hello', libdir / 'libanswer.so.1', libdir / 'answer.o')}
+
+  optimizer = deps.TreeOptimizer(str(tree), TOPDIR)
+  optimizer.strip(str(debug_tree))
+  assert optimizer.stats['stripped'] == 3 and optimizer.stats['split'] == 2
+  assert optimizer.stats['strip_saved'] == sum(sizes[p] - p.stat().st_size for p in sizes) > 0
+  # split once, under the first name
+  for path, debug_name in ((bindir / 'hello', 'hello.debug'), (libdir / 'libanswer.so.1', 'libanswer.so.debug')):
+    assert '.symtab' not in sections(path) and '.debug_info' not in sections(path)
+    assert '.gnu_debuglink' in sections(path)
+    assert '.debug_info' in sections(debug_tree / path.parent.relative_to(tree) / '.debug' / debug_name)
+  assert not (debug_tree / TOPDIR / 'lib' / '.debug' / 'libanswer.so.1.debug').exists()
+  # objects keep their symbols, to link with
+  assert '.symtab' in sections(libdir / 'answer.o') and '.debug_info' not in sections(libdir / 'answer.o')
+  assert (bindir / 'hello').stat().st_mode & 0o777 == 0o555
+  assert (libdir / 'libanswer.so').samefile(libdir / 'libanswer.so.1')
+  assert subprocess.run([str(bindir / 'hello')]).returncode == 0
+
+  again = deps.TreeOptimizer(str(tree), TOPDIR)
+  again.strip()
+  assert again.stats['strip_saved'] == 0 and again.stats['split'] == 0
@@ -0,0 +1,66 @@
+# PristineSources: a build writing into its checked-out tree must not reach
+# the pristine tree, which other builds (and boxes) share.
+
+import io
+import os
+import tarfile
+
+import pytest
+
+FILES = {
+  'foo-1.0/src/main.c': b'int main(void) { return 0; }\n',
+  'foo-1.0/po/de.po': b'msgid "x"\nmsgstr "y"\n',
+  }
+
+
+@pytest.fixture
+def pristine(deps, tmp_path):
+  tarball = tmp_path / 'foo-1.0.tar.gz'
+  with tarfile.open(str(tarball), 'w:gz') as tf:
+    for name, data in FILES.items():
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mode = 0o644
+      tf.addfile(info, io.BytesIO(data))
+  sources = deps.PristineSources(str(tmp_path / 'pristine'))
+  return sources, sources.tree(str(tarball), 'f00', 'foo-1.0')
+
+
+def test_read_only(pristine):
+  _, src = pristine
+  for name in FILES:
+    path = os.path.join(os.path.dirname(src), name)
+    assert os.stat(path).st_mode & 0o222 == 0, name
+
+
+def test_writes_stay_in_checkout(pristine, tmp_path):
+  sources, src = pristine
+  work = tmp_path / 'work'
+  assert sources.checkout(src, str(work))
+  for name in FILES:
+    path = work / name.split('/', 1)[1]
+    try:
+      with open(str(path), 'wb') as fh:
+        fh.write(b'changed by the build\n')
+    except PermissionError:
+      pass  # not root, and a link to the pristine file: as good
+  for name, data in FILES.items():
+    with open(os.path.join(os.path.dirname(src), name), 'rb') as fh:
+      assert fh.read() == data, name
+  assert sources.checkout(src, str(tmp_path / 'again'))
+
+
+def test_links_only_what_builds_leave(pristine, tmp_path, monkeypatch):
+  sources, src = pristine
+  monkeypatch.setattr(os, 'geteuid', lambda: 1000)
+  work = tmp_path / 'work'
+  assert sources.checkout(src, str(work))
+  def same(name):
+    return os.stat(str(work / name)).st_ino == os.stat(os.path.join(src, name)).st_ino
+  assert same('src/main.c')
+  assert not same('po/de.po')
+  assert os.access(str(work / 'po' / 'de.po'), os.W_OK)
+
+  monkeypatch.setattr(os, 'geteuid', lambda: 0)
+  assert sources.checkout(src, str(tmp_path / 'as-root'))
+  assert os.stat(str(tmp_path / 'as-root' / 'src' / 'main.c')).st_ino != os.stat(os.path.join(src, 'src/main.c')).st_ino
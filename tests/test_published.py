@@ -0,0 +1,93 @@
+# BuildPlan.resolve_published, against a directory standing in for the
+# published apt repo.
+
+import hashlib
+
+import pytest
+
+from conftest import BOX, edit_json, new_plan
+
+
+def publish(deps, third_party, packages):
+  """Writes a Packages index for (name, version, build key or None), with
+  the package files it names; returns the repo as deps.py reads it."""
+  arch = deps._deb_architecture()
+  index = third_party / 'repo' / 'dists' / BOX / 'main' / f'binary-{arch}'
+  index.mkdir(parents=True, exist_ok=True)
+  (third_party / 'repo' / 'pool').mkdir(exist_ok=True)
+  stanzas = []
+  for name, version, key in packages:
+    filename = f'pool/optgnupg-{name}_{version}_{arch}.deb'
+    content = f'{name} {version}\n'.encode()
+    (third_party / 'repo' / filename).write_bytes(content)
+    stanza = [f'Package: optgnupg-{name}', f'Version: {version}', f'Architecture: {arch}',
+              f'Filename: {filename}', f'SHA256: {hashlib.sha256(content).hexdigest()}']
+    if key is not None:
+      stanza.append(f'{deps.BUILD_KEY_FIELD}: {key}')
+    stanzas.append('\n'.join(stanza) + '\n')
+  (index / 'Packages').write_text('\n'.join(stanzas))
+  return deps.PublishedRepo(str(third_party / 'repo'), BOX, arch)
+
+
+def test_reuse_all(deps, third_party):
+  plan = new_plan(deps, third_party)
+  repo = publish(deps, third_party, [
+      ('liba', '1.0-pt1', plan.build_keys['liba']),
+      ('libb', '1.0-pt2', plan.build_keys['libb']),
+      ('app', '1.0-pt1', None),  # from before build keys: reused by version
+      ])
+  plan.resolve_published(repo)
+  assert sorted(plan.published) == ['app', 'liba', 'libb']
+  assert plan.pkg_version_bumps == {}
+  assert plan.published['libb'].endswith('/pool/optgnupg-libb_1.0-pt2_{}.deb'.format(deps._deb_architecture()))
+
+
+def test_rebuild_unpublished(deps, third_party):
+  plan = new_plan(deps, third_party)
+  repo = publish(deps, third_party, [('liba', '1.0-pt1', plan.build_keys['liba'])])
+  plan.resolve_published(repo)
+  assert sorted(plan.published) == ['liba']
+  assert plan.pkg_version_bumps == {}
+  assert plan.direct_needs_version_constraints['app'] == {'libb': '= 1.0-pt2'}
+
+
+def test_rebuild_bumps_and_repins(deps, third_party):
+  plan = new_plan(deps, third_party)
+  repo = publish(deps, third_party, [
+      ('liba', '1.0-pt1', plan.build_keys['liba']),
+      ('libb', '1.0-pt2', 'built-from-other-inputs'),
+      ('app', '1.0-pt1', 'built-from-other-inputs'),
+      ])
+  plan.resolve_published(repo)
+  assert sorted(plan.published) == ['liba']
+  assert plan.pkg_version_bumps == {'libb': '3', 'app': '2'}
+  assert plan.direct_needs_version_constraints['app'] == {'libb': '= 1.0-pt3'}
+  assert 'optgnupg_libb = 1.0-pt3' in plan._pkg_depends(plan.products['app'])
+  # and the pin the app package was built with is part of its keys
+  assert plan.inputs['app']['version_constraints'] == {'libb': '= 1.0-pt3'}
+
+
+def test_bumped_builds_are_reused_next_time(deps, third_party):
+  plan = new_plan(deps, third_party)
+  published = [
+      ('liba', '1.0-pt1', plan.build_keys['liba']),
+      ('libb', '1.0-pt2', 'built-from-other-inputs'),
+      ('app', '1.0-pt1', 'built-from-other-inputs'),
+      ]
+  plan.resolve_published(publish(deps, third_party, published))
+  # as if those rebuilds were then published
+  published += [('libb', '1.0-pt3', plan.build_keys['libb']), ('app', '1.0-pt2', plan.build_keys['app'])]
+  plan = new_plan(deps, third_party)
+  plan.resolve_published(publish(deps, third_party, published))
+  assert sorted(plan.published) == ['app', 'liba', 'libb']
+  assert plan.pkg_version_bumps == {'libb': '3', 'app': '2'}
+  assert plan.direct_needs_version_constraints['app'] == {'libb': '= 1.0-pt3'}
+
+
+def test_unsatisfiable_pin(deps, third_party):
+  edit_json(third_party / 'confs' / 'versions.json',
+            lambda versions: versions['overrides']['app']['depends'].update(libb='= 1.0-pt1'))
+  plan = new_plan(deps, third_party)
+  repo = publish(deps, third_party, [('libb', '1.0-pt2', 'built-from-other-inputs')])
+  with pytest.raises(deps.Error, match='app needs libb = 1.0-pt1'):
+    plan.resolve_published(repo)
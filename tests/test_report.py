@@ -0,0 +1,58 @@
+# The build report: a record per stage run, and a summary with the critical
+# path through the products.
+
+import argparse
+import json
+import sys
+
+import pytest
+
+from conftest import TOP, new_plan
+
+
+def test_report_of_build(tmp_path, bench_deps):
+  options = argparse.Namespace(
+      seed=1, source_files=1, swdb_fraction=0.5, latency={'make': 0.2}, packager='native', make_jobs=1,
+      python=sys.executable, deps=str(TOP / 'vscripts' / 'deps.py'))
+  scenario = bench_deps.Scenario(options, 'chain', 3, tmp_path)
+  scenario.generate()
+  scenario.run('plan', '--prepare-outside')
+  _, summary = scenario.run('build', '--run-inside', '--jobs', '2')
+
+  records = [json.loads(l) for l in (tmp_path / 'out' / 'build-report.jsonl').read_text().splitlines()]
+  assert records[-1] == summary
+  stages = [r for r in records if r['type'] == 'stage']
+  for name in scenario.names:
+    ran = [r['stage'] for r in stages if r['product'] == name]
+    for stage in ('untar', 'run_configure', 'compile', 'install_temptree', 'package'):
+      assert stage in ran, (name, ran)
+  for r in stages:
+    assert r['box'] == 'bench' and not r['failed'] and not r['already']
+    assert r['wall'] >= 0 and r['cpu_user'] >= 0 and r['max_rss_kb'] >= 0
+  # the fake make sleeps for the compile
+  compiles = [r for r in stages if r['stage'] == 'compile']
+  assert all(r['wall'] >= 0.2 for r in compiles)
+
+  assert summary['critical_path'] == scenario.names
+  assert summary['critical_path_wall'] >= 0.2 * len(scenario.names)
+  assert summary['critical_path_wall'] == pytest.approx(sum(summary['product_wall'].values()))
+  assert summary['installed'] == sorted(scenario.names)
+  assert summary['failed'] == [] and summary['skipped'] == []
+
+  # a rerun finds it all done: the report starts afresh
+  scenario.run('noop', '--run-inside')
+  records = [json.loads(l) for l in (tmp_path / 'out' / 'build-report.jsonl').read_text().splitlines()]
+  assert all(r['type'] == 'summary' or r['already'] for r in records)
+
+
+def test_critical_path(deps, third_party):
+  plan = new_plan(deps, third_party)
+  plan.stage_records = [
+      {'product': 'liba', 'stage': 'compile', 'wall': 5.0},
+      {'product': 'libb', 'stage': 'compile', 'wall': 1.0},
+      {'product': 'app', 'stage': 'compile', 'wall': 2.0},
+      {'product': 'app', 'stage': 'package', 'wall': 0.5},
+      # tests run off the path, once the product is installed
+      {'product': 'libb', 'stage': 'check', 'wall': 100.0},
+      ]
+  assert plan.critical_path() == (8.5, ['liba', 'libb', 'app'])
@@ -0,0 +1,102 @@
+# Scheduling within memory and CPU budgets, by estimates from the resources
+# each product took in its last builds here.
+
+import argparse
+import datetime
+import json
+import sys
+
+import pytest
+
+from conftest import TOP, new_plan
+
+
+def stage(product, stage, wall, cpu, rss_mib, **kw):
+  return dict({'type': 'stage', 'product': product, 'stage': stage, 'already': False, 'failed': False,
+               'wall': wall, 'cpu_user': cpu, 'cpu_sys': 0.0, 'max_rss_kb': rss_mib * 1024}, **kw)
+
+
+def test_estimate(deps, tmp_path):
+  stats = deps.BuildStats(str(tmp_path / 'stats.json'))
+  stats.add([
+      stage('liba', 'run_configure', 2.0, 1.0, 50),
+      # make -j4: four compilers of 100 MiB
+      stage('liba', 'compile', 10.0, 40.0, 100),
+      stage('liba', 'check', 30.0, 30.0, 20),
+      stage('liba', 'package', 1.0, 0.5, 300, already=True),
+      stage('libb', 'compile', 1.0, 1.0, 10, failed=True),
+      {'type': 'install_batch', 'products': ['libb']},
+      ])
+  assert stats.estimate('liba') == {'wall': 12.0, 'cpu': 4.0, 'mem_mib': 400}
+  assert stats.estimate('libb') is None
+  for wall in range(deps.STATS_KEEP + 2):
+    stats.add([stage('libb', 'compile', 100.0 + wall, 100.0, 10)])
+  stats.save()
+  again = deps.BuildStats(str(tmp_path / 'stats.json'))
+  assert len(again.products['libb']['compile']) == deps.STATS_KEEP
+  assert again.estimate('libb')['wall'] == 104.0
+  assert deps.BuildStats(str(tmp_path / 'nonesuch.json')).estimate('liba') is None
+
+
+@pytest.fixture
+def plan(deps, third_party):
+  plan = new_plan(deps, third_party, '--mem-budget', '1000', '--cpu-budget', '4')
+  plan.stats = deps.BuildStats(str(third_party / 'stats.json'))
+  plan.stats.add([stage('liba', 'compile', 10.0, 20.0, 400), stage('libb', 'compile', 30.0, 30.0, 200)])
+  return plan
+
+
+def test_plan_resources(plan):
+  estimates = plan.plan_resources()
+  assert estimates['liba'] == {'wall': 10.0, 'cpu': 2.0, 'mem_mib': 800}
+  # never built: a median one
+  assert estimates['app'] == {'wall': 30.0, 'cpu': 2.0, 'mem_mib': 800}
+  # ranked by the longest chain of builds from each
+  assert plan.priority == {'app': 30.0, 'libb': 60.0, 'liba': 70.0}
+
+
+def test_admit(plan):
+  plan.plan_resources()
+  # anything goes when nothing's running
+  in_use = [5000, 16.0]
+  assert plan._admit('liba', in_use, {})
+  in_use = [800, 2.0]
+  assert not plan._admit('app', in_use, {'f1': 'liba'})
+  # its need is held back, so what would have fitted still has to wait
+  assert in_use == [1600, 4.0]
+  plan.estimates['libb'] = {'wall': 1.0, 'cpu': 0.5, 'mem_mib': 100}
+  assert not plan._admit('libb', in_use, {'f1': 'liba'})
+  assert plan._admit('libb', [800, 2.0], {'f1': 'liba'})
+  plan.mem_budget = 0
+  assert not plan._admit('app', [800, 2.5], {'f1': 'liba'})
+  plan.options.cpu_budget = 0
+  assert plan._admit('app', [800, 2.5], {'f1': 'liba'})
+
+
+def test_over_budget_waits(tmp_path, bench_deps):
+  options = argparse.Namespace(
+      seed=1, source_files=1, swdb_fraction=0.0, latency={'make': 0.5}, packager='native', make_jobs=1,
+      python=sys.executable, deps=str(TOP / 'vscripts' / 'deps.py'))
+  scenario = bench_deps.Scenario(options, 'wide', 4, tmp_path)
+  scenario.generate()
+  base, first, second, small = scenario.names
+  stats = {base: {'compile': [[0.5, 0.5, 10 * 1024]]}, first: {'compile': [[0.5, 0.5, 600 * 1024]]},
+           second: {'compile': [[0.5, 0.5, 700 * 1024]]}, small: {'compile': [[0.5, 0.5, 100 * 1024]]}}
+  (tmp_path / 'out' / '.build-stats.json').write_text(json.dumps(stats))
+  scenario.run('plan', '--prepare-outside')
+  scenario.run('build', '--run-inside', '--jobs', '3', '--mem-budget', '1000', '--cpu-budget', '0')
+
+  log = (tmp_path / 'build.log').read_text()
+  assert f'Waiting for memory: \x1b[3m{second}' in log
+  records = [json.loads(l) for l in (tmp_path / 'out' / 'build-report.jsonl').read_text().splitlines()]
+  spans = {}
+  for r in records:
+    if r['type'] == 'stage':
+      start = datetime.datetime.fromisoformat(r['started']).timestamp()
+      lo, hi = spans.get(r['product'], (start, start + r['wall']))
+      spans[r['product']] = (min(lo, start), max(hi, start + r['wall']))
+  assert spans[second][0] >= spans[first][1]
+  # the small one would have fitted alongside the first, but waits its turn
+  # behind the second, then goes with it
+  assert spans[small][0] >= spans[first][1]
+  assert spans[small][0] < spans[second][1]
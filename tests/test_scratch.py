@@ -0,0 +1,24 @@
+# ScratchSpace making room: only the trees of finished products go, and the
+# plan is told, so as to forget the stages done in them.
+
+
+def test_evicts_finished_only(deps, tmp_path):
+  evicted = []
+  # a cap of a byte: nothing fits, so everything finished has to go
+  scratch = deps.ScratchSpace(str(tmp_path / 'scratch'), 1, evicted=evicted.append)
+  for name in ('done', 'building'):
+    tree = tmp_path / 'scratch' / name
+    (tree / 'sub').mkdir(parents=True)
+    (tree / 'sub' / 'file').write_text(name)
+    scratch.track(name, [str(tree), str(tmp_path / 'elsewhere' / name)])
+  scratch.finished('done')
+
+  assert scratch.place('next', 100) is None
+  assert evicted == ['done']
+  assert not (tmp_path / 'scratch' / 'done').exists()
+  assert (tmp_path / 'scratch' / 'building' / 'sub' / 'file').exists()
+  assert scratch.stats['evicted'] == 1
+
+  # and only the once
+  assert scratch.place('next', 100) is None
+  assert evicted == ['done']
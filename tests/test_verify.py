@@ -0,0 +1,89 @@
+# Signature checks: gpg runs once per tarball and signature, for a keyring,
+# and failures are never remembered.
+
+import pytest
+
+from conftest import new_plan
+
+# logs what it's asked; signatures containing "bad" don't verify
+FAKE_GPG = '''#!/bin/sh
+echo "$*" >> "$GNUPGHOME/calls.log"
+for last; do :; done
+case "$*" in
+  *--list-keys*) cat "$GNUPGHOME/fingerprints" ;;
+  *--verify*)
+    if grep -q bad "$last"; then echo "gpg: BAD signature" >&2; exit 1; fi
+    echo "[GNUPG:] VALIDSIG FPR1111 2020-01-01"
+    ;;
+esac
+'''
+
+
+@pytest.fixture
+def gpg(third_party, monkeypatch):
+  home = third_party / 'gnupg'
+  home.mkdir()
+  (home / 'pubring.kbx').write_text('keys')
+  (home / 'fingerprints').write_text('fpr:::::::::FPR1111:\n')
+  fake = third_party / 'gpg'
+  fake.write_text(FAKE_GPG)
+  fake.chmod(0o755)
+  monkeypatch.setenv('GNUPGHOME', str(home))
+  for n in ('liba', 'libb', 'app'):
+    (third_party / 'in' / f'{n}-1.0.tar.gz.sig').write_text(f'{n} signature\n')
+  return home
+
+
+def verify(deps, third_party):
+  plan = new_plan(deps, third_party, '--gpg', str(third_party / 'gpg'))
+  plan.verify_signatures([(n, plan.products[n].tarball) for n in plan.ordered])
+  return plan
+
+
+def verified(gpg):
+  calls = (gpg / 'calls.log').read_text().splitlines() if (gpg / 'calls.log').exists() else []
+  (gpg / 'calls.log').write_text('')
+  return sorted(c.rsplit('/', 1)[1] for c in calls if '--verify' in c)
+
+
+def keyring_reads(gpg):
+  return sum('--list-keys' in c for c in (gpg / 'calls.log').read_text().splitlines())
+
+
+def test_verified_once(deps, third_party, gpg):
+  plan = verify(deps, third_party)
+  assert plan.verified['liba']['signer'] == 'FPR1111'
+  assert verified(gpg) == ['app-1.0.tar.gz.sig', 'liba-1.0.tar.gz.sig', 'libb-1.0.tar.gz.sig']
+  plan = verify(deps, third_party)
+  assert sorted(plan.verified) == ['app', 'liba', 'libb']
+  assert verified(gpg) == []
+  # nor is the keyring listed again while it's unchanged
+  assert keyring_reads(gpg) == 0
+
+
+def test_changed_tarball_verified_again(deps, third_party, gpg):
+  verify(deps, third_party)
+  verified(gpg)
+  (third_party / 'in' / 'libb-1.0.tar.gz').write_text('libb, respun\n')
+  verify(deps, third_party)
+  assert verified(gpg) == ['libb-1.0.tar.gz.sig']
+
+
+def test_new_keyring_verifies_again(deps, third_party, gpg):
+  verify(deps, third_party)
+  verified(gpg)
+  (gpg / 'pubring.kbx').write_text('keys, and another')
+  (gpg / 'fingerprints').write_text('fpr:::::::::FPR1111:\nfpr:::::::::FPR2222:\n')
+  verify(deps, third_party)
+  assert len(verified(gpg)) == 3
+
+
+def test_failures_not_cached(deps, third_party, gpg):
+  (third_party / 'in' / 'libb-1.0.tar.gz.sig').write_text('bad signature\n')
+  with pytest.raises(deps.Error, match='gpg --verify failed'):
+    verify(deps, third_party)
+  # all were tried, and the good ones kept
+  assert len(verified(gpg)) == 3
+  with pytest.raises(deps.Error):
+    verify(deps, third_party)
+  assert verified(gpg) == ['libb-1.0.tar.gz.sig']
@@ -0,0 +1,21 @@
+# InputWatcher, by inotify and by polling: what we download into the
+# tarballs dir ourselves is not a change to rebuild for.
+
+import pytest
+
+
+@pytest.mark.parametrize('poll', [0, 0.1])
+def test_own_writes_ignored(deps, tmp_path, poll):
+  tarballs = tmp_path / 'in'
+  tarballs.mkdir()
+  watcher = deps.InputWatcher([], [str(tarballs)], poll=poll)
+  ours = tarballs / 'fetched-1.0.tar.gz'
+  ours.write_bytes(b'downloaded')
+  watcher.written([str(ours)])
+  theirs = tarballs / 'dropped-1.0.tar.gz'
+  theirs.write_bytes(b'put there by hand')
+  assert watcher.wait() == [str(theirs)]
+
+  # replaced since, it counts
+  ours.write_bytes(b'put there by hand, too')
+  assert watcher.wait() == [str(ours)]
@@ -68,8 +68,33 @@ end
 if ENV.has_key?('PT_INITIAL_DEPLOY')
   $vbuild_env['PT_INITIAL_DEPLOY'] = ENV['PT_INITIAL_DEPLOY']
 end
+['PT_BUILD_JOBS', 'PT_MAKE_JOBS', 'PT_CONFIGURE_CACHE', 'PT_STRIP', 'PT_MEM_BUDGET', 'PT_CPU_BUDGET', 'PT_TMPFS_CAP', 'PT_CHECK'].each do |k|
+  if ENV.has_key?(k)
+    $vbuild_env[k] = ENV[k]
+  end
+end
 
 $asset_indir = ENV["PT_GNUPG_IN"] || "./in"
+# Shared across all boxes; ccache keys on the compiler, so mixing OSes is safe.
+$ccache_dir = ENV["PT_CCACHE_DIR"]
+if ! $ccache_dir.nil?
+  $vbuild_env['PT_CCACHE_DIR'] = '/ccache'
+end
+# Extracted sources, keyed by tarball hash, so also fine to share.
+$pristine_dir = ENV["PT_PRISTINE_DIR"]
+if ! $pristine_dir.nil?
+  $vbuild_env['PT_PRISTINE_DIR'] = '/pristine'
+end
+# Built trees and packages, kept apart by ABI, so also fine to share.
+$artifact_store = ENV["PT_ARTIFACT_STORE"]
+if ! $artifact_store.nil?
+  $vbuild_env['PT_ARTIFACT_STORE'] = '/artifacts'
+end
+# Work and DESTDIR trees in RAM, while they fit.
+$tmpfs_size = ENV["PT_TMPFS_SIZE"]
+if ! $tmpfs_size.nil?
+  $vbuild_env['PT_TMPFS_DIR'] = '/pt-tmpfs'
+end
 # Triggers local environmental actions such as configuring home cache; this
 # should become somewhat less kludgy.
 $enable_ptlocal = ENV["NAME"] == "Phil Pennock"
@@ -129,6 +154,18 @@ def run_container(wanted_name)
     d_run_argv += ['--mount', "type=bind,src=#{Pathname($asset_indir).realpath.to_path},dst=/in,readonly"]
     d_run_argv += ['--mount', "type=bind,src=#{generated_assets_dir},dst=/out"]
     d_run_argv += ['--mount', "type=bind,src=#{Pathname('.').realpath.to_path},dst=/vagrant,readonly"]
+    if ! $ccache_dir.nil?
+      d_run_argv += ['--mount', "type=bind,src=#{Pathname($ccache_dir).realpath.to_path},dst=/ccache"]
+    end
+    if ! $pristine_dir.nil?
+      d_run_argv += ['--mount', "type=bind,src=#{Pathname($pristine_dir).realpath.to_path},dst=/pristine"]
+    end
+    if ! $artifact_store.nil?
+      d_run_argv += ['--mount', "type=bind,src=#{Pathname($artifact_store).realpath.to_path},dst=/artifacts"]
+    end
+    if ! $tmpfs_size.nil?
+      d_run_argv += ['--tmpfs', "/pt-tmpfs:rw,exec,size=#{$tmpfs_size}"]
+    end
     d_run_argv += ['-w', '/vagrant']
     d_run_argv += [image]
     bash_commands = []
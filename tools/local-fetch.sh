@@ -6,7 +6,7 @@ set -eu
 
 ./tools/host.presetup.sh
 PT_BUILD_CONFIGS_DIR=./confs PT_BUILD_TARBALLS_DIR="./in" \
-  ./vscripts/deps.py --prepare-outside --base-dir . --gnupg-trust-model tofu
+  ./vscripts/deps.py --prepare-outside --base-dir . --patches-dir ./patches --gnupg-trust-model tofu
 
 printf 'Vagrant targets: '
 jq -r < confs/machines.json '.[]|select(has("box"))|.name' | sort | xargs
@@ -3,9 +3,10 @@
 """
 build: Build GnuPG and dependencies, in order
 
-Ultimate goal (probably not implemented yet) is to handle existing packages on
-apt repo, grab those which are usable if none of their dependencies need
-rebuilding, reuse as much as possible, but build what's needed.
+Given a published apt repo (--published-repo), packages already there are
+reused when none of their inputs or dependencies need rebuilding; when they
+do, the product is rebuilt, with its package version auto-bumped if the
+configured version is already taken in the repo.  Only what's needed is built.
 """
 
 __author__ = 'phil@pennock-tech.com (Phil Pennock)'
@@ -13,15 +14,25 @@ __author__ = 'phil@pennock-tech.com (Phil Pennock)'
 import argparse
 import collections
 import datetime
+import functools
+import hashlib
+import io
 import json
 import os
-import platform
 import re
+import resource
+import shlex
+import shutil
+import stat
 import subprocess
 import sys
 import tempfile
-
-import requests
+import threading
+import time
+import traceback
+# Only building, packaging, fetching and --watch need concurrent.futures,
+# ctypes, gzip, lzma, platform, select, struct, tarfile or requests; they're
+# imported where used, so that a run with nothing to do starts quickly.
 
 # *sob*
 if os.path.exists('/var/run/bootstrap.older.optgnupg-gnupg'):
@@ -48,10 +59,50 @@ PKG_PREFIX = 'optgnupg'
 PKG_VERSIONEXT = 'unknown'
 PKG_INSTALL_CMD = '/usr/local/bin/pt-build-pkg-install'  # wrapper: sudo dpkg -i (or equivalent per OS)
 PKG_UNINSTALL_CMD = '/usr/local/bin/pt-build-pkg-uninstall'
+CACHE_DIRNAME = '.build-cache'  # within results dir, unless overridden
+MACHINES_FN = CONFS_DIR + '/machines.json'
+BUILD_KEY_FIELD = 'Pt-Build-Key'  # custom control field in our packages
+FETCH_JOBS = 4
+VERIFY_CACHE_FN = '.gpg-verified.json'  # within tarballs dir, unless overridden
+BUILD_REPORT_FN = 'build-report.jsonl'  # within results dir
+PLAN_FN = 'build-plan.json'  # within tarballs dir, unless overridden
+WATCH_SETTLE = 0.5  # seconds without further changes before rebuilding
+WATCH_POLL = 2.0  # seconds between looks, where we can't use inotify
+PLAN_FORMAT = 1
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+COMPILER_CACHE_CMD = 'ccache'
+# ccache counters, as named by --print-stats and in the stats_log
+COMPILER_CACHE_HITS = ('direct_cache_hit', 'preprocessed_cache_hit')
+COMPILER_CACHE_MISSES = ('cache_miss',)
+FETCH_CHUNK = 1 << 20
+PRISTINE_DIRNAME = '.pristine'  # within base dir, unless overridden
+PRISTINE_MANIFEST_FN = '.pristine-manifest.json'
+FICLONE = 0x40049409  # ioctl, from linux/fs.h: reflink a file
+CONFIGURE_CACHE_DIRNAME = '.configure-cache'  # within results dir, unless overridden
+# what configure checks depend upon beyond a product's own env settings, which may be inherited
+CONFIGURE_CACHE_ENV = ('CC', 'CXX', 'CPP', 'CXXCPP', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS',
+                       'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR')
+SCRATCH_DIRNAME = 'pt-build.{}'  # within tmpfs dir, per box
+# Stages whose results live in the work tree or DESTDIR tree, not the package
+WORK_TREE_STAGES = ('untar', 'patch', 'configure', 'compile', 'tmpinstall', 'prepackage-fixup', 'optimize')
+CHECK_MODES = ('require', 'warn')  # per product, as "check"; false to skip
+STRIP_MODES = ('none', 'strip', 'split')
+STRIP_CMD = 'strip'
+OBJCOPY_CMD = 'objcopy'
+STAGE_STATE_FN = '.stage-state.json'  # within base dir
+INPUT_HASHES_FN = '.input-hashes.json'  # within base dir
+STATS_FN = '.build-stats.json'  # within results dir, unless overridden
+STATS_KEEP = 5  # builds of each product to estimate from
 
 PACKAGE_TYPES = {
     'debian-family': 'deb',
 }
+PACKAGERS = ('native', 'fpm')  # native only knows deb
+DEB_COMPRESSORS = {
+    # name: (member suffix, threaded command)
+    'xz': ('.xz', ['xz', '-T0', '-c']),
+    'zstd': ('.zst', ['zstd', '-T0', '-q', '-c']),
+}
 
 
 class Error(Exception):
@@ -90,6 +141,1736 @@ class OurJSONEncoder(json.JSONEncoder):
     return json.JSONEncoder.default(self, o)
 
 
+class LineAtomicOutput(object):
+  """LineAtomicOutput wraps a stream so that each thread writes whole lines.
+
+  print() writes the text and the line ending separately, which interleaves
+  badly once several builds are printing at once.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self._lock = threading.Lock()
+    self._pending = {}  # thread ident: text of its unfinished line
+
+  def write(self, text):
+    me = threading.get_ident()
+    with self._lock:
+      buffered = self._pending.pop(me, '') + text
+      complete, newline, rest = buffered.rpartition('\n')
+      if rest:
+        self._pending[me] = rest
+      if newline:
+        self.stream.write(complete + newline)
+    return len(text)
+
+  def flush(self):
+    with self._lock:
+      self.stream.flush()
+
+  def unwrap(self):
+    """Write out any unfinished lines and return the wrapped stream."""
+    with self._lock:
+      for text in self._pending.values():
+        self.stream.write(text + '\n')
+      self._pending.clear()
+      self.stream.flush()
+    return self.stream
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+def instrumented_stage(method):
+  """Decorator for BuildPlan stage methods, recording what each run cost.
+
+  Wall time, plus CPU time, peak RSS and blocks written of both the commands
+  run via BuildPlan._check_call and of our own thread, accumulate into a
+  record which is handed to BuildPlan._finish_stage_record.
+  """
+  @functools.wraps(method)
+  def wrapper(self, product, *args, **kwargs):
+    record = {
+      'type': 'stage', 'box': self.options.boxname, 'product': product.name, 'stage': method.__name__,
+      'started': datetime.datetime.now().isoformat(), 'already': False, 'failed': False,
+      'cpu_user': 0.0, 'cpu_sys': 0.0, 'max_rss_kb': 0, 'bytes_written': 0,
+      }
+    outer = getattr(self._stage_local, 'record', None)
+    self._stage_local.record = record
+    ours = resource.getrusage(RUSAGE_THREAD)
+    t0 = time.monotonic()
+    try:
+      return method(self, product, *args, **kwargs)
+    except:
+      record['failed'] = True
+      raise
+    finally:
+      record['wall'] = time.monotonic() - t0
+      _add_rusage(record, resource.getrusage(RUSAGE_THREAD), since=ours)
+      for k in ('wall', 'cpu_user', 'cpu_sys'):
+        record[k] = round(record[k], 3)
+      self._stage_local.record = outer
+      self._finish_stage_record(record)
+  return wrapper
+
+
+def _add_rusage(record, ru, since=None):
+  # Linux carries the RSS high-water mark across exec, so a child's peak
+  # never reads below the size of this Python process at fork time.
+  if since is None:
+    record['cpu_user'] += ru.ru_utime
+    record['cpu_sys'] += ru.ru_stime
+    record['bytes_written'] += ru.ru_oublock * 512
+    record['max_rss_kb'] = max(record['max_rss_kb'], ru.ru_maxrss)
+  else:
+    # our own thread: maxrss is of the whole process, so is not meaningful here
+    record['cpu_user'] += ru.ru_utime - since.ru_utime
+    record['cpu_sys'] += ru.ru_stime - since.ru_stime
+    record['bytes_written'] += (ru.ru_oublock - since.ru_oublock) * 512
+
+
+def _sha256_file(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as fh:
+    for chunk in iter(lambda: fh.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _hash_json(data):
+  return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _umask():
+  # there's no reading the umask without setting it, so do that once, before any threads
+  mask = os.umask(0o022)
+  os.umask(mask)
+  return mask
+
+UMASK = _umask()
+
+
+def _as_created(fd):
+  """Give a file from mkstemp (always 0600) the mode open() would have, so
+  that what we write for other boxes and users to share is readable."""
+  os.fchmod(fd, 0o666 & ~UMASK)
+
+
+def _atomic_write_json(path, data):
+  """Write JSON to path such that readers see either old or new content."""
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.' + os.path.basename(path) + '.')
+  try:
+    _as_created(fd)
+    with os.fdopen(fd, 'w') as fh:
+      json.dump(data, fh, indent=2, sort_keys=True, cls=OurJSONEncoder)
+      print(file=fh)
+    os.replace(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+
+def _link_or_copy(src, dst):
+  """Hardlink src to dst, falling back to a copy across filesystems."""
+  if os.path.exists(dst):
+    os.unlink(dst)
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+
+
+class DependencyGraph(object):
+  """DependencyGraph is the "A needed for B" graph of products.
+
+  Reads the tsort(1) input format: whitespace-separated pairs, where a pair
+  naming the same node twice just declares it.  Nodes are numbered in
+  topological order (ties broken by first appearance, so the file order
+  means something) and the transitive closures of dependencies and of reverse
+  dependencies are computed once, as bitsets over those numbers.
+  """
+
+  def __init__(self, pairs):
+    self.nodes = []
+    index = {}
+    direct = collections.defaultdict(set)
+    for before, after in pairs:
+      for n in (before, after):
+        if n not in index:
+          index[n] = len(self.nodes)
+          self.nodes.append(n)
+      if before != after:
+        direct[after].add(before)
+    self.order = self._toposort(direct, index)
+    self.index = {n: i for i, n in enumerate(self.order)}
+    self.direct_needs = {n: sorted(direct[n], key=self.index.get) for n in self.order}
+    self._needs_bits = [0] * len(self.order)
+    for i, n in enumerate(self.order):
+      for dep in self.direct_needs[n]:
+        d = self.index[dep]
+        self._needs_bits[i] |= (1 << d) | self._needs_bits[d]
+    self._invalidates_bits = [0] * len(self.order)
+    for i, n in enumerate(self.order):
+      bits = self._needs_bits[i]
+      while bits:
+        low = bits & -bits
+        self._invalidates_bits[low.bit_length() - 1] |= 1 << i
+        bits ^= low
+
+  @classmethod
+  def from_file(cls, fn):
+    with open(fn) as fh:
+      words = [w for l in fh for w in l.split('#', 1)[0].split()]
+    if len(words) % 2:
+      raise Error('odd number of names in {!r}, want pairs'.format(fn))
+    return cls(zip(words[0::2], words[1::2]))
+
+  def _toposort(self, direct, index):
+    waiting = {n: len(direct[n]) for n in self.nodes}
+    users = collections.defaultdict(list)
+    for n in self.nodes:
+      for dep in direct[n]:
+        users[dep].append(n)
+    order = []
+    ready = [n for n in self.nodes if not waiting[n]]
+    while ready:
+      n = ready.pop(0)
+      order.append(n)
+      for user in users[n]:
+        waiting[user] -= 1
+        if not waiting[user]:
+          ready.append(user)
+      ready.sort(key=index.get)
+    if len(order) != len(self.nodes):
+      raise Error('dependency cycle: ' + ' -> '.join(self._find_cycle(direct, set(order))))
+    return order
+
+  def _find_cycle(self, direct, sorted_ok):
+    # Every node left over is on, or downstream of, a cycle: walking back
+    # through unsorted dependencies must eventually revisit a node.
+    n = next(n for n in self.nodes if n not in sorted_ok)
+    path = []
+    seen = {}
+    while n not in seen:
+      seen[n] = len(path)
+      path.append(n)
+      n = min((d for d in direct[n] if d not in sorted_ok), key=self.nodes.index)
+    cycle = path[seen[n]:] + [n]
+    cycle.reverse()  # report as "needed for" order
+    return cycle
+
+  def _names(self, bits):
+    return set(self.order[i] for i in range(bits.bit_length()) if bits >> i & 1)
+
+  def needs(self, name):
+    """Everything which name needs, directly or indirectly."""
+    return self._names(self._needs_bits[self.index[name]])
+
+  def invalidates(self, name):
+    """Everything which needs name, directly or indirectly."""
+    return self._names(self._invalidates_bits[self.index[name]])
+
+  def levels(self):
+    """Lists of nodes, each level needing only nodes from earlier levels."""
+    level = {}
+    for n in self.order:
+      level[n] = 1 + max((level[d] for d in self.direct_needs[n]), default=-1)
+    result = [[] for _ in range(1 + max(level.values(), default=-1))]
+    for n in self.order:
+      result[level[n]].append(n)
+    return result
+
+  def ready(self, done):
+    """Nodes not in done, all of whose dependencies are, in order."""
+    done_bits = 0
+    for n in done:
+      done_bits |= 1 << self.index[n]
+    return [n for i, n in enumerate(self.order)
+            if not done_bits >> i & 1 and self._needs_bits[i] & ~done_bits == 0]
+
+
+def _memory_mib():
+  """Memory we may use: the cgroup limit (as in a container), else all of it."""
+  for fn in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+    try:
+      with open(fn) as fh:
+        limit = fh.read().strip()
+    except OSError:
+      continue
+    if limit.isdigit() and int(limit) < 1 << 60:
+      return int(limit) >> 20
+  try:
+    with open('/proc/meminfo') as fh:
+      for line in fh:
+        if line.startswith('MemTotal:'):
+          return int(line.split()[1]) >> 10
+  except OSError:
+    pass
+  return 0
+
+
+def _parse_mib(text):
+  """'2048' (MiB), '512M', '16G' into MiB; 0 for no limit."""
+  text = text.strip().upper()
+  if text.endswith('B'):
+    text = text[:-1]
+  scale = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+  if text and text[-1] in scale:
+    return int(float(text[:-1]) * scale[text[-1]])
+  return int(text)
+
+
+class BuildStats(object):
+  """BuildStats keeps the resources used by each stage of each product, over
+  its last few builds on this box, to estimate what the next will take.
+
+  Peak RSS, as getrusage reports it, is of the biggest single process; for a
+  stage running several at once (make -jN), we scale it by the average CPU
+  parallelism of the stage to estimate their total.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      self.products = json.load(open(path))
+    except (OSError, ValueError):
+      self.products = {}
+
+  def add(self, records):
+    for r in records:
+      if r.get('type') != 'stage' or r['already'] or r['failed']:
+        continue
+      samples = self.products.setdefault(r['product'], {}).setdefault(r['stage'], [])
+      samples.append([r['wall'], round(r['cpu_user'] + r['cpu_sys'], 3), r['max_rss_kb']])
+      del samples[:-STATS_KEEP]
+
+  def save(self):
+    try:
+      _atomic_write_json(self.path, self.products)
+    except OSError as e:
+      print('\033[33mNot saving build stats: {}\033[0m'.format(e), flush=True)
+
+  def estimate(self, product_name):
+    """{'wall': seconds, 'cpu': CPUs, 'mem_mib': MiB} at its busiest stage,
+    or None if we've never built it."""
+    stages = self.products.get(product_name)
+    if not stages:
+      return None
+    wall = 0.0
+    cpu = 0.0
+    mem_mib = 0.0
+    for stage, samples in stages.items():
+      stage_wall = sum(s[0] for s in samples) / len(samples)
+      # nb: stages of under a second are too brief for their ratio to mean much
+      parallelism = sum(s[1] for s in samples) / max(float(len(samples)), sum(s[0] for s in samples))
+      if stage != 'check':  # which runs after the product is installed
+        wall += stage_wall
+      cpu = max(cpu, parallelism)
+      mem_mib = max(mem_mib, max(s[2] for s in samples) / 1024 * max(1.0, parallelism))
+    return {'wall': round(wall, 3), 'cpu': round(cpu, 2), 'mem_mib': int(mem_mib)}
+
+
+class BuildCache(object):
+  """BuildCache holds built packages, keyed by a hash of all of their inputs.
+
+  Layout: <cache_dir>/<kk>/<key>/ holds the package and an entry.json
+  describing what went into it; <cache_dir>/products.json maps each product
+  to the key it was last built or reused with, so that we can tell what
+  changed since the previous run.
+  """
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self._lock = threading.Lock()
+    self._products_fn = os.path.join(self.cache_dir, 'products.json')
+    try:
+      self.last_keys = json.load(open(self._products_fn))
+    except (OSError, ValueError):
+      self.last_keys = {}
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def lookup(self, key):
+    """Returns the cached package path for key, or None."""
+    try:
+      entry = json.load(open(os.path.join(self._entry_dir(key), 'entry.json')))
+    except (OSError, ValueError):
+      return None
+    pkgpath = os.path.join(self._entry_dir(key), entry['package'])
+    if not os.path.exists(pkgpath):
+      return None
+    return pkgpath
+
+  def extras(self, key):
+    """Returns paths of the other packages stored with key's (eg: -dbg)."""
+    try:
+      entry = json.load(open(os.path.join(self._entry_dir(key), 'entry.json')))
+    except (OSError, ValueError):
+      return []
+    paths = [os.path.join(self._entry_dir(key), fn) for fn in entry.get('extras', [])]
+    return [p for p in paths if os.path.exists(p)]
+
+  def check_result(self, key):
+    """Returns how the test suite went for key's build, or None if not run."""
+    try:
+      entry = json.load(open(os.path.join(self._entry_dir(key), 'entry.json')))
+    except (OSError, ValueError):
+      return None
+    return entry.get('check')
+
+  def store(self, key, product_name, pkgpath, inputs, extras=(), check=None):
+    entry_dir = self._entry_dir(key)
+    os.makedirs(entry_dir, exist_ok=True)
+    for path in [pkgpath] + list(extras):
+      _link_or_copy(path, os.path.join(entry_dir, os.path.basename(path)))
+    _atomic_write_json(os.path.join(entry_dir, 'entry.json'), {
+      'product': product_name,
+      'package': os.path.basename(pkgpath),
+      'extras': [os.path.basename(path) for path in extras],
+      'inputs': inputs,
+      'check': check,
+      'stored': datetime.datetime.now().isoformat(),
+      })
+
+  def record_used(self, product_name, key):
+    with self._lock:
+      self.last_keys[product_name] = key
+      _atomic_write_json(self._products_fn, self.last_keys)
+
+
+class Fetcher(object):
+  """Fetcher downloads files concurrently, over pooled HTTP connections.
+
+  Each download is written to a .part file beside the target, resumed with an
+  HTTP Range request if a previous attempt left one behind, checked against
+  the expected sha256 (where we know it) and only then renamed into place;
+  so an interrupted download never looks like a complete file.
+  """
+
+  def __init__(self, jobs=FETCH_JOBS):
+    # Imported here: it takes longer to import than a no-op run takes
+    # otherwise, and is only needed when there's something to fetch.
+    import requests
+    self.jobs = max(1, jobs)
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=self.jobs, pool_maxsize=self.jobs)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def fetch_many(self, wanted):
+    """Fetch each (url, outpath, sha256-or-None); returns paths fetched.
+
+    All downloads are attempted; the first error is raised afterwards.
+    """
+    import concurrent.futures
+    fetched = []
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      futures = {pool.submit(self.fetch, url, outpath, sha256): outpath for url, outpath, sha256 in wanted}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          future.result()
+          fetched.append(futures[future])
+        except Exception as e:
+          print('\033[31;1mFetch failed for {}: {}\033[0m'.format(futures[future], e), file=sys.stderr, flush=True)
+          errors.append(e)
+    if errors:
+      raise errors[0]
+    return fetched
+
+  def fetch(self, url, outpath, sha256=None):
+    partial = outpath + '.part'
+    headers = {}
+    have = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if have:
+      headers['Range'] = 'bytes={}-'.format(have)
+      print('\033[36;1mResuming <{}> from {} bytes\033[0m'.format(url, have), flush=True)
+    else:
+      print('\033[36;1mFetching <{}>\033[0m'.format(url), flush=True)
+    with self.session.get(url, stream=True, headers=headers, timeout=60) as r:
+      if r.status_code == 416:
+        pass  # .part already holds everything the server has; check it
+      else:
+        r.raise_for_status()
+        mode = 'ab' if have and r.status_code == 206 else 'wb'
+        with open(partial, mode, buffering=FETCH_CHUNK) as fd:
+          for chunk in r.iter_content(chunk_size=FETCH_CHUNK):
+            fd.write(chunk)
+    if sha256 and _sha256_file(partial) != sha256:
+      os.unlink(partial)
+      raise Error('sha256 mismatch for <{}>, discarded download'.format(url))
+    os.replace(partial, outpath)
+
+
+class VerificationCache(object):
+  """VerificationCache remembers which tarballs gpg has accepted signatures for.
+
+  Entries are keyed on the sha256 of the tarball and of its signature, plus
+  an identifier for the set of key fingerprints in the keyring (and the trust
+  model), so changing any of those means verifying afresh.  That identifier
+  is itself remembered against the size and mtime of the keyring files, so
+  that when nothing changed we needn't run gpg at all.  The tarballs dir is
+  read-only inside containers, so failing to save is not an error.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.keyring_id = None
+    self._lock = threading.Lock()
+    self._dirty = False
+    try:
+      self.entries = json.load(open(path))
+    except (OSError, ValueError):
+      self.entries = {}
+
+  def use_keyring(self, keyring_stat, get_keyring_id):
+    """Sets keyring_id: remembered for keyring_stat, or from get_keyring_id()."""
+    key = 'keyring:' + _hash_json(keyring_stat)
+    if key not in self.entries:
+      self.entries[key] = get_keyring_id()
+      self._dirty = True
+    self.keyring_id = self.entries[key]
+
+  def _key(self, tarball_sha256, sig_sha256):
+    return '{}:{}:{}'.format(tarball_sha256, sig_sha256, self.keyring_id)
+
+  def get(self, tarball_sha256, sig_sha256):
+    return self.entries.get(self._key(tarball_sha256, sig_sha256))
+
+  def put(self, tarball_sha256, sig_sha256, result):
+    with self._lock:
+      self.entries[self._key(tarball_sha256, sig_sha256)] = result
+      self._dirty = True
+
+  def save(self):
+    if not self._dirty:
+      return
+    try:
+      _atomic_write_json(self.path, self.entries)
+      self._dirty = False
+    except OSError as e:
+      print('\033[33mNot saving gpg verification cache: {}\033[0m'.format(e), flush=True)
+
+
+class InputHashes(object):
+  """InputHashes remembers the sha256 of input files, against their stat.
+
+  A file whose size, mtime and inode are as when we hashed it is taken to be
+  unchanged.  Files modified within the last few seconds are not remembered,
+  as a write landing within the same mtime tick would go unnoticed.
+  """
+
+  RECENT = 2  # seconds
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._dirty = False
+    try:
+      self.entries = json.load(open(path))
+    except (OSError, ValueError):
+      self.entries = {}
+
+  def sha256(self, path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+    with self._lock:
+      known = self.entries.get(path)
+    if known is not None and known[:3] == stamp:
+      return known[3]
+    digest = _sha256_file(path)
+    if time.time() - st.st_mtime > self.RECENT:
+      with self._lock:
+        self.entries[path] = stamp + [digest]
+        self._dirty = True
+    return digest
+
+  def save(self):
+    if not self._dirty:
+      return
+    with self._lock:
+      try:
+        _atomic_write_json(self.path, self.entries)
+        self._dirty = False
+      except OSError as e:
+        print('\033[33mNot saving input hashes: {}\033[0m'.format(e), flush=True)
+
+
+class StageManifest(object):
+  """StageManifest records which stages are done for each product on a box,
+  all in one file.
+
+  A stage counts as done only for the input key it was done with: recording a
+  stage under a new key forgets everything done under the old one.  Stages of
+  concurrent builds are recorded from several threads; each update rewrites
+  the file atomically, so a build which dies leaves it either side of its
+  last stage.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    try:
+      self.products = json.load(open(path))
+    except FileNotFoundError:
+      self.products = {}
+    except ValueError as e:
+      print('\033[33mIgnoring unreadable stage state {}: {}\033[0m'.format(path, e), flush=True)
+      self.products = {}
+
+  def _save(self):
+    _atomic_write_json(self.path, self.products)
+
+  def get(self, product_name, key, stage):
+    """Returns what was recorded for the stage, or None if not done."""
+    with self._lock:
+      entry = self.products.get(product_name)
+      if entry is None or entry['key'] != key:
+        return None
+      return entry['stages'].get(stage)
+
+  def record(self, product_name, key, stage, content):
+    with self._lock:
+      entry = self.products.get(product_name)
+      if entry is None or entry['key'] != key:
+        entry = self.products[product_name] = {'key': key, 'stages': {}}
+      entry['stages'][stage] = content
+      self._save()
+
+  def forget(self, product_name, stage):
+    with self._lock:
+      entry = self.products.get(product_name)
+      if entry is not None and entry['stages'].pop(stage, None) is not None:
+        self._save()
+
+  def discard_stale(self, product_name, key):
+    """Drop the product's stages if they were done with other inputs;
+    returns those dropped."""
+    with self._lock:
+      entry = self.products.get(product_name)
+      if entry is None or entry['key'] == key:
+        return {}
+      del self.products[product_name]
+      self._save()
+      return entry['stages']
+
+  def adopt_flag_files(self, base_dir, keys):
+    """Take over stages recorded by older versions, as one flag file per
+    stage, and remove those.
+
+    Flag files named .done.<product>.<stage> predate input keys, so are taken
+    to be for the current inputs, as those versions would have; ones named
+    .done.<product>.<key[:16]>.<stage> count only for the current key.
+    """
+    legacy = [fn for fn in os.listdir(base_dir) if fn.startswith('.done.')]
+    if not legacy:
+      return
+    adopted = 0
+    # longest first, so that a product named as a prefix of another can't claim its files
+    names = sorted(keys, key=len, reverse=True)
+    with self._lock:
+      for fn in legacy:
+        for product_name in names:
+          key = keys[product_name]
+          prefix = '.done.{}.'.format(product_name)
+          if not fn.startswith(prefix):
+            continue
+          stage = fn[len(prefix):]
+          scoped = re.match(r'^([0-9a-f]{16})\.(.+)$', stage)
+          if scoped:
+            if scoped.group(1) != key[:16]:
+              break  # done with other inputs
+            stage = scoped.group(2)
+          with open(os.path.join(base_dir, fn)) as fh:
+            content = fh.readline().rstrip('\n')
+          entry = self.products.get(product_name)
+          if entry is None or entry['key'] != key:
+            entry = self.products[product_name] = {'key': key, 'stages': {}}
+          entry['stages'].setdefault(stage, content)
+          adopted += 1
+          break
+      self._save()
+    for fn in legacy:
+      os.unlink(os.path.join(base_dir, fn))
+    print('\033[36mMoved {} of {} stage flag files into \033[3m{}\033[0m'.format(
+        adopted, len(legacy), self.path), flush=True)
+
+
+class MakeJobserver(object):
+  """MakeJobserver is a GNU make jobserver shared by concurrent builds.
+
+  Each make runs one job without asking, as if it held a slot, so each is
+  started between acquire() and release(), which take a token from the pipe
+  for that job and give it back.  Makes run with env() as their environment
+  act as sub-makes of this jobserver, taking tokens for their other jobs from
+  the same pipe; so however many products compile at once, together they
+  stay within the same number of jobs.
+  """
+
+  def __init__(self, jobs):
+    self.jobs = max(1, jobs)
+    self.read_fd, self.write_fd = os.pipe()
+    os.write(self.write_fd, b'+' * self.jobs)
+
+  def acquire(self):
+    """Blocks for a job slot for a make to start in; returns the token to
+    give release() once it's done."""
+    return os.read(self.read_fd, 1)
+
+  def release(self, token):
+    os.write(self.write_fd, token)
+
+  def env(self, base):
+    env = dict(base)
+    # make 4.2+ call this --jobserver-auth but still accept the older name
+    env['MAKEFLAGS'] = (env.get('MAKEFLAGS', '') + ' -j --jobserver-fds={},{}'.format(self.read_fd, self.write_fd)).strip()
+    return env
+
+  def pass_fds(self):
+    return (self.read_fd, self.write_fd)
+
+  def close(self):
+    os.close(self.read_fd)
+    os.close(self.write_fd)
+
+
+class PristineSources(object):
+  """PristineSources holds each source tarball extracted once, by its sha256.
+
+  Extraction streams the (compressed) tarball straight through tarfile, so
+  there's no decompressed copy on disk, into <root>/.extract.* and renames the
+  result to <root>/<sha256>; two boxes sharing the root race harmlessly.  The
+  tree is made read-only, and builds get a hardlink farm of its files via
+  checkout(); but as root, read-only doesn't stop a write, so then (and for
+  files builds are known to rewrite in place) each file is a private copy:
+  a reflink where the filesystem can, so still sharing the blocks.  A
+  manifest of sizes and mtimes lets checkout() notice a file changed all the
+  same, in which case the tree is extracted again.
+  """
+
+  # msgmerge --update, makeinfo and stamp rules write these through whatever
+  # is there
+  REWRITTEN = ('*.po', '*.pot', '*.gmo', '*.info', '*.info-[0-9]*', 'stamp-*')
+
+  def __init__(self, root):
+    self.root = root
+    os.makedirs(self.root, exist_ok=True)
+
+  def tree(self, tarball, sha256, expected_dirname):
+    """Returns the pristine directory expected_dirname from tarball."""
+    top = os.path.join(self.root, sha256)
+    src = os.path.join(top, expected_dirname)
+    if os.path.isfile(os.path.join(top, PRISTINE_MANIFEST_FN)) and os.path.isdir(src):
+      return src
+    if os.path.exists(top):
+      self.discard(sha256)
+    import tarfile
+    tmp = tempfile.mkdtemp(dir=self.root, prefix='.extract.')
+    try:
+      with open(tarball, 'rb') as fh, tarfile.open(fileobj=fh, mode='r|*') as tf:
+        kw = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        tf.extractall(tmp, members=self._checked_members(tf, tarball), **kw)
+      if not os.path.isdir(os.path.join(tmp, expected_dirname)):
+        raise Error('Missing expected dir {!r} from {!r}'.format(expected_dirname, tarball))
+      _atomic_write_json(os.path.join(tmp, PRISTINE_MANIFEST_FN), self._manifest(tmp))
+      self._set_writable(tmp, False)
+      try:
+        os.rename(tmp, top)
+      except OSError:
+        if not os.path.isdir(top):
+          raise
+        self._remove(tmp)  # someone else got there first
+    except:
+      if os.path.exists(tmp):
+        self._remove(tmp)
+      raise
+    return src
+
+  @staticmethod
+  def _checked_members(tf, tarball):
+    for member in tf:
+      name = os.path.normpath(member.name)
+      if os.path.isabs(name) or name == '..' or name.startswith('..' + os.path.sep):
+        raise Error('Unsafe path {!r} in {!r}'.format(member.name, tarball))
+      if member.issym() or member.islnk():
+        target = member.linkname
+        if member.issym():
+          target = os.path.join(os.path.dirname(name), target)
+        target = os.path.normpath(target)
+        if os.path.isabs(target) or target == '..' or target.startswith('..' + os.path.sep):
+          raise Error('Unsafe link {!r} -> {!r} in {!r}'.format(member.name, member.linkname, tarball))
+      elif not (member.isfile() or member.isdir()):
+        print('\033[33mSkipping special file {!r} in {!r}\033[0m'.format(member.name, tarball),
+            file=sys.stderr, flush=True)
+        continue
+      yield member
+
+  @staticmethod
+  def _manifest(top):
+    manifest = {}
+    for dirpath, _, filenames in os.walk(top):
+      for fn in filenames:
+        path = os.path.join(dirpath, fn)
+        st = os.lstat(path)
+        if stat.S_ISREG(st.st_mode):
+          manifest[os.path.relpath(path, top)] = [st.st_size, st.st_mtime_ns]
+    return manifest
+
+  @staticmethod
+  def _set_writable(top, writable):
+    for dirpath, _, filenames in os.walk(top):
+      for path in [dirpath] + [os.path.join(dirpath, fn) for fn in filenames]:
+        mode = os.lstat(path).st_mode
+        if not stat.S_ISLNK(mode):
+          os.chmod(path, (mode | stat.S_IWUSR) if writable else (mode & ~0o222))
+
+  def _remove(self, top):
+    self._set_writable(top, True)
+    shutil.rmtree(top)
+
+  def discard(self, sha256):
+    top = os.path.join(self.root, sha256)
+    # Move aside first, so that nobody picks up a half-removed tree.
+    doomed = tempfile.mkdtemp(dir=self.root, prefix='.discard.')
+    os.chmod(doomed, 0o700)
+    try:
+      os.rename(top, os.path.join(doomed, 'tree'))
+    except FileNotFoundError:
+      pass
+    self._remove(doomed)
+
+  def checkout(self, src, dst):
+    """Populate dst with the tree at src; returns False if src was found
+    modified (and dst is then incomplete)."""
+    import fnmatch
+    top = os.path.dirname(src)
+    manifest = json.load(open(os.path.join(top, PRISTINE_MANIFEST_FN)))
+    linking = os.geteuid() != 0
+    for dirpath, dirnames, filenames in os.walk(src):
+      outdir = os.path.join(dst, os.path.relpath(dirpath, src))
+      os.makedirs(outdir, exist_ok=True)
+      for fn in dirnames + filenames:
+        path = os.path.join(dirpath, fn)
+        out = os.path.join(outdir, fn)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+          os.symlink(os.readlink(path), out)
+        elif stat.S_ISDIR(st.st_mode):
+          continue
+        else:
+          if manifest.get(os.path.relpath(path, top)) != [st.st_size, st.st_mtime_ns]:
+            return False
+          if linking and not any(fnmatch.fnmatchcase(fn, pattern) for pattern in self.REWRITTEN):
+            try:
+              os.link(path, out)
+              continue
+            except OSError:
+              linking = False  # eg, EXDEV: pristine root is another mount
+          _reflink_or_copy(path, out)
+          os.chmod(out, st.st_mode | stat.S_IWUSR)
+      shutil.copystat(dirpath, outdir)
+      os.chmod(outdir, os.lstat(dirpath).st_mode | stat.S_IWUSR)
+    return True
+
+  def size(self, tarball, sha256):
+    """Bytes of files in the pristine tree of tarball, from its manifest; or,
+    if it isn't extracted, a guess from the size of the tarball (extracting
+    it just to find out would be a waste)."""
+    try:
+      manifest = json.load(open(os.path.join(self.root, sha256, PRISTINE_MANIFEST_FN)))
+    except (OSError, ValueError):
+      return 4 * os.path.getsize(tarball)
+    return sum(size for size, _ in manifest.values())
+
+
+def _reflink_or_copy(src, dst):
+  """Copy src to dst, times and all; sharing the blocks, on a filesystem
+  which can (btrfs, xfs), until either is written."""
+  import fcntl
+  with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+    try:
+      fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    except OSError:
+      shutil.copyfileobj(fin, fout, 1 << 20)
+  shutil.copystat(src, dst)
+
+
+def _tree_bytes(top):
+  """Bytes of the files under top, counting files hardlinked together once."""
+  total = 0
+  seen = set()
+  for dirpath, _, filenames in os.walk(top):
+    for fn in filenames:
+      try:
+        st = os.lstat(os.path.join(dirpath, fn))
+      except OSError:
+        continue
+      if st.st_nlink > 1:
+        if (st.st_dev, st.st_ino) in seen:
+          continue
+        seen.add((st.st_dev, st.st_ino))
+      total += st.st_size
+  return total
+
+
+class ScratchSpace(object):
+  """ScratchSpace puts build trees on a RAM-backed filesystem, up to a cap.
+
+  A tree goes under root if the space in use there, plus what is expected of
+  the trees still being built, leaves room within the cap for what this one
+  is expected to need.  Otherwise the trees of finished (packaged) products
+  are removed, least recently finished first, to make room, and evicted is
+  called with the product's name; failing that, place() returns None and the
+  tree goes on disk instead.
+
+  The trees of a product still building are never removed; nor, so that
+  they can be looked into, are those of a failed build.
+  """
+
+  def __init__(self, root, cap, evicted=lambda product_name: None):
+    self.root = os.path.abspath(root)
+    os.makedirs(self.root, exist_ok=True)
+    if not cap:
+      st = os.statvfs(self.root)
+      cap = st.f_blocks * st.f_frsize * 3 // 4
+    self.cap = cap
+    self._evicted = evicted
+    self._lock = threading.Lock()
+    self._trees = collections.defaultdict(list)
+    self._finished = collections.OrderedDict()  # least recently finished first
+    self._growing = {}
+    self.stats = {'placed': 0, 'spilled': 0, 'evicted': 0, 'evicted_bytes': 0}
+
+  def contains(self, path):
+    return os.path.commonpath([self.root, os.path.abspath(path)]) == self.root
+
+  def _used(self):
+    st = os.statvfs(self.root)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+  def place(self, product_name, expect):
+    """Returns root if a tree of about expect bytes fits, else None."""
+    with self._lock:
+      self._finished.pop(product_name, None)
+      while self._used() + sum(self._growing.values()) + expect > self.cap:
+        if not self._finished:
+          self.stats['spilled'] += 1
+          return None
+        victim, _ = self._finished.popitem(last=False)
+        self._evict(victim)
+      self._growing[product_name] = self._growing.get(product_name, 0) + expect
+      self.stats['placed'] += 1
+      return self.root
+
+  def track(self, product_name, paths):
+    """Note paths (those of them under root) as trees of product_name."""
+    with self._lock:
+      self._trees[product_name].extend(p for p in paths if self.contains(p))
+
+  def finished(self, product_name):
+    """The product is packaged: its trees may be removed to make room."""
+    with self._lock:
+      self._growing.pop(product_name, None)
+      if self._trees.get(product_name):
+        self._finished[product_name] = None
+        self._finished.move_to_end(product_name)
+
+  def _evict(self, product_name):
+    for path in self._trees.pop(product_name, []):
+      if os.path.isdir(path):
+        size = _tree_bytes(path)
+        shutil.rmtree(path)
+        self.stats['evicted'] += 1
+        self.stats['evicted_bytes'] += size
+    self._evicted(product_name)
+    print('\033[38;5;49mRemoved trees of {} from tmpfs, to make room\033[0m'.format(product_name), flush=True)
+
+  def sweep(self):
+    """Remove whatever under root isn't a tracked tree: left from builds
+    with other inputs, or from before a crash."""
+    with self._lock:
+      keep = set(p for paths in self._trees.values() for p in paths)
+      for fn in os.listdir(self.root):
+        path = os.path.join(self.root, fn)
+        if path in keep:
+          continue
+        if os.path.isdir(path) and not os.path.islink(path):
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _toolchain_fingerprint(cc, compiler_cache):
+  """Hash of what autoconf results depend upon, beyond the configure inputs:
+  the compiler, the C library, the OS release and the architecture."""
+  import platform
+  argv = shlex.split(cc)
+  if argv and os.path.basename(argv[0]) == os.path.basename(compiler_cache):
+    argv = argv[1:]
+  parts = [platform.machine(), list(platform.libc_ver()), cc]
+  for flags in (['--version'], ['-dumpmachine']):
+    try:
+      parts.append(subprocess.check_output(argv + flags,
+          stderr=subprocess.STDOUT, stdin=open(os.devnull, 'r'), universal_newlines=True))
+    except (OSError, subprocess.CalledProcessError):
+      parts.append(None)
+  try:
+    compiler = shutil.which(argv[0]) if argv else None
+    st = os.stat(os.path.realpath(compiler)) if compiler else None
+    parts.append([st.st_size, st.st_mtime] if st else None)
+  except OSError:
+    parts.append(None)
+  try:
+    parts.append(open('/etc/os-release').read())
+  except OSError:
+    parts.append(None)
+  return _hash_json(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _abi_fingerprint(cc, compiler_cache, os_deps):
+  """Returns (hash, parts) of what a built tree depends upon, beyond its own
+  inputs, for it to be used on another box: the compiler, the C library, the
+  architecture and the versions of the OS packages which products need.
+
+  Unlike _toolchain_fingerprint, the OS release is left out: boxes of
+  different releases with all of these in common share builds.
+  """
+  import platform
+  argv = shlex.split(cc)
+  if argv and os.path.basename(argv[0]) == os.path.basename(compiler_cache):
+    argv = argv[1:]
+  parts = {'arch': _deb_architecture(), 'libc': list(platform.libc_ver())}
+  for name, flags in (('compiler', ['--version']), ('target', ['-dumpmachine'])):
+    try:
+      parts[name] = subprocess.check_output(argv + flags,
+          stderr=subprocess.STDOUT, stdin=open(os.devnull, 'r'), universal_newlines=True).splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+      parts[name] = None
+  parts['os_deps'] = {name: None for name in os_deps}
+  if os_deps:
+    try:
+      out = subprocess.check_output(['dpkg-query', '-W', '-f', '${Package} ${Version}\\n'] + list(os_deps),
+          stderr=subprocess.DEVNULL, stdin=open(os.devnull, 'r'), universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+      out = e.output  # some not installed; still lists the rest
+    except OSError:
+      out = ''
+    for line in out.splitlines():
+      name, _, version = line.partition(' ')
+      if name in parts['os_deps'] and version:
+        parts['os_deps'][name] = version
+  return _hash_json(parts), parts
+
+
+def _link_tree(src, dst):
+  """Populate dst with the tree at src: hardlinks where possible, else
+  copies, keeping files which are hardlinked together in src so in dst."""
+  copied = {}
+  linking = True
+  for dirpath, dirnames, filenames in os.walk(src):
+    outdir = os.path.join(dst, os.path.relpath(dirpath, src))
+    os.makedirs(outdir, exist_ok=True)
+    for fn in dirnames + filenames:
+      path = os.path.join(dirpath, fn)
+      out = os.path.join(outdir, fn)
+      st = os.lstat(path)
+      if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(path), out)
+      elif stat.S_ISDIR(st.st_mode):
+        continue
+      elif (st.st_dev, st.st_ino) in copied:
+        os.link(copied[(st.st_dev, st.st_ino)], out)
+      else:
+        if linking:
+          try:
+            os.link(path, out)
+            continue
+          except OSError:
+            linking = False  # eg, EXDEV
+        shutil.copy2(path, out)
+        if st.st_nlink > 1:
+          copied[(st.st_dev, st.st_ino)] = out
+    shutil.copystat(dirpath, outdir)
+
+
+class ArtifactStore(object):
+  """ArtifactStore shares what boxes build with the others of the same ABI
+  (see _abi_fingerprint).
+
+  Layout: <root>/<abi>/trees/<kk>/<tree key>/ holds a product's installed
+  tree, ready to package (tree/, and debug/ for a -dbg package), with an
+  entry.json; <root>/<abi>/packages/ is a BuildCache of the packages made
+  from them.  A box with the same input key for a product installs that
+  package as it is; one with the same tree key but, say, a different package
+  version, need only package the tree.
+  """
+
+  def __init__(self, root, abi, abi_parts, boxname):
+    self.root = os.path.join(root, abi[:32])
+    self.boxname = boxname
+    os.makedirs(self.root, exist_ok=True)
+    if not os.path.exists(os.path.join(self.root, 'abi.json')):
+      _atomic_write_json(os.path.join(self.root, 'abi.json'), abi_parts)
+    self.packages = BuildCache(os.path.join(self.root, 'packages'))
+
+  def _tree_dir(self, tree_key):
+    return os.path.join(self.root, 'trees', tree_key[:2], tree_key)
+
+  def tree_entry(self, tree_key):
+    """Returns what was recorded with the tree for tree_key, or None."""
+    try:
+      return json.load(open(os.path.join(self._tree_dir(tree_key), 'entry.json')))
+    except (OSError, ValueError):
+      return None
+
+  def tree_bytes(self, tree_key, entry):
+    """Bytes of files in the tree (and debug tree) for tree_key: as recorded
+    in its entry, or counted for entries from before that was."""
+    if entry.get('bytes') is not None:
+      return entry['bytes']
+    return sum(_tree_bytes(os.path.join(self._tree_dir(tree_key), d)) for d in ('tree', 'debug'))
+
+  def link_tree(self, tree_key, dst, debug_dst):
+    _link_tree(os.path.join(self._tree_dir(tree_key), 'tree'), dst)
+    if os.path.isdir(os.path.join(self._tree_dir(tree_key), 'debug')):
+      _link_tree(os.path.join(self._tree_dir(tree_key), 'debug'), debug_dst)
+
+  def put_tree(self, tree_key, product_name, tree, debug_tree, check=None):
+    entry = self.tree_entry(tree_key)
+    if entry is not None:
+      if entry['check'] is None and check is not None:
+        # built untested elsewhere; tested here
+        entry['check'] = check
+        _atomic_write_json(os.path.join(self._tree_dir(tree_key), 'entry.json'), entry)
+      return
+    parent = os.path.dirname(self._tree_dir(tree_key))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.incoming.')
+    try:
+      _link_tree(tree, os.path.join(tmp, 'tree'))
+      if os.path.isdir(debug_tree):
+        _link_tree(debug_tree, os.path.join(tmp, 'debug'))
+      _atomic_write_json(os.path.join(tmp, 'entry.json'), {
+        'product': product_name,
+        'box': self.boxname,
+        'check': check,
+        'bytes': _tree_bytes(os.path.join(tmp, 'tree')) + _tree_bytes(os.path.join(tmp, 'debug')),
+        'stored': datetime.datetime.now().isoformat(),
+        })
+      try:
+        os.rename(tmp, self._tree_dir(tree_key))
+      except OSError:
+        if not os.path.isdir(self._tree_dir(tree_key)):
+          raise
+        shutil.rmtree(tmp)  # another box got there first
+    except:
+      if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+      raise
+
+
+class ConfigureCache(object):
+  """ConfigureCache shares autoconf cache files between configure runs.
+
+  Each configure gets a private copy of the shared file (so concurrent
+  configures never see each other's partial writes) and what it learned is
+  merged back afterwards, under a lock.  Files are keyed by the caller;
+  anything in the key changing just means starting a new file.
+  """
+
+  _ENTRY_RE = re.compile(r'^(?:test "\$\{|: \$\{)?(\w+_cv_\w+)[=+]')
+
+  def __init__(self, root):
+    self.root = root
+    os.makedirs(self.root, exist_ok=True)
+    self._lock = threading.Lock()
+
+  def _path(self, key):
+    return os.path.join(self.root, key + '.cache')
+
+  @classmethod
+  def _entries(cls, path):
+    entries = collections.OrderedDict()
+    name = None
+    try:
+      fh = open(path)
+    except FileNotFoundError:
+      return entries
+    with fh:
+      for line in fh:
+        m = cls._ENTRY_RE.match(line)
+        if m:
+          name = m.group(1)
+          entries[name] = line
+        elif name is not None and not line.startswith('#'):
+          entries[name] += line  # a quoted value spanning lines
+    return entries
+
+  def checkout(self, key, dst):
+    """Copies the shared cache file for key to dst; returns how many results it held."""
+    with self._lock:
+      entries = self._entries(self._path(key))
+    with open(dst, 'w') as fh:
+      fh.writelines(entries.values())
+    return len(entries)
+
+  def merge(self, key, src):
+    """Merges the results in src into the shared file; returns how many were new."""
+    learned = self._entries(src)
+    with self._lock:
+      entries = self._entries(self._path(key))
+      new = sum(1 for k in learned if k not in entries)
+      entries.update(learned)
+      fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp.')
+      _as_created(fd)
+      with os.fdopen(fd, 'w') as fh:
+        print('# shared autoconf cache, see vscripts/deps.py ConfigureCache', file=fh)
+        fh.writelines(entries[k] for k in sorted(entries))
+      os.replace(tmp, self._path(key))
+    return new
+
+
+class DebWriter(object):
+  """DebWriter makes a .deb straight from an installed tree, as fpm -s dir would.
+
+  The tree is walked once to checksum and size the files (the control member
+  needs md5sums and Installed-Size, and must come first), then data.tar is
+  streamed from the tree through the compressor into the ar archive; its ar
+  size field is filled in afterwards.  Files are owned by root; hardlinks in
+  the tree stay hardlinks.
+  """
+
+  # 'name', 'name >= 1.0' or 'name (>= 1.0)'
+  _DEPENDENCY_RE = re.compile(r'^\s*(?P<name>[^\s()<>=]+)\s*'
+                              r'(?:\(\s*(?P<op>[<>=]+)\s*(?P<version>[^\s()]+)\s*\)|(?P<bare_op>[<>=]+)\s*(?P<bare_version>[^\s()]+))?\s*$')
+
+  def __init__(self, tree, topdir, exclude=(), compression='xz'):
+    self.tree = tree
+    self.topdir = topdir
+    self.exclude = set(exclude)
+    self.compression = compression
+    self.fields = collections.OrderedDict()
+    self.depends = []
+    self._entries = None
+
+  @staticmethod
+  def deb_dependency(dep):
+    """'name_x >= 1.0 | other' as fpm -d would write it: 'name-x (>= 1.0) | other'.
+
+    Constraints already written the Debian way, 'name (>= 1.0)', as os-deps
+    may be, are passed through.
+    """
+    alternatives = []
+    for alt in dep.split('|'):
+      m = DebWriter._DEPENDENCY_RE.match(alt)
+      if m is None:
+        raise Error('unable to parse dependency {!r}'.format(dep))
+      name = m.group('name').replace('_', '-')
+      op, version = m.group('op') or m.group('bare_op'), m.group('version') or m.group('bare_version')
+      if op:
+        name += ' ({} {})'.format(op, version)
+      alternatives.append(name)
+    return ' | '.join(alternatives)
+
+  def _scan(self):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(self.tree, self.topdir)):
+      dirnames.sort()
+      rel = os.path.relpath(dirpath, self.tree)
+      entries.append((rel, dirpath, os.lstat(dirpath), None))
+      for fn in sorted(filenames) + sorted(d for d in dirnames if os.path.islink(os.path.join(dirpath, d))):
+        arcname = os.path.join(rel, fn)
+        if arcname in self.exclude:
+          continue
+        path = os.path.join(dirpath, fn)
+        st = os.lstat(path)
+        md5 = None
+        if stat.S_ISREG(st.st_mode):
+          h = hashlib.md5()
+          with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(FETCH_CHUNK), b''):
+              h.update(chunk)
+          md5 = h.hexdigest()
+        entries.append((arcname, path, st, md5))
+    return entries
+
+  def _tarinfo(self, arcname, path, st, seen):
+    import tarfile
+    ti = tarfile.TarInfo('./' + arcname)
+    ti.mode = stat.S_IMODE(st.st_mode)
+    ti.mtime = int(st.st_mtime)
+    ti.uid = ti.gid = 0
+    ti.uname = ti.gname = 'root'
+    if stat.S_ISDIR(st.st_mode):
+      ti.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+      ti.type = tarfile.SYMTYPE
+      ti.linkname = os.readlink(path)
+    elif (st.st_dev, st.st_ino) in seen:
+      ti.type = tarfile.LNKTYPE
+      ti.linkname = seen[(st.st_dev, st.st_ino)]
+    elif stat.S_ISREG(st.st_mode):
+      ti.size = st.st_size
+      if st.st_nlink > 1:
+        seen[(st.st_dev, st.st_ino)] = ti.name
+    else:
+      raise Error('Cannot package special file {!r}'.format(path))
+    return ti
+
+  def installed_size(self):
+    # as dpkg-gencontrol counts it: KiB per file (hardlinks once), rounded up, 1 per dir/link
+    total = 0
+    inodes = set()
+    for _, _, st, md5 in self._entries:
+      if md5 and (st.st_dev, st.st_ino) not in inodes:
+        inodes.add((st.st_dev, st.st_ino))
+        total += max(1, -(-st.st_size // 1024))
+      elif not md5:
+        total += 1
+    return total
+
+  def _control_tar(self):
+    import tarfile
+    control = ''.join('{}: {}\n'.format(k, v) for k, v in self.fields.items() if v != '')
+    md5sums = ''.join('{}  {}\n'.format(md5, arcname) for arcname, _, _, md5 in self._entries if md5)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz', format=tarfile.GNU_FORMAT) as tf:
+      ti = tarfile.TarInfo('./')
+      ti.type, ti.mode, ti.mtime = tarfile.DIRTYPE, 0o755, int(time.time())
+      tf.addfile(ti)
+      for name, text in (('control', control), ('md5sums', md5sums)):
+        data = text.encode('utf-8')
+        ti = tarfile.TarInfo('./' + name)
+        ti.size, ti.mode, ti.mtime = len(data), 0o644, int(time.time())
+        tf.addfile(ti, io.BytesIO(data))
+    return buf.getvalue()
+
+  @staticmethod
+  def _ar_header(name, size):
+    return '{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n'.format(
+        name, int(time.time()), 0, 0, 100644, size).encode('ascii')
+
+  def _ar_member(self, out, name, data):
+    out.write(self._ar_header(name, len(data)))
+    out.write(data)
+    if len(data) % 2:
+      out.write(b'\n')
+
+  def _write_data_tar(self, fileobj):
+    import tarfile
+    seen = {}
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT) as tf:
+      root = tarfile.TarInfo('./')
+      root.type, root.mode, root.mtime = tarfile.DIRTYPE, 0o755, int(time.time())
+      root.uname = root.gname = 'root'
+      tf.addfile(root)
+      for arcname, path, st, _ in self._entries:
+        ti = self._tarinfo(arcname, path, st, seen)
+        if ti.type == tarfile.REGTYPE:
+          with open(path, 'rb') as fh:
+            tf.addfile(ti, fh)
+        else:
+          tf.addfile(ti)
+
+  def _stream_data(self, out):
+    """Writes the compressed data.tar to out, at its current position."""
+    suffix, cmdline = DEB_COMPRESSORS[self.compression]
+    out.flush()
+    try:
+      proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=out)
+    except OSError:
+      if self.compression != 'xz':
+        raise Error('No {!r} command to compress packages with'.format(cmdline[0]))
+      # single-threaded, but always there
+      import lzma
+      with lzma.LZMAFile(out, 'w', format=lzma.FORMAT_XZ) as xzf:
+        self._write_data_tar(xzf)
+      return suffix
+    try:
+      self._write_data_tar(proc.stdin)
+    finally:
+      proc.stdin.close()
+      if proc.wait() != 0:
+        raise Error('{!r} failed: exit {}'.format(cmdline[0], proc.returncode))
+    out.seek(0, os.SEEK_END)
+    return suffix
+
+  def write(self, outpath):
+    self._entries = self._scan()
+    self.fields['Installed-Size'] = str(self.installed_size())
+    if self.depends:
+      self.fields['Depends'] = ', '.join(self.deb_dependency(d) for d in self.depends)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outpath), prefix='.tmp.' + os.path.basename(outpath) + '.')
+    try:
+      with os.fdopen(fd, 'w+b') as out:
+        out.write(b'!<arch>\n')
+        self._ar_member(out, 'debian-binary', b'2.0\n')
+        self._ar_member(out, 'control.tar.gz', self._control_tar())
+        header_at = out.tell()
+        out.write(self._ar_header('data.tar', 0))  # name and size fixed up below
+        suffix = self._stream_data(out)
+        end = out.tell()
+        size = end - header_at - 60
+        if size % 2:
+          out.write(b'\n')
+        out.seek(header_at)
+        out.write('{:<16}'.format('data.tar' + suffix).encode('ascii'))
+        out.seek(header_at + 48)
+        out.write('{:<10}'.format(size).encode('ascii'))
+      os.chmod(tmp, 0o644)
+      os.replace(tmp, outpath)
+    except:
+      os.unlink(tmp)
+      raise
+    return outpath
+
+
+class TreeOptimizer(object):
+  """TreeOptimizer shrinks an installed tree before it is packaged.
+
+  strip() strips ELF objects and static archives, with the options dh_strip
+  uses; given a debug tree, the debug info of executables and shared objects
+  is first split out into <dir>/.debug/<name>.debug there, which gdb finds
+  from the debuglink left in the stripped file.  dedupe() hardlinks regular
+  files with identical content and mode together.  Each counts in .stats the
+  files it changed and the bytes that saved.
+  """
+
+  STRIP_COMMON = ['--remove-section=.comment', '--remove-section=.note']
+
+  def __init__(self, tree, topdir, exclude=(), run=subprocess.check_call):
+    self.tree = tree
+    self.topdir = topdir
+    self.exclude = set(exclude)
+    self.run = run
+    self.stats = {'stripped': 0, 'strip_saved': 0, 'split': 0, 'deduped': 0, 'dedupe_saved': 0}
+
+  def _files(self, tree=None):
+    """Yields (arcname, path, lstat) for the regular files under topdir."""
+    tree = tree or self.tree
+    for dirpath, dirnames, filenames in os.walk(os.path.join(tree, self.topdir)):
+      dirnames.sort()
+      for fn in sorted(filenames):
+        path = os.path.join(dirpath, fn)
+        arcname = os.path.relpath(path, tree)
+        st = os.lstat(path)
+        if arcname not in self.exclude and stat.S_ISREG(st.st_mode):
+          yield arcname, path, st
+
+  @staticmethod
+  def _elf_kind(path):
+    """'exec', 'shared', 'object' or 'archive', with whether it has
+    symbols or debug info to strip; or (None, False) for anything else."""
+    import struct
+    with open(path, 'rb') as fh:
+      head = fh.read(64)
+      if head.startswith(b'!<arch>\n'):
+        return 'archive', True
+      if len(head) < 52 or head[:4] != b'\x7fELF':
+        return None, False
+      wide = head[4] == 2
+      end = '<' if head[5] == 1 else '>'
+      e_type = struct.unpack_from(end + 'H', head, 16)[0]
+      if wide:
+        shoff, = struct.unpack_from(end + 'Q', head, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(end + 'HHH', head, 0x3a)
+        sh = end + 'I20xQQ'  # sh_name, sh_offset, sh_size
+      else:
+        shoff, = struct.unpack_from(end + 'I', head, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(end + 'HHH', head, 0x2e)
+        sh = end + 'I12xII'
+      kind = {1: 'object', 2: 'exec', 3: 'shared'}.get(e_type)
+      if kind is None or not shnum or shstrndx >= shnum:
+        return None, False
+      headers = []
+      for i in range(shnum):
+        fh.seek(shoff + i * shentsize)
+        headers.append(struct.unpack(sh, fh.read(struct.calcsize(sh))))
+      fh.seek(headers[shstrndx][1])
+      names = fh.read(headers[shstrndx][2])
+    strippable = False
+    for name_at, _, _ in headers:
+      name = names[name_at:names.find(b'\0', name_at)]
+      if name == b'.symtab' or name.startswith((b'.debug_', b'.zdebug_')):
+        strippable = True
+        break
+    if kind == 'shared' and '.so' not in os.path.basename(path):
+      kind = 'exec'  # a PIE executable
+    return kind, strippable
+
+  @staticmethod
+  def _relink(keep, path):
+    """Make path another name for keep (renaming over a name for the same
+    file does nothing, hence checking first)."""
+    if os.path.samefile(keep, path):
+      return
+    tmp = path + '.pt-link'
+    os.link(keep, tmp)
+    os.replace(tmp, path)
+
+  def strip(self, debug_tree=None):
+    """Strip everything strippable; see class docstring for debug_tree."""
+    import struct
+    done = {}
+    for arcname, path, st in list(self._files()):
+      inode = (st.st_dev, st.st_ino)
+      if inode in done:
+        # another name for a file we've stripped; if stripping replaced the
+        # file, point this name at the new one too
+        self._relink(done[inode], path)
+        continue
+      try:
+        kind, strippable = self._elf_kind(path)
+      except struct.error:
+        continue  # truncated; not something to strip
+      if not strippable:
+        continue
+      done[inode] = path
+      if kind in ('archive', 'object'):
+        args = ['--strip-debug', '--enable-deterministic-archives'] + self.STRIP_COMMON
+      elif kind == 'shared':
+        args = ['--strip-unneeded'] + self.STRIP_COMMON
+      else:
+        args = list(self.STRIP_COMMON)
+      if not st.st_mode & stat.S_IWUSR:
+        os.chmod(path, st.st_mode | stat.S_IWUSR)
+      if debug_tree is not None and kind in ('exec', 'shared'):
+        debug_dir = os.path.join(debug_tree, os.path.dirname(arcname), '.debug')
+        debug_file = os.path.join(debug_dir, os.path.basename(path) + '.debug')
+        os.makedirs(debug_dir, exist_ok=True)
+        self.run([OBJCOPY_CMD, '--only-keep-debug', '--compress-debug-sections', path, debug_file])
+        os.chmod(debug_file, 0o644)
+        self.run([STRIP_CMD] + args + [path])
+        self.run([OBJCOPY_CMD, '--add-gnu-debuglink=' + debug_file, path])
+        self.stats['split'] += 1
+      else:
+        self.run([STRIP_CMD] + args + [path])
+      os.chmod(path, stat.S_IMODE(st.st_mode))
+      self.stats['stripped'] += 1
+      self.stats['strip_saved'] += st.st_size - os.lstat(path).st_size
+
+  def dedupe(self, tree=None):
+    """Hardlink together files of identical content and mode."""
+    by_size = collections.defaultdict(dict)
+    for _, path, st in self._files(tree):
+      if st.st_size:
+        by_size[(st.st_size, st.st_mode)].setdefault((st.st_dev, st.st_ino), []).append(path)
+    for (size, _), inodes in by_size.items():
+      if len(inodes) < 2:
+        continue
+      by_content = collections.defaultdict(list)
+      for paths in inodes.values():
+        by_content[_sha256_file(paths[0])].append(paths)
+      for same in by_content.values():
+        # keep the inode with the most names already; link the rest to it
+        same.sort(key=len, reverse=True)
+        keep = same[0][0]
+        for paths in same[1:]:
+          for path in paths:
+            self._relink(keep, path)
+          self.stats['deduped'] += len(paths)
+          self.stats['dedupe_saved'] += size
+
+
+class PublishedRepo(object):
+  """PublishedRepo is a locally-readable apt repo which we publish to.
+
+  root is the directory holding dists/ and pool/; we read the Packages index
+  for one distribution/component/architecture.
+  """
+
+  def __init__(self, root, distribution, architecture, component='main'):
+    self.root = root
+    self.distribution = distribution
+    import gzip
+    import lzma
+    self.packages = collections.defaultdict(list)
+    index_dir = os.path.join(root, 'dists', distribution, component, 'binary-' + architecture)
+    for fn, opener in (('Packages', open), ('Packages.gz', gzip.open), ('Packages.xz', lzma.open)):
+      path = os.path.join(index_dir, fn)
+      if os.path.exists(path):
+        with opener(path, 'rt', encoding='utf-8') as fh:
+          self._parse(fh)
+        self.index_path = path
+        break
+    else:
+      raise Error('no Packages index found in {!r}'.format(index_dir))
+
+  def _parse(self, fh):
+    stanza = {}
+    field = None
+    for line in fh:
+      line = line.rstrip('\n')
+      if not line.strip():
+        if stanza:
+          self.packages[stanza.get('Package')].append(stanza)
+        stanza = {}
+        continue
+      if line[0] in ' \t' and field is not None:
+        stanza[field] += '\n' + line
+        continue
+      field, value = line.split(':', 1)
+      stanza[field] = value.strip()
+    if stanza:
+      self.packages[stanza.get('Package')].append(stanza)
+
+  def find(self, package, version):
+    for stanza in self.packages.get(package, []):
+      if stanza.get('Version') == version:
+        return stanza
+    return None
+
+  def path_for(self, stanza):
+    """Returns the local path of the package file for a stanza, verified."""
+    path = os.path.join(self.root, stanza['Filename'])
+    if 'SHA256' in stanza and _sha256_file(path) != stanza['SHA256']:
+      raise Error('checksum mismatch for published {!r}'.format(path))
+    return path
+
+
+class InputWatcher(object):
+  """InputWatcher waits for changes to some files, and to the entries of some
+  directories (not recursively: the patches and tarballs dirs are flat).
+
+  It uses inotify, via ctypes, where it can; otherwise (or given poll=N)
+  it compares stat results every N seconds.  Files are watched through their
+  directories, so that an editor replacing a file by renaming a new one over
+  it still counts.  Dotfiles and downloads in progress are ignored: the
+  tarballs dir holds our own caches.  So are changes which leave a file as
+  it was after we last wrote it (see written()), such as our own downloads.
+  """
+
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  _MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+  _EVENT_FORMAT = 'iIII'
+
+  def __init__(self, files, dirs, poll=0):
+    self.files = set(os.path.abspath(f) for f in files)
+    self.dirs = set(os.path.abspath(d) for d in dirs)
+    self.poll = poll
+    self._fd = None
+    self._wds = {}
+    self._ours = {}
+    if not poll:
+      self._fd = self._inotify()
+    if self._fd is None:
+      self.poll = poll or WATCH_POLL
+      self._snapshot = self._stat_all()
+    self.method = 'inotify' if self._fd is not None else 'polling every {}s'.format(self.poll)
+
+  def _inotify(self):
+    import ctypes
+    import ctypes.util
+    import struct
+    self._event = struct.Struct(self._EVENT_FORMAT)
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+      return None
+    if fd < 0:
+      return None
+    for d in sorted(self.dirs | set(os.path.dirname(f) for f in self.files)):
+      wd = libc.inotify_add_watch(fd, os.fsencode(d), self._MASK)
+      if wd < 0:
+        # eg, ENOSPC: out of watches
+        os.close(fd)
+        return None
+      self._wds[wd] = d
+    return fd
+
+  def _wanted(self, path):
+    fn = os.path.basename(path)
+    if path in self.files:
+      return True
+    return os.path.dirname(path) in self.dirs and not fn.startswith('.') and not fn.endswith('.part') and fn != PLAN_FN
+
+  def _stat_all(self):
+    snapshot = {}
+    for d in self.dirs:
+      try:
+        names = os.listdir(d)
+      except OSError:
+        continue
+      for fn in names:
+        snapshot[os.path.join(d, fn)] = None
+    for path in list(snapshot) + list(self.files):
+      if not self._wanted(path):
+        snapshot.pop(path, None)
+        continue
+      snapshot[path] = self._stat(path)
+    return snapshot
+
+  @staticmethod
+  def _stat(path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+  def written(self, paths):
+    """Note paths as just written by us, so that wait() doesn't report them
+    unless they change again."""
+    for path in paths:
+      path = os.path.abspath(path)
+      self._ours[path] = self._stat(path)
+
+  def _theirs(self, changed):
+    """Of changed, those not left as we wrote them."""
+    return set(p for p in changed if p not in self._ours or self._stat(p) != self._ours[p])
+
+  def _read_changes(self, timeout):
+    """Changed paths seen within timeout seconds (None: wait for some)."""
+    if self._fd is None:
+      time.sleep(self.poll if timeout is None else min(timeout, self.poll))
+      now = self._stat_all()
+      changed = set(p for p in set(now) | set(self._snapshot) if now.get(p) != self._snapshot.get(p))
+      self._snapshot = now
+      return changed
+    import select
+    ready, _, _ = select.select([self._fd], [], [], timeout)
+    if not ready:
+      return set()
+    buf = os.read(self._fd, 65536)
+    changed = set()
+    offset = 0
+    while offset < len(buf):
+      wd, mask, _, length = self._event.unpack_from(buf, offset)
+      name = buf[offset + self._event.size:offset + self._event.size + length].rstrip(b'\0')
+      offset += self._event.size + length
+      if mask & self.IN_Q_OVERFLOW:
+        changed.update(self.files | self.dirs)
+      elif wd in self._wds:
+        path = os.path.join(self._wds[wd], os.fsdecode(name))
+        if self._wanted(path):
+          changed.add(path)
+    return changed
+
+  def wait(self):
+    """Returns the paths changed, once some have and things have settled."""
+    changed = set()
+    while not changed:
+      changed = self._theirs(self._read_changes(None))
+    while True:
+      more = self._theirs(self._read_changes(WATCH_SETTLE))
+      if not more:
+        return sorted(changed)
+      changed |= more
+
+
 class BuildPlan(object):
   """BuildPlan represents our state of knowledge around what needs to happen."""
 
@@ -100,30 +1881,52 @@ class BuildPlan(object):
     # FIXME: relies upon being run in clean OS images!
     self.installed = set()
     self._fetched = []
+    # Package installs and removals change shared OS state, so even when
+    # building several products at once, only one thread touches dpkg.
+    self._install_lock = threading.Lock()
+    self.failed = {}
+    self.skipped = set()
+    self.input_keys = {}
+    self.build_keys = {}
+    self.tree_keys = {}
+    self.inputs = {}
+    # auto-bumped package versions, and packages reused from the published repo
+    self.pkg_version_bumps = {}
+    self.published = {}
+    self._file_sha256 = {}
+    base_dir = os.path.expanduser(options.base_dir)
+    self.hashes = InputHashes(os.path.join(base_dir, INPUT_HASHES_FN))
+    self.stages = StageManifest(os.path.join(base_dir, STAGE_STATE_FN))
+    self.verified = {}
+    self._stage_local = threading.local()
+    self._report_lock = threading.Lock()
+    self.stage_records = []
+    self._report_fn = None
+    self.jobserver = None
+    self._compiler_cache_before = None
+    self.pristine = None
+    self.configure_cache = None
+    self.scratch = None
+    self._workdirs = {}
+    self.artifacts = None
+    self.prebuilt = {}
+    self.planned_params = {}
+    self.stats = None
+    self.estimates = {}
+    self.priority = {}
+    self.mem_budget = options.mem_budget
+    self._resource_waits = set()
 
   def _get_depends(self, fn):
-    p = subprocess.Popen(['tsort', fn],
-         stdout=subprocess.PIPE, stderr=sys.stderr, stdin=open(os.devnull, 'r'),
-         universal_newlines=True)
-    self.ordered = list(map(lambda s: s.strip(), p.stdout.readlines()))
-
-    self.needs = collections.defaultdict(set)
-    self.direct_needs = {}
+    self.graph = DependencyGraph.from_file(fn)
+    self.ordered = list(self.graph.order)
+    self.direct_needs = dict(self.graph.direct_needs)
     self.direct_needs_version_constraints = {}
-    for l in open(fn):
-      before, after = l.strip().split()
-      if before == after:
-        continue
-      self.needs[after].add(before)
-    for k in self.ordered:
-      self.direct_needs[k] = sorted(self.needs[k])
-      for dep in list(self.needs[k]):
-        self.needs[k].update(self.needs[dep])
-
+    self.needs = collections.defaultdict(set)
     self.invalidates = collections.defaultdict(set)
-    for k in self.needs.keys():
-      for rev in self.needs[k]:
-        self.invalidates[rev].add(k)
+    for k in self.ordered:
+      self.needs[k] = self.graph.needs(k)
+      self.invalidates[k] = self.graph.invalidates(k)
 
   def _get_mutexes(self, fn):
     # partitions via sets where each member is a dict key pointing to the set
@@ -136,6 +1939,34 @@ class BuildPlan(object):
       for member in not_together:
         self.mutually_excluded[member] = not_together
 
+  def fetched(self):
+    """Paths downloaded since the plan was made, or last reloaded."""
+    return list(self._fetched)
+
+  def reload(self):
+    """For --watch: read the dependencies and configs again, and fetch and
+    verify whatever they now call for.  File hashes (while the files are
+    unchanged), signature checks, stage state and what's installed carry
+    over; everything about the last build is forgotten."""
+    self._get_depends(self.options.dependencies_file)
+    self._get_mutexes(self.options.mutex_file)
+    self._file_sha256 = {}
+    self._fetched = []
+    self.failed = {}
+    self.skipped = set()
+    self.pkg_version_bumps = {}
+    self.published = {}
+    self.prebuilt = {}
+    self.planned_params = {}
+    self.stage_records = []
+    self._report_fn = None
+    self._workdirs = {}
+    self._resource_waits = set()
+    self.process_swdb()
+    self.process_versions_conf()
+    self.process_configures()
+    self.ensure_have_each()
+
   def process_swdb(self, fn=None):
     if fn is None:
       fn = self.options.swdb_file
@@ -184,6 +2015,8 @@ class BuildPlan(object):
           if pname not in self.products:
             raise Error('Unknown product to override: {!r}'.format(pname))
           self.products[pname].ver = self.other_versions['overrides'][pname]['build_version']
+          # swdb checksums are for the swdb version, not the one we override to
+          self.products[pname].sha1 = self.products[pname].sha2 = ''
         if 'depends' in self.other_versions['overrides'][pname]:
           self.direct_needs_version_constraints[pname] = self.other_versions['overrides'][pname]['depends']
 
@@ -195,36 +2028,131 @@ class BuildPlan(object):
       raise Error('Missing key "prefix" in {!r}'.format(cfn))
 
   def ensure_have_each(self, tardir=None):
+    """Make sure we have every tarball and signature, and that they verify.
+
+    Tarballs whose sha256 we know (from swdb, or a "sha256" key in the versions
+    file) are checked against it before we spend a gpg invocation on them;
+    anything missing is fetched concurrently.
+    """
     if tardir is None:
       tardir = self.options.tarballs_dir
+    wanted = []
     for product in self.ordered:
       if product in self.products:
-        self.ensure_swdb_product(self.products[product], tardir)
+        wanted.append(self.ensure_swdb_product(self.products[product], tardir))
+      else:
+        wanted.append(self.ensure_3rdparty_product(product, tardir))
+    to_fetch = []
+    for name, want_path, dl_src, sha256 in wanted:
+      print('\033[36m{}\033[0m'.format(name), flush=True)
+      if os.path.exists(want_path) and sha256 and self._sha256(want_path) != sha256:
+        print('\033[31mChecksum mismatch, refetching: \033[3m{}\033[0m'.format(want_path), flush=True)
+        os.unlink(want_path)
+        del self._file_sha256[want_path]
+      for ext in ('', '.sig'):
+        if not os.path.exists(want_path + ext):
+          to_fetch.append((dl_src + ext, want_path + ext, sha256 if not ext else None))
+    if to_fetch:
+      self._fetched.extend(Fetcher(self.options.fetch_jobs).fetch_many(to_fetch))
+    self.verify_signatures([(name, want_path) for name, want_path, _, _ in wanted])
+    self.hashes.save()
+
+  def _sha256(self, path):
+    # Tarballs get hashed for checksums, verification and input keys; once
+    # each, and not again on later runs unless they change.
+    if path not in self._file_sha256:
+      self._file_sha256[path] = self.hashes.sha256(path)
+    return self._file_sha256[path]
+
+  def _keyring_stat(self):
+    home = os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+    files = []
+    for fn in ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg'):
+      try:
+        st = os.stat(os.path.join(home, fn))
+      except FileNotFoundError:
+        continue
+      files.append([fn, st.st_size, st.st_mtime_ns, st.st_ino])
+    return [self.options.gpg, self.options.gnupg_trust_model, home, files]
+
+  def _keyring_id(self):
+    out = subprocess.check_output([self.options.gpg, '--batch', '--with-colons', '--fingerprint', '--list-keys'],
+        stderr=subprocess.DEVNULL, stdin=open(os.devnull, 'r'), universal_newlines=True)
+    fingerprints = set()
+    for l in out.splitlines():
+      if l.startswith('fpr:'):
+        fingerprints.add(l.split(':')[9])
+    return _hash_json([self.options.gpg, self.options.gnupg_trust_model, sorted(fingerprints)])
+
+  def verify_signatures(self, items):
+    """gpg --verify each (name, tarball), skipping those verified before.
+
+    Results are cached (see VerificationCache); the uncached are verified
+    concurrently, and any failure is raised once all have been tried.
+    """
+    if self.options.verify_cache:
+      cache_fn = self.options.verify_cache
+    else:
+      cache_fn = os.path.join(self.options.tarballs_dir, VERIFY_CACHE_FN)
+    cache = VerificationCache(cache_fn)
+    cache.use_keyring(self._keyring_stat(), self._keyring_id)
+    uncached = []
+    for name, want_path in items:
+      tarball_sha, sig_sha = self._sha256(want_path), self._sha256(want_path + '.sig')
+      result = cache.get(tarball_sha, sig_sha)
+      if result is not None:
+        print('\033[34mSignature already verified: \033[3m{}\033[0m  \033[34m[{}]\033[0m'.format(
+          name, result.get('signer', '?')), flush=True)
+        self.verified[name] = result
       else:
-        self.ensure_3rdparty_product(product, tardir)
+        uncached.append((name, want_path, tarball_sha, sig_sha))
+    import concurrent.futures
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.options.fetch_jobs)) as pool:
+      futures = {pool.submit(self.verify_signature, name, want_path): (name, tarball_sha, sig_sha)
+                 for name, want_path, tarball_sha, sig_sha in uncached}
+      for future in concurrent.futures.as_completed(futures):
+        name, tarball_sha, sig_sha = futures[future]
+        try:
+          result = future.result()
+        except Exception as e:
+          errors.append(e)
+          continue
+        cache.put(tarball_sha, sig_sha, result)
+        self.verified[name] = result
+    cache.save()
+    if errors:
+      raise errors[0]
 
   def ensure_swdb_product(self, product: Product, tardir):
+    """Returns (name, want_path, dl_src, sha256) for the product's tarball."""
     fn = '{0.filename_base}-{0.ver}.tar.bz2'.format(product)
     want_path = os.path.join(tardir, fn)
     dl_src = '{o.mirror}{slash}{p.filename_base}/{fn}'.format(
         o=self.options, p=product, fn=fn,
         slash='' if self.options.mirror.endswith('/') else '/')
 
-    self.check_and_download(product.name, want_path, dl_src)
     self.products[product.name].tarball = want_path
     self.products[product.name].dirname = '{0.filename_base}-{0.ver}'.format(product)
-
-  def check_and_download(self, name, want_path, dl_src):
-    print('\033[36m{}\033[0m'.format(name), flush=True)
-    for ext in ('', '.sig'):
-      path_name = want_path + ext
-      if not os.path.exists(path_name):
-        self.fetch_file(dl_src + ext, path_name)
-
-    subprocess.check_call([self.options.gpg, '--trust-model', self.options.gnupg_trust_model, '--verify', want_path + ext],
-        stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+    return product.name, want_path, dl_src, product.sha2
+
+  def verify_signature(self, name, want_path):
+    """Runs gpg --verify, returning a record of the good signature."""
+    cmd = subprocess.run([self.options.gpg, '--status-fd', '1', '--trust-model', self.options.gnupg_trust_model, '--verify', want_path + '.sig'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=open(os.devnull, 'r'),
+        universal_newlines=True)
+    # Several of these run at once; keep each one's output together.
+    print('\033[36m{}\033[0m\n{}'.format(name, cmd.stderr), end='', file=sys.stderr, flush=True)
+    if cmd.returncode != 0:
+      raise Error('gpg --verify failed for {!r}'.format(want_path))
+    result = {'verified': datetime.datetime.now().isoformat(), 'signer': ''}
+    for l in cmd.stdout.splitlines():
+      if l.startswith('[GNUPG:] VALIDSIG '):
+        result['signer'] = l.split()[2]
+    return result
 
   def ensure_3rdparty_product(self, product: Product, tardir):
+    """Returns (name, want_path, dl_src, sha256) for the product's tarball."""
     if product not in self.other_versions['products']:
       raise Error('no version configured in {o.versions_file} for {p}'.format(
         o=self.options, p=product))
@@ -236,76 +2164,813 @@ class BuildPlan(object):
         other=other, fn=fn,
         slash='' if other['urlbase'].endswith('/') else '/')
 
-    self.check_and_download(product, want_path, dl_src)
     p = Product()
     p.third_party = True
     p.name = p.filename_base = p.product = product
     p.ver = other['version']
+    p.sha2 = other.get('sha256', '')
     p.tarball = want_path
     p.dirname = other.get('dirname', '{p}-{other[version]}'.format(p=product, other=other))
     self.products[product] = p
-
-  def fetch_file(self, url, outpath):
-    print('\033[36;1mFetching <{}>\033[0m'.format(url), flush=True)
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    with open(outpath, 'wb') as fd:
-      for chunk in r.iter_content(chunk_size=4096):
-        fd.write(chunk)
-    self._fetched.append(outpath)
-
-  def build_each(self):
+    return product, want_path, dl_src, p.sha2
+
+  def _plan_inputs(self):
+    """Digests of the files a plan was made from, by role rather than path
+    (the paths differ between the host and the boxes)."""
+    inputs = {}
+    for role in ('dependencies_file', 'mutex_file', 'swdb_file', 'versions_file', 'configures_file', 'machines_file'):
+      fn = getattr(self.options, role)
+      inputs[role] = self._sha256(fn) if os.path.exists(fn) else None
+    if os.path.isdir(self.options.patches_dir):
+      for fn in sorted(os.listdir(self.options.patches_dir)):
+        inputs['patches/' + fn] = self._sha256(os.path.join(self.options.patches_dir, fn))
+    return inputs
+
+  def write_plan(self, fn=None):
+    """Freeze what we know, after fetching and verifying, for --run-inside.
+
+    The plan holds the resolved products with their tarball hashes, the
+    dependency graph and its closures, the configure params/env for every box
+    in the machines file, the signature verification results and digests of
+    the files it was made from; and a digest of all that.
+    """
+    if fn is None:
+      fn = self.options.plan_file or os.path.join(self.options.tarballs_dir, PLAN_FN)
+    try:
+      machines = json.load(open(self.options.machines_file))
+    except (OSError, ValueError):
+      machines = []
+    boxnames = sorted(set([m['name'] for m in machines if 'name' in m] + [self.options.boxname]))
+    products = {}
+    for name in self.ordered:
+      product = self.products[name].as_dict()
+      st = os.stat(product['tarball'])
+      product['tarball'] = os.path.basename(product['tarball'])
+      product['tarball_sha256'] = self._sha256(self.products[name].tarball)
+      product['tarball_stat'] = [st.st_size, st.st_mtime_ns]
+      products[name] = product
+    plan = {
+      'format': PLAN_FORMAT,
+      'created': datetime.datetime.now().isoformat(),
+      'inputs': self._plan_inputs(),
+      'order': self.ordered,
+      'direct_needs': self.direct_needs,
+      'needs': {k: sorted(v) for k, v in self.needs.items()},
+      'invalidates': {k: sorted(v) for k, v in self.invalidates.items()},
+      'mutually_excluded': {k: sorted(v) for k, v in self.mutually_excluded.items()},
+      'direct_needs_version_constraints': self.direct_needs_version_constraints,
+      'products': products,
+      'other_versions': self.other_versions,
+      'configures': self.configures,
+      'params': {box: {name: self._params_and_env(name, boxname=box) for name in self.ordered} for box in boxnames},
+      'verified': self.verified,
+      }
+    plan['digest'] = _hash_json(plan)
+    _atomic_write_json(fn, plan)
+    self.hashes.save()
+    print('\033[36mWrote build plan: \033[3m{}\033[0m  \033[36m[{}]\033[0m'.format(fn, plan['digest'][:16]), flush=True)
+    return fn
+
+  def load_plan(self, fn=None):
+    """Load a plan from write_plan, instead of processing swdb/versions/
+    configures and fetching/verifying.  Returns False, having loaded nothing,
+    if there's no plan or it doesn't match what's here now."""
+    if fn is None:
+      fn = self.options.plan_file or os.path.join(self.options.tarballs_dir, PLAN_FN)
+    def stale(why):
+      print('\033[33mNot using build plan {}: {}\033[0m'.format(fn, why), flush=True)
+      return False
+    try:
+      plan = json.load(open(fn))
+    except FileNotFoundError:
+      return stale('none made')
+    except (OSError, ValueError) as e:
+      return stale(e)
+    if plan.get('format') != PLAN_FORMAT:
+      return stale('format {!r}, want {!r}'.format(plan.get('format'), PLAN_FORMAT))
+    digest = plan.pop('digest', None)
+    if digest != _hash_json(plan):
+      return stale('digest mismatch, plan modified')
+    inputs = self._plan_inputs()
+    changed = sorted(k for k in set(inputs) | set(plan['inputs']) if inputs.get(k) != plan['inputs'].get(k))
+    if changed:
+      return stale('changed since: ' + ' '.join(changed))
+    if plan['order'] != self.ordered:
+      return stale('dependency order differs')
+    products = {}
+    file_sha256 = {}
+    for name, d in plan['products'].items():
+      p = Product()
+      for k in Product.__slots__:
+        setattr(p, k, d.get(k, ''))
+      p.tarball = os.path.join(self.options.tarballs_dir, d['tarball'])
+      try:
+        st = os.stat(p.tarball)
+      except OSError as e:
+        return stale(e)
+      if [st.st_size, st.st_mtime_ns] != d['tarball_stat']:
+        return stale('tarball changed: {}'.format(p.tarball))
+      file_sha256[p.tarball] = d['tarball_sha256']
+      products[name] = p
+    self.products = products
+    self._file_sha256.update(file_sha256)
+    self.needs.update({k: set(v) for k, v in plan['needs'].items()})
+    self.invalidates.update({k: set(v) for k, v in plan['invalidates'].items()})
+    self.direct_needs_version_constraints = plan['direct_needs_version_constraints']
+    self.other_versions = plan['other_versions']
+    self.configures = plan['configures']
+    self.planned_params = plan['params'].get(self.options.boxname, {})
+    self.verified = plan['verified']
+    print('\033[36mUsing build plan: \033[3m{}\033[0m  \033[36m[{}]\033[0m'.format(fn, digest[:16]), flush=True)
+    return True
+
+  def compute_input_keys(self):
+    """Hash everything which goes into each product's package.
+
+    The key covers the tarball content, the patches which will be applied, the
+    normalized configure params/env, fixups, packaging metadata, and the
+    versions and keys of everything in self.needs[product]; so a change to any
+    input changes the key of that product and all products downstream.
+
+    The build key is the same but leaves out package version numbers: it is
+    recorded in the packages we make, to recognize published packages which
+    were built from identical inputs, whatever version they ended up as.
+    """
+    if self.options.cache_dir:
+      cache_dir = self.options.cache_dir
+    else:
+      cache_dir = os.path.join(self.options.results_dir, CACHE_DIRNAME)
+    self.cache = BuildCache(cache_dir)
+    for product_name in self.ordered:
+      product = self.products[product_name]
+      params, envs = self._params_and_env(product_name)
+      pkg_conf = self.configures['packages'].get(product_name, {})
+      inputs = {
+        'product': product_name,
+        'version': product.ver,
+        'tarball_sha256': self._sha256(product.tarball),
+        'patches': {f: self._sha256(os.path.join(self.options.patches_dir, f)) for f in self._patch_files(product)},
+        'params': params,
+        'env': envs,
+        'fixups': self._normalize_list(pkg_conf.get('fixups', [])),
+        'optimize': self._optimize_settings(product_name),
+        'os_deps': pkg_conf.get('os-deps', {}).get(self.options.ostype, []),
+        'version_constraints': self.direct_needs_version_constraints.get(product_name, {}),
+        'packaging': [self.options.ostype, self.options.pkg_prefix, self.options.pkg_email, self.options.pkg_version_ext],
+        'needs': {dep: {
+            'version': self.products[dep].ver,
+            'build_key': self.build_keys[dep],
+          } for dep in self.needs[product_name]},
+        }
+      self.build_keys[product_name] = _hash_json(inputs)
+      # what the installed tree depends upon, for the artifact store
+      self.tree_keys[product_name] = _hash_json(dict(
+        {k: inputs[k] for k in ('product', 'version', 'tarball_sha256', 'patches', 'params', 'env', 'fixups', 'optimize')},
+        needs={dep: self.tree_keys[dep] for dep in self.needs[product_name]}))
+      inputs['pkg_version'] = self._pkg_full_version(product)
+      for dep in self.needs[product_name]:
+        inputs['needs'][dep]['pkg_version'] = self._pkg_full_version(self.products[dep])
+        inputs['needs'][dep]['key'] = self.input_keys[dep]
+      self.inputs[product_name] = inputs
+      self.input_keys[product_name] = _hash_json(inputs)
+    self.hashes.save()
+
+  def resolve_published(self, repo: PublishedRepo):
+    """Decide, per product, whether to reuse the published package.
+
+    A published package is reused when it carries our build key, or when it
+    predates build keys, has the version we would build and nothing it depends
+    upon is being rebuilt.  Otherwise we rebuild; if our version is already
+    taken in the repo, with the package version bumped past every published
+    one, and exact pins on it moved along (see _repin).  Everything in
+    self.invalidates for a rebuilt product is rebuilt too.
+    """
+    rebuild = set()
+    for product_name in self.ordered:
+      if self._repin(product_name):
+        # the pin is part of the build key, which we're about to look for
+        self.compute_input_keys()
+      product = self.products[product_name]
+      pkgname = self._pkg_name(product)
+      version = self._pkg_full_version(product)
+      candidates = repo.packages.get(pkgname, [])
+      if product_name not in rebuild:
+        for stanza in candidates:
+          if stanza.get(BUILD_KEY_FIELD) == self.build_keys[product_name]:
+            self._reuse_published(repo, product, stanza)
+            break
+        else:
+          stanza = repo.find(pkgname, version)
+          if stanza is not None and BUILD_KEY_FIELD not in stanza:
+            self._reuse_published(repo, product, stanza)
+        if product_name in self.published:
+          continue
+      rebuild.add(product_name)
+      rebuild.update(self.invalidates[product_name])
+      if repo.find(pkgname, version) is None:
+        print('\033[35m[{}] Rebuild: \033[1m{}\033[0m\033[35m {}\033[0m'.format(
+          self.options.boxname, product_name, version), flush=True)
+        continue
+      ours = re.compile(re.escape('{}-{}'.format(product.ver, self.options.pkg_version_ext)) + r'(\d+)$')
+      taken = [int(m.group(1)) for m in (ours.match(c.get('Version', '')) for c in candidates) if m]
+      self.pkg_version_bumps[product_name] = str(max(taken) + 1)
+      print('\033[35m[{}] Rebuild: \033[1m{}\033[0m\033[35m {} published already, bumped to {}\033[0m'.format(
+        self.options.boxname, product_name, version, self._pkg_full_version(product)), flush=True)
+    if self.pkg_version_bumps or self.published:
+      # versions of reused/bumped dependencies feed into the keys downstream
+      self.compute_input_keys()
+
+  def _repin(self, product_name):
+    """Pins of the product to an exact version ("= 1.8.7-pt6" in the versions
+    file) of a dependency whose package version we bumped move to the bumped
+    version.  Any other exact pin on a bumped dependency would make packages
+    which can't be installed together, so is an Error.  Returns whether any
+    pin moved."""
+    constraints = self.direct_needs_version_constraints.get(product_name, {})
+    repinned = dict(constraints)
+    for depname, constraint in constraints.items():
+      m = re.match(r'^\s*=\s*(\S+)\s*$', constraint)
+      if m is None or depname not in self.pkg_version_bumps:
+        continue
+      dep = self.products[depname]
+      have = self._pkg_full_version(dep)
+      if m.group(1) == have:
+        continue
+      if m.group(1) != self._pkg_full_version(dep, bumped=False):
+        raise Error('{} needs {} {}, but that is now {}; fix the pin in {}'.format(
+          product_name, depname, constraint.strip(), have, self.options.versions_file))
+      repinned[depname] = '= ' + have
+      print('\033[35m[{}] Repinned: \033[1m{}\033[0m\033[35m needs {} = {}\033[0m'.format(
+        self.options.boxname, product_name, depname, have), flush=True)
+    if repinned == constraints:
+      return False
+    self.direct_needs_version_constraints[product_name] = repinned
+    return True
+
+  def _reuse_published(self, repo, product, stanza):
+    self.published[product.name] = repo.path_for(stanza)
+    pkgver = stanza['Version'][len('{}-{}'.format(product.ver, self.options.pkg_version_ext)):]
+    if stanza['Version'] != self._pkg_full_version(product) and pkgver.isdigit():
+      self.pkg_version_bumps[product.name] = pkgver
+    print('\033[36m[{}] Published: \033[1m{}\033[0m\033[36m {}\033[0m'.format(
+      self.options.boxname, product.name, stanza['Version']), flush=True)
+
+  def report_stale(self):
+    """Report products whose inputs changed since the last run, and discard
+    their stale stage state, along with all of self.invalidates for them."""
+    changed = set(p for p in self.ordered if self.cache.last_keys.get(p) != self.input_keys[p])
+    # Keys embed those of dependencies, so a change shows up all the way
+    # downstream; report the products where it originates, and the closure.
+    origins = [p for p in self.ordered if p in changed and not (self.needs[p] & changed)]
+    stale = set(origins)
+    for product_name in origins:
+      stale.update(self.invalidates[product_name])
+    for product_name in self.ordered:
+      if product_name not in stale:
+        continue
+      if product_name in origins:
+        why = 'inputs changed'
+      else:
+        why = 'downstream of ' + ' '.join(p for p in origins if p in self.needs[product_name])
+      print('\033[35m[{}] Stale: \033[1m{}\033[0m\033[35m ({})\033[0m'.format(
+        self.options.boxname, product_name, why), flush=True)
+      self._discard_stale_stages(self.products[product_name])
+    return stale
+
+  def _discard_stale_stages(self, product: Product):
+    # The work tree itself is replaced by untar(); here we tidy up stages
+    # recorded against keys which no longer apply, and the DESTDIR tree.
+    discarded = self.stages.discard_stale(product.name, self.input_keys[product.name])
+    for stage in ('tmpinstall', 'shared-tree'):
+      tree = discarded.get(stage)
+      if tree and os.path.isabs(tree):
+        for path in (tree, self._debug_tree(tree)):
+          if os.path.isdir(path):
+            shutil.rmtree(path)
+
+  def nothing_to_do(self):
+    """True if every product is installed from a package made (or reused)
+    with the inputs it has now; in which case, says so.
+
+    This looks only at the stage state and the build cache, so that a rerun
+    with nothing changed starts no threads, jobservers, or commands.
+    """
+    for product_name in self.ordered:
+      key = self.input_keys[product_name]
+      if self.stages.get(product_name, key, 'install_pkg') is None:
+        return False
+      if self.cache.last_keys.get(product_name) != key:
+        return False
+      if product_name not in self.published and self.cache.lookup(key) is None:
+        return False
+    print('\033[32;1m[{}] Nothing to do:\033[0m\033[32m all {} products are built and installed\033[0m'.format(
+      self.options.boxname, len(self.ordered)), flush=True)
+    return True
+
+  def build_each(self, jobs=None):
+    """Build (or install already-built) products, in dependency order.
+
+    Products whose direct_needs are all handled are ready; ready products are
+    started longest-path-first (see plan_resources), up to `jobs` at a time and
+    as far as the memory and CPU they used last time fit within the budgets.
+    Two members of one mutually_excluded set are never in flight together.
+    A failure stops only
+    the products downstream of it (per self.invalidates); independent branches
+    carry on.  Failures are left in self.failed, the products abandoned because
+    of them in self.skipped.
+    """
+    if jobs is None:
+      jobs = self.options.jobs
+    jobs = max(1, jobs)
+    pending = list(self.ordered)
+    done = set()
+    running = {}
+    self._compiler_cache_before = self.compiler_cache_stats()
+    self.pristine = PristineSources(self.options.pristine_dir or
+        os.path.join(os.path.expanduser(self.options.base_dir), PRISTINE_DIRNAME))
+    if self.options.configure_cache:
+      self.configure_cache = ConfigureCache(self.options.configure_cache_dir or
+          os.path.join(self.options.results_dir, CONFIGURE_CACHE_DIRNAME))
+    if self.options.tmpfs_dir:
+      self._setup_scratch()
+    if self.options.artifact_store:
+      self._setup_artifacts()
+    if jobs > 1:
+      sys.stdout, sys.stderr = LineAtomicOutput(sys.stdout), LineAtomicOutput(sys.stderr)
+      self.jobserver = MakeJobserver(self.options.make_jobs)
+    self.plan_prebuilt()
+    self.stats = BuildStats(self.options.stats_file or os.path.join(self.options.results_dir, STATS_FN))
+    self.plan_resources()
+    try:
+      self._schedule(jobs, pending, done, running)
+    finally:
+      self.stats.add(self.stage_records)
+      self.stats.save()
+      if jobs > 1:
+        sys.stdout, sys.stderr = sys.stdout.unwrap(), sys.stderr.unwrap()
+        self.jobserver.close()
+        self.jobserver = None
+
+  def _schedule(self, jobs, pending, done, running):
+    import concurrent.futures
+    checking = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+      while pending or running:
+        batch = self._next_install_batch(pending, done, running)
+        if batch:
+          results = self.install_prebuilt(batch)
+          for product_name, _ in results:
+            pending.remove(product_name)
+          for product_name, err in results:
+            if err is None:
+              done.add(product_name)
+            else:
+              self._fail(product_name, err, pending)
+          continue
+        in_use = [sum(self.estimates[p][k] for p in running.values()) for k in ('mem_mib', 'cpu')]
+        ready = sorted(self.graph.ready(done), key=lambda p: -self.priority[p])
+        for product_name in ready:
+          if len(running) >= jobs:
+            break
+          if product_name not in pending or product_name in self.prebuilt:
+            continue
+          if any(other in running.values() for other in self.mutually_excluded.get(product_name, ()) if other != product_name):
+            continue
+          if not self._admit(product_name, in_use, running):
+            continue
+          pending.remove(product_name)
+          running[pool.submit(self._build_and_store, product_name)] = product_name
+        if not running:
+          raise Error('no buildable products left but still pending: {}'.format(' '.join(pending)))
+        finished, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+          product_name = running.pop(future)
+          err = future.exception()
+          if future in checking:
+            checking.discard(future)
+            if err is not None:
+              self._fail(product_name, err, pending)
+            else:
+              done.add(product_name)
+          elif err is None:
+            mode = self._check_mode(product_name)
+            if mode != 'require':
+              # installed, so what needs it can go ahead (while its tests
+              # run, if they're only to warn); else only once they pass
+              done.add(product_name)
+            if mode is not None:
+              check = pool.submit(self._check_and_store, product_name, future.result())
+              running[check] = product_name
+              checking.add(check)
+          else:
+            self._fail(product_name, err, pending)
+
+  def plan_resources(self):
+    """Estimate what each product will take, from its last builds here, and
+    rank them by the longest estimated chain of builds from each to the end.
+
+    Products never built here are assumed to be median ones; with no history
+    at all, everything is assumed to fit and the ranking is by depth alone.
+    """
+    known = [e for e in (self.stats.estimate(p) for p in self.ordered) if e is not None]
+    default = {'wall': 1.0, 'cpu': 0.0, 'mem_mib': 0}
+    if known:
+      default = {k: sorted(e[k] for e in known)[len(known) // 2] for k in default}
+    self.estimates = {p: self.stats.estimate(p) or dict(default) for p in self.ordered}
+    dependents = collections.defaultdict(list)
+    for p in self.ordered:
+      for dep in self.direct_needs[p]:
+        dependents[dep].append(p)
+    self.priority = {}
+    for p in reversed(self.ordered):
+      self.priority[p] = self.estimates[p]['wall'] + max(
+        (self.priority[d] for d in dependents[p]), default=0.0)
+    self._resource_waits = set()
+    return self.estimates
+
+  def _admit(self, product_name, in_use, running):
+    """Whether product_name fits alongside what's running; if it doesn't, its
+    need is held back from in_use so that lower-ranked products can only fill
+    in around it rather than keep it waiting indefinitely.  Anything is
+    admitted when nothing else is running."""
+    need = self.estimates[product_name]
+    budgets = (self.mem_budget, self.options.cpu_budget)
+    short = [name for name, used, want, budget in zip(('memory', 'cpu'), in_use, (need['mem_mib'], need['cpu']), budgets)
+             if budget and used + want > budget]
+    if short and running:
+      if product_name not in self._resource_waits:
+        self._resource_waits.add(product_name)
+        print('\033[33m[{}] Waiting for {}: \033[3m{}\033[0m\033[33m (expect {} MiB, {} cpu)\033[0m'.format(
+          self.options.boxname, ' and '.join(short), product_name, need['mem_mib'], need['cpu']), flush=True)
+      in_use[0] += need['mem_mib']
+      in_use[1] += need['cpu']
+      return False
+    in_use[0] += need['mem_mib']
+    in_use[1] += need['cpu']
+    return True
+
+  def _setup_scratch(self):
+    """Start using the tmpfs dir, taking over the trees recorded in the stage
+    state; the rest of what's there is of no further use."""
+    self.scratch = ScratchSpace(
+        os.path.join(os.path.expanduser(self.options.tmpfs_dir), SCRATCH_DIRNAME.format(self.options.boxname)),
+        self.options.tmpfs_cap << 20, evicted=self._forget_trees)
+    for product_name in self.ordered:
+      product = self.products[product_name]
+      self.scratch.track(product_name, self._product_trees(product))
+      if self._have_done_stage(product, 'package') and (
+          self._check_mode(product_name) is None or self._have_done_stage(product, 'check')):
+        self.scratch.finished(product_name)
+    self.scratch.sweep()
+    if self.options.mem_budget:
+      # tmpfs pages are charged to the memory of the box, not to the build
+      self.mem_budget = max(1, self.options.mem_budget - (self.scratch.cap >> 20))
+    print('\033[36mBuilding in tmpfs: \033[3m{}\033[0m\033[36m, up to {} MiB\033[0m'.format(
+      self.scratch.root, self.scratch.cap >> 20), flush=True)
+
+  def _setup_artifacts(self):
+    os_deps = set()
+    for pkg_conf in self.configures['packages'].values():
+      for dep in pkg_conf.get('os-deps', {}).get(self.options.ostype, []):
+        # eg: 'libunbound2 | libunbound8', 'libfoo (>= 1.2)'
+        os_deps.update(alt.split('(')[0].strip() for alt in dep.split('|'))
+    abi, parts = _abi_fingerprint(os.environ.get('CC', 'gcc'), self.options.compiler_cache, tuple(sorted(os_deps)))
+    self.artifacts = ArtifactStore(os.path.expanduser(self.options.artifact_store), abi, parts, self.options.boxname)
+    print('\033[36mArtifact store: \033[3m{}\033[0m\033[36m (ABI {})\033[0m'.format(
+      self.artifacts.root, abi[:16]), flush=True)
+
+  def _product_trees(self, product: Product):
+    """The work and DESTDIR trees recorded for the product, if any."""
+    trees = []
+    if self._have_done_stage(product, 'untar'):
+      trees += [self._workdir(product), self._workdir(product) + '.build']
+    for stage in ('tmpinstall', 'shared-tree'):
+      tree = self._have_done_stage(product, stage)
+      if tree:
+        trees += [tree, self._debug_tree(tree)]
+    return trees
+
+  def _forget_trees(self, product_name):
+    """The product's trees have been removed from the tmpfs: forget the
+    stages done in them, so that a rebuild starts afresh."""
+    for stage in WORK_TREE_STAGES + ('shared-tree',):
+      self.stages.forget(product_name, stage)
+    self._workdirs.pop(product_name, None)
+
+  def _recover_lost_trees(self, product: Product):
+    """Forget stages done in trees which have since gone (as everything in a
+    tmpfs does on a reboot), unless the product is packaged (and tested)."""
+    packaged = self._have_done_stage(product, 'package')
+    if packaged and (self._check_mode(product.name) is None or self._have_done_stage(product, 'check')):
+      return
+    tree = self._have_done_stage(product, 'tmpinstall')
+    if self._have_done_stage(product, 'untar') and not os.path.isdir(self._workdir(product)):
+      lost = WORK_TREE_STAGES
+    elif tree and not os.path.isdir(tree) and not packaged:
+      lost = WORK_TREE_STAGES[WORK_TREE_STAGES.index('tmpinstall'):]
+    elif not packaged and self._have_done_stage(product, 'shared-tree') and not os.path.isdir(
+        self._have_done_stage(product, 'shared-tree')):
+      lost = ('shared-tree',)
+    else:
+      return
+    print('\033[33mTrees of {} are gone, redoing from {}\033[0m'.format(product.name, lost[0]), flush=True)
+    for stage in lost:
+      self.stages.forget(product.name, stage)
+    for path in (tree, self._debug_tree(tree)) if tree else ():
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+
+  def _fail(self, product_name, err, pending):
+    self.failed[product_name] = err
+    print('\033[31;1m[{}] Failed: \033[3m{}\033[0m'.format(self.options.boxname, product_name), flush=True)
+    traceback.print_exception(type(err), err, err.__traceback__, file=sys.stderr)
+    for downstream in sorted(self.invalidates[product_name]):
+      if downstream in pending:
+        pending.remove(downstream)
+        self.skipped.add(downstream)
+        print('\033[31m[{}] Skipping, needs failed {!r}: \033[3m{}\033[0m'.format(
+          self.options.boxname, product_name, downstream), flush=True)
+
+  def plan_prebuilt(self):
+    """Work out which products have a package already, from the build cache
+    or the published repo, and so only need installing."""
+    self.prebuilt = {}
     for product_name in self.ordered:
-      # TODO: use the repo spec to check an existing repo server's contents
-      # instead of requiring the pkg be present on local FS
-      # install that if not depending upon something we've had to recompile,
-      # else if it exists but we have had to recompile a dep then auto-bump the
-      # pkgver suffix and build anyway.
-      # Also: figure out how to keep those pkgvers in sync across N OSes, if doing that way.
-      pkgpath = self._pkg_generated_pathname(self.products[product_name])
-      if os.path.exists(pkgpath):
-        print('\033[36mAlready have: \033[1m{}\033[0m  \033[36;3m{}\033[0m'.format(product_name, pkgpath), flush=True)
-        self.install_package(self.products[product_name], pkgpath)
+      product = self.products[product_name]
+      key = self.input_keys[product_name]
+      cached = self.cache.lookup(key)
+      if cached is None and self.artifacts is not None and self.artifacts.packages.lookup(key) is not None:
+        print('\033[36mFrom artifact store: \033[1m{}\033[0m'.format(product_name), flush=True)
+        shared = self.artifacts.packages
+        self.cache.store(key, product_name, shared.lookup(key), self.inputs[product_name],
+            extras=shared.extras(key), check=shared.check_result(key))
+        cached = self.cache.lookup(key)
+      if cached is not None:
+        pkgpath = self._pkg_generated_pathname(product)
+        print('\033[36mAlready have: \033[1m{}\033[0m  \033[36;3m{}\033[0m  \033[36m[{}]\033[0m'.format(
+          product_name, pkgpath, key[:16]), flush=True)
+        for src, dst in [(cached, pkgpath)] + [
+            (extra, os.path.join(self.options.results_dir, os.path.basename(extra))) for extra in self.cache.extras(key)]:
+          if not (os.path.exists(dst) and os.path.samefile(src, dst)):
+            _link_or_copy(src, dst)
+        self.prebuilt[product_name] = pkgpath
+      elif product_name in self.published:
+        self.prebuilt[product_name] = self.published[product_name]
+    return self.prebuilt
+
+  def _next_install_batch(self, pending, done, running):
+    """Prebuilt products which can be installed together now: those whose
+    dependencies are all installed, or are in the same batch (dpkg orders a
+    single transaction itself).  No two from one mutually_excluded set, nor
+    one whose set has a member building."""
+    batch = []
+    in_batch = set()
+    busy = set(running.values())
+    for product_name in self.ordered:
+      if product_name not in pending or product_name not in self.prebuilt:
+        continue
+      if any(dep not in done and dep not in in_batch for dep in self.direct_needs[product_name]):
         continue
-      print('\033[36mExpecting to create: \033[3m{}\033[0m'.format(pkgpath), flush=True)
-      self.build_one(product_name)
+      excluded = set(self.mutually_excluded.get(product_name, ())) - {product_name}
+      if excluded & (busy | in_batch):
+        continue
+      batch.append(product_name)
+      in_batch.add(product_name)
+    return batch
+
+  def _build_and_store(self, product_name):
+    product = self.products[product_name]
+    key = self.input_keys[product_name]
+    pkgpath = self._pkg_generated_pathname(product)
+    print('\033[36mExpecting to create: \033[3m{}\033[0m  \033[36m[{}]\033[0m'.format(pkgpath, key[:16]), flush=True)
+    pkgpath = self.build_one(product_name)
+    if self._check_mode(product_name) is None:
+      self._store(product_name, pkgpath)
+    return pkgpath
+
+  def _check_and_store(self, product_name, pkgpath):
+    result = self.check(self.products[product_name])
+    self._store(product_name, pkgpath, check=result)
+
+  def _store(self, product_name, pkgpath, check=None):
+    """Into the build cache, once built (and tested): a package whose tests
+    failed is only kept when its tests are allowed to fail."""
+    product = self.products[product_name]
+    key = self.input_keys[product_name]
+    extras = [p for p in [self._pkg_generated_pathname(product, dbg=True)] if os.path.exists(p)]
+    self.cache.store(key, product_name, pkgpath, self.inputs[product_name], extras=extras, check=check)
+    self.cache.record_used(product_name, key)
+    if self.artifacts is not None and (check is None or check['passed']):
+      tree = self._have_done_stage(product, 'tmpinstall')
+      if tree and os.path.isdir(tree):
+        self.artifacts.put_tree(self.tree_keys[product_name], product_name, tree, self._debug_tree(tree), check=check)
+      self.artifacts.packages.store(key, product_name, pkgpath, self.inputs[product_name], extras=extras, check=check)
+    if self.scratch is not None:
+      self.scratch.finished(product_name)
 
   def _normalize_list(self, items):
     return list(map(lambda s: s.replace('#{prefix}', self.configures['prefix']), items))
 
+  def _workdir(self, product: Product):
+    """Where the product is unpacked: in the base dir, or in the tmpfs dir if
+    untar() found room there."""
+    if product.name in self._workdirs:
+      return self._workdirs[product.name]
+    done = self._have_done_stage(product, 'untar')
+    if done and os.path.isabs(done):
+      # nb: earlier versions recorded a timestamp here
+      return done
+    return os.path.join(os.path.expanduser(self.options.base_dir), product.dirname)
+
+  def _builddir(self, product: Product):
+    """Where configure, make and make install run: the source tree, unless
+    the product builds out-of-tree (VPATH)."""
+    if self.options.vpath or self.configures['packages'][product.name].get('vpath', False):
+      return self._workdir(product) + '.build'
+    return self._workdir(product)
+
   def _some_file_for_stage(self, product: Product, stage, prefix):
     return os.path.join(
         os.path.expanduser(self.options.base_dir),
         '.{prefix}.{p.name}.{stage}'.format(p=product, stage=stage, prefix=prefix))
 
-  def _flagfile_for_stage(self, product: Product, stage):
-    # _could_ use inspect module to auto-determine stage, but prefer slightly less magic
-    return self._some_file_for_stage(product, stage, 'done')
-
   def _stdout_for_stage(self, product: Product, stage):
     return self._some_file_for_stage(product, stage, 'stdout')
 
   def _stderr_for_stage(self, product: Product, stage):
     return self._some_file_for_stage(product, stage, 'stderr')
 
+  # _could_ use inspect module to auto-determine stage, but prefer slightly less magic
+  # Stages are scoped to the input key, so that changing any input (or that
+  # of a dependency) means no stage counts as done for the new inputs.
   def _record_done_stage(self, product: Product, stage, content=None):
-    with open(self._flagfile_for_stage(product, stage), 'w') as fh:
-      if content is None:
-        content = datetime.datetime.now().isoformat()
-      print(content, file=fh)
+    if content is None:
+      content = datetime.datetime.now().isoformat()
+    self.stages.record(product.name, self.input_keys[product.name], stage, content)
 
-  def _have_done_stage(self, product: Product, stage, want_content=False):
-    if not want_content:
-      return os.path.exists(self._flagfile_for_stage(product, stage))
-    try:
-      return list(map(lambda s: s.rstrip(), open(self._flagfile_for_stage(product, stage)).readlines()))
-    except:
-      return None
+  def _have_done_stage(self, product: Product, stage):
+    """Returns what was recorded for the stage (when, or a path), or None."""
+    return self.stages.get(product.name, self.input_keys[product.name], stage)
 
   def _print_already(self, stagename):
     print('\033[34m[{}] Already: \033[3m{}\033[0m'.format(self.options.boxname, stagename), flush=True)
-
-  def build_one(self, product_name: str):
+    record = getattr(self._stage_local, 'record', None)
+    if record is not None:
+      record['already'] = True
+
+  def _check_call(self, cmdline, **kwargs):
+    """subprocess.check_call which also accounts the child's resource usage
+    to the stage running in this thread."""
+    p = subprocess.Popen(cmdline, **kwargs)
+    try:
+      _, status, ru = os.wait4(p.pid, 0)
+    except BaseException:
+      p.kill()
+      p.wait()
+      raise
+    if os.WIFSIGNALED(status):
+      p.returncode = -os.WTERMSIG(status)
+    else:
+      p.returncode = os.WEXITSTATUS(status)
+    record = getattr(self._stage_local, 'record', None)
+    if record is not None:
+      _add_rusage(record, ru)
+    if p.returncode:
+      raise subprocess.CalledProcessError(p.returncode, cmdline)
+
+  def _finish_stage_record(self, record):
+    with self._report_lock:
+      self.stage_records.append(record)
+      self._append_report(record)
+
+  def _append_report(self, record):
+    # Written as we go, so that a build which dies still leaves its timings;
+    # each run starts the report afresh.
+    if self._report_fn is None:
+      self._report_fn = os.path.join(self.options.results_dir, BUILD_REPORT_FN)
+      open(self._report_fn, 'w').close()
+    with open(self._report_fn, 'a') as fh:
+      print(json.dumps(record, sort_keys=True), file=fh)
+
+  def _product_times(self):
+    # nb: the check stage runs after the product is installed, off the path
+    times = collections.defaultdict(float)
+    for r in self.stage_records:
+      if r['stage'] != 'check':
+        times[r['product']] += r['wall']
+    return times
+
+  def _check_results(self):
+    """{product: how its tests went}, from this run or the build cache."""
+    results = {}
+    for r in self.stage_records:
+      if 'check' in r:
+        results[r['product']] = dict(r['check'], wall=r['wall'])
+      elif r['stage'] == 'check' and r['failed']:
+        results[r['product']] = {'passed': False, 'cached': False, 'wall': r['wall']}
+    for product_name in self.ordered:
+      cached = self.cache.check_result(self.input_keys[product_name])
+      if product_name not in results and cached is not None:
+        results[product_name] = dict(cached, cached=True)
+    return results
+
+  def critical_path(self):
+    """Returns (total, [products]) for the longest chain of dependencies,
+    weighted by the wall time each product's stages took in this run."""
+    own = self._product_times()
+    finish = {}
+    via = {}
+    for p in self.ordered:
+      before = max(self.direct_needs[p], key=lambda d: finish[d], default=None)
+      via[p] = before
+      finish[p] = own.get(p, 0.0) + (finish[before] if before is not None else 0.0)
+    if not finish:
+      return 0.0, []
+    p = max(finish, key=lambda k: finish[k])
+    total = finish[p]
+    path = []
+    while p is not None:
+      path.append(p)
+      p = via[p]
+    return total, list(reversed(path))
+
+  def write_build_report(self):
+    """Append a summary record to the build report, after the stage records."""
+    total, path = self.critical_path()
+    summary = {
+      'type': 'summary',
+      'box': self.options.boxname,
+      'finished': datetime.datetime.now().isoformat(),
+      'product_wall': self._product_times(),
+      'critical_path': path,
+      'critical_path_wall': total,
+      'installed': sorted(self.installed),
+      'failed': sorted(self.failed),
+      'skipped': sorted(self.skipped),
+      }
+    if self.options.check:
+      summary['check'] = self._check_results()
+    if self.scratch is not None:
+      summary['tmpfs'] = dict(self.scratch.stats, cap_mib=self.scratch.cap >> 20)
+    if self.estimates:
+      summary['resource_budget'] = {
+        'mem_mib': self.mem_budget,
+        'cpu': self.options.cpu_budget,
+        'waited': sorted(self._resource_waits),
+        }
+    after = self.compiler_cache_stats() if self._compiler_cache_before is not None else None
+    if after is not None:
+      # nb: counters are for the whole cache dir, which other boxes may share
+      summary['compiler_cache'] = {
+        'hits': after[0] - self._compiler_cache_before[0],
+        'misses': after[1] - self._compiler_cache_before[1],
+        }
+    with self._report_lock:
+      self._append_report(summary)
+    return summary
+
+  def print_profile(self):
+    total, path = self.critical_path()
+    own = self._product_times()
+    print('\nCritical path: {:.1f}s'.format(total))
+    for p in path:
+      stages = ['{}={:.1f}s'.format(r['stage'], r['wall']) for r in self.stage_records if r['product'] == p]
+      print('  {:<16} {:7.1f}s  {}'.format(p, own.get(p, 0.0), ' '.join(stages)))
+    by_stage = collections.defaultdict(lambda: [0.0, 0.0, 0])
+    for r in self.stage_records:
+      by_stage[r['stage']][0] += r['wall']
+      by_stage[r['stage']][1] += r['cpu_user'] + r['cpu_sys']
+      by_stage[r['stage']][2] = max(by_stage[r['stage']][2], r['max_rss_kb'])
+    configure_stats = [r['configure_cache'] for r in self.stage_records if 'configure_cache' in r]
+    if configure_stats:
+      print('Configure cache: {} of {} configures started with cached results'.format(
+        sum(1 for c in configure_stats if c['primed']), len(configure_stats)))
+    optimize_stats = [r['optimize'] for r in self.stage_records if 'optimize' in r]
+    if optimize_stats:
+      print('Tree optimizer: {} bytes saved by stripping, {} by hardlinking duplicates, over {} products'.format(
+        sum(o['strip_saved'] for o in optimize_stats), sum(o['dedupe_saved'] for o in optimize_stats), len(optimize_stats)))
+    if self.options.check:
+      checks = self._check_results()
+      print('Checks: {} passed, {} failed; {} from the cache'.format(
+        sum(1 for c in checks.values() if c['passed']), sum(1 for c in checks.values() if not c['passed']),
+        sum(1 for c in checks.values() if c['cached'])))
+    if self.scratch is not None:
+      print('Tmpfs: {placed} trees placed, {spilled} spilled to disk, {evicted} removed to make room ({evicted_bytes} bytes)'.format(
+        **self.scratch.stats))
+    cache_stats = [r['compiler_cache'] for r in self.stage_records if 'compiler_cache' in r]
+    if cache_stats:
+      print('Compiler cache: {} hits, {} misses'.format(
+        sum(c['hits'] for c in cache_stats), sum(c['misses'] for c in cache_stats)))
+    print('Stages, summed across products:')
+    for stage in sorted(by_stage, key=lambda k: -by_stage[k][0]):
+      wall, cpu, rss = by_stage[stage]
+      print('  {:<18} wall {:7.1f}s  cpu {:7.1f}s  peak rss {:8d} KiB'.format(stage, wall, cpu, rss))
+
+  def _params_and_env(self, product_name: str, boxname=None):
+    if boxname is None:
+      if product_name in self.planned_params:
+        return [list(x) for x in self.planned_params[product_name]]
+      boxname = self.options.boxname
     if product_name not in self.configures['packages']:
       raise Error('missing configure information for {!r}'.format(product_name))
     params = self._normalize_list(self.configures['common_params'] + self.configures['packages'][product_name].get('params', []))
@@ -314,64 +2979,106 @@ class BuildPlan(object):
       for chunk in self.configures['packages'][product_name]['sometimes']:
         if 'boxes' not in chunk:
           continue
-        if self.options.boxname not in chunk['boxes']:
-          print('\033[35mWe are {!r} and that is not found in boxes constraints for this chunk'.format(self.options.boxname), flush=True)
+        if boxname not in chunk['boxes']:
+          if boxname == self.options.boxname:
+            print('\033[35mWe are {!r} and that is not found in boxes constraints for this chunk'.format(boxname), flush=True)
           continue
         params += self._normalize_list(chunk.get('params', []))
         envs += self._normalize_list(chunk.get('env', []))
+    return params, envs
+
+  def build_one(self, product_name: str):
+    """Builds, packages and installs a product, returning the package path."""
+    params, envs = self._params_and_env(product_name)
     print('\033[36;1m[{}] Build: \033[3m{}\033[0m'.format(self.options.boxname, product_name), flush=True)
     product = self.products[product_name]
-    self.ensure_clear_for(product)
-    self.untar(product, product.tarball, product.dirname)
-    try:
-      os.chdir(product.dirname)
+    # Builds may be running in parallel threads, so nothing here may chdir;
+    # each stage runs its commands with cwd= the product's work directory.
+    with self._install_lock:
+      self.ensure_clear_for(product)
+    self._recover_lost_trees(product)
+    tmp = self.shared_tree(product) if self.artifacts is not None else None
+    if tmp is None:
+      self.untar(product, product.tarball, product.dirname)
       self.patch(product)
       self.run_configure(product, params, envs)
+      self.compile(product)
       tmp = self.install_temptree(product)
       self.prepackage_fixup(product, tmp)
-      pkg_path = self.package(product, tmp)
-      self.install_package(product, pkg_path)  # need for later packages to build
-    finally:
-      os.chdir(os.path.expanduser(self.options.base_dir))
+      self.optimize_tree(product, tmp)
+    pkg_path = self.package(product, tmp)
+    self.install_package(product, pkg_path)  # need for later packages to build
+    return pkg_path
+
+  def _conflicts_for(self, product_names):
+    """Installed packages which must go before product_names can be installed."""
+    conflicts = []
+    for product_name in product_names:
+      for disallow in sorted(self.mutually_excluded.get(product_name, ())):
+        if disallow not in product_names and disallow in self.installed and disallow not in conflicts:
+          conflicts.append(disallow)
+    return conflicts
 
   def ensure_clear_for(self, product: Product):
     if product.name not in self.mutually_excluded:
       print('\033[38;5;49mNo packages defined as conflicting with {!r}\033[0m'.format(product.name), flush=True)
       return
-    saw_conflict = []
-    for disallow in self.mutually_excluded[product.name]:
-      if disallow == product.name:
-        continue
-      if disallow in self.installed:
-        saw_conflict.append(disallow)
-        print('\033[31mConflicting package for {p.name!r} installed: \033[1m{c!r}\033[0m'.format(
-          p=product, c=disallow), flush=True)
-        self.uninstall(self.products[disallow])
+    saw_conflict = self._conflicts_for([product.name])
+    for disallow in saw_conflict:
+      print('\033[31mConflicting package for {p.name!r} installed: \033[1m{c!r}\033[0m'.format(
+        p=product, c=disallow), flush=True)
     if saw_conflict:
+      self.uninstall([self.products[c] for c in saw_conflict])
       print('\033[38;5;49mPackage {p.name!r} in set [{s}]; uninstalled: [{u}]'.format(
         p=product, s=' '.join(self.mutually_excluded[product.name]), u=' '.join(saw_conflict)), flush=True)
     else:
       print('\033[38;5;49mNo packages conflicting with {p.name!r} were installed [set: {s}]\033[0m'.format(
         p=product, s=' '.join(self.mutually_excluded[product.name])), flush=True)
 
+  @instrumented_stage
   def untar(self, product: Product, tarball, expected_dirname):
     STAGENAME = 'untar'
     if self._have_done_stage(product, STAGENAME):
       self._print_already(STAGENAME)
       return
-    subprocess.check_call(['tar', '-xf', tarball],
-        stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
-    if not os.path.isdir(expected_dirname):
-      raise Error('Missing expected dir {!r} from {!r}'.format(expected_dirname, tarball))
-    self._record_done_stage(product, STAGENAME)
+    base_dir = os.path.expanduser(self.options.base_dir)
+    self._workdirs.pop(product.name, None)
+    for top in [base_dir] + ([self.scratch.root] if self.scratch is not None else []):
+      for leftover in (os.path.join(top, expected_dirname), os.path.join(top, expected_dirname) + '.build'):
+        if os.path.isdir(leftover):
+          # left over from a build with different inputs
+          shutil.rmtree(leftover)
+    sha256 = self._sha256(tarball)
+    top = base_dir
+    if self.scratch is not None:
+      # objects and all, a build tree is typically a few times the source
+      top = self.scratch.place(product.name, 3 * self.pristine.size(tarball, sha256))
+      if top is None:
+        print('\033[33mNo room in tmpfs for {}, building on disk\033[0m'.format(product.name), flush=True)
+        top = base_dir
+    self._workdirs[product.name] = os.path.join(top, expected_dirname)
+    if self.scratch is not None:
+      self.scratch.track(product.name, [self._workdir(product), self._workdir(product) + '.build'])
+    if not self.pristine.checkout(self.pristine.tree(tarball, sha256, expected_dirname), self._workdir(product)):
+      print('\033[33mPristine tree for {} was modified, extracting again\033[0m'.format(product.name), flush=True)
+      shutil.rmtree(self._workdir(product))
+      self.pristine.discard(sha256)
+      if not self.pristine.checkout(self.pristine.tree(tarball, sha256, expected_dirname), self._workdir(product)):
+        raise Error('Pristine tree for {!r} modified while checking it out'.format(tarball))
+    os.makedirs(self._builddir(product), exist_ok=True)
+    self._record_done_stage(product, STAGENAME, content=self._workdir(product))
+
+  def _patch_files(self, product: Product):
+    our_patches_re = re.compile(r'^' + re.escape(product.name) + '_(?:(?:v' + re.escape(product.ver) + ')|[^v])')
+    return sorted(f for f in os.listdir(self.options.patches_dir) if our_patches_re.match(f))
 
+  @instrumented_stage
   def patch(self, product: Product):
     STAGENAME = 'patch'
     if self._have_done_stage(product, STAGENAME):
       self._print_already(STAGENAME)
       return
-    our_patches_re = re.compile(r'^' + re.escape(product.name) + '_(?:(?:v' + re.escape(product.ver) + ')|[^v])')
-    patch_files = [f for f in os.listdir(self.options.patches_dir) if our_patches_re.match(f)]
+    patch_files = self._patch_files(product)
     if not patch_files:
       print('No patches for {}'.format(product.name), file=sys.stderr, flush=True)
       self._record_done_stage(product, STAGENAME)
@@ -383,50 +3090,301 @@ class BuildPlan(object):
       m = level_extractor.match(patch_short[len(product.name):])
       if m is not None:
         patch_strip = int(m.group(1))
-      subprocess.check_call(['patch', '-p' + str(patch_strip)],
-          stdout=sys.stdout, stderr=sys.stderr, stdin=open(patch, 'rb'))
+      self._check_call(['patch', '-p' + str(patch_strip)],
+          stdout=sys.stdout, stderr=sys.stderr, stdin=open(patch, 'rb'),
+          cwd=self._workdir(product))
     self._record_done_stage(product, STAGENAME)
 
+  @instrumented_stage
   def run_configure(self, product: Product, params, envs):
     STAGENAME = 'configure'
     if self._have_done_stage(product, STAGENAME):
       self._print_already(STAGENAME)
       return
-    newenv = os.environ.copy()
+    newenv = self._configure_env(product, envs)
+    cache_key = self._configure_cache_key(product, params, envs, newenv)
+    if cache_key is not None:
+      cache_file = self._some_file_for_stage(product, STAGENAME, 'cache')
+      primed = self.configure_cache.checkout(cache_key, cache_file)
+      params = params + ['--cache-file=' + cache_file]
+    with open(self._stdout_for_stage(product, STAGENAME), 'wb') as stdout:
+      with open(self._stderr_for_stage(product, STAGENAME), 'wb') as stderr:
+        self._check_call([os.path.join(os.path.relpath(self._workdir(product), self._builddir(product)), 'configure')] + params,
+            stdout=stdout, stderr=stderr, stdin=open(os.devnull, 'r'),
+            env=newenv, cwd=self._builddir(product))
+    if cache_key is not None:
+      learned = self.configure_cache.merge(cache_key, cache_file)
+      record = getattr(self._stage_local, 'record', None)
+      if record is not None:
+        record['configure_cache'] = {'key': cache_key[:16], 'primed': primed, 'learned': learned}
+    self._collect_compiler_cache_stats(product)
+    self._record_done_stage(product, STAGENAME)
+
+  def _configure_env(self, product: Product, envs):
+    """The environment to configure in: ours, with the product's settings
+    from configures.json ("VAR=value", or "VAR" or "VAR=" to unset), then
+    the compiler cache, so a CC of the product's own is wrapped too."""
+    env = os.environ.copy()
     for e in envs:
       try:
         k, v = e.split('=', 1)
         if v:
-          newenv[k] = v
+          env[k] = v
         else:
-          del newenv[k]
+          env.pop(k, None)
       except ValueError:
-        del newenv[e]
+        env.pop(e, None)
+    return self._compiler_cache_env(product, env)
+
+  def _configure_cache_key(self, product: Product, params, envs, env):
+    """Which shared autoconf cache this configure may use, or None.
+
+    Results are only shared between products configured with the same
+    environment settings, whether from configures.json or inherited (checks
+    compile and link with CFLAGS, CPPFLAGS, LDFLAGS and so on), the same
+    variables and platform given as params, and against the same builds of
+    the same dependencies (a check for a library gets a different answer once
+    that library is installed), on the same box and toolchain.  Other params
+    (--with-*, --enable-*) are left out, or nothing would be shared: they
+    mostly steer checks of the product's own, cached under names of their own.
+    """
+    if self.configure_cache is None:
+      return None
+    if not self.configures['packages'][product.name].get('configure_cache', True):
+      return None
+    return _hash_json({
+      'box': self.options.boxname,
+      'toolchain': _toolchain_fingerprint(env.get('CC', 'gcc'), self.options.compiler_cache),
+      'env': sorted(envs),
+      'flags': {k: env[k] for k in CONFIGURE_CACHE_ENV if k in env},
+      'params': sorted(p for p in params if not p.startswith('-') or p.startswith(('--host=', '--build=', '--target='))),
+      'needs': {dep: self.build_keys[dep] for dep in self.needs[product.name]},
+      })
+
+  def _compiler_cache_env(self, product: Product, env):
+    """Adjusts env to compile through the compiler cache, if we have one.
+
+    CC/CXX are wrapped at configure time and so baked into the Makefiles; the
+    cache settings are needed by every stage which might compile.  Paths under
+    the dir holding the work tree are hashed relative to it, so a rebuild in a fresh tree (or in
+    another box with the same layout) still hits.
+    """
+    if not self.options.compiler_cache_dir:
+      return env
+    env['CCACHE_DIR'] = self.options.compiler_cache_dir
+    env['CCACHE_BASEDIR'] = os.path.dirname(self._workdir(product))
+    env['CCACHE_STATSLOG'] = self._some_file_for_stage(product, 'compiler-cache', 'stats')
+    for var, default in (('CC', 'gcc'), ('CXX', 'g++')):
+      compiler = env.get(var, default)
+      if os.path.basename(compiler.split()[0]) != os.path.basename(self.options.compiler_cache):
+        env[var] = self.options.compiler_cache + ' ' + compiler
+    return env
+
+  def _collect_compiler_cache_stats(self, product: Product):
+    """Moves the compiler cache hits/misses logged by this stage's commands
+    into the stage record.  Needs ccache 4 for the stats_log; without it, we
+    only have the totals in the build report summary."""
+    if not self.options.compiler_cache_dir:
+      return
+    fn = self._some_file_for_stage(product, 'compiler-cache', 'stats')
+    try:
+      lines = open(fn).read().split()
+    except OSError:
+      return
+    os.unlink(fn)
+    record = getattr(self._stage_local, 'record', None)
+    if record is not None:
+      record['compiler_cache'] = {
+        'hits': sum(1 for l in lines if l in COMPILER_CACHE_HITS),
+        'misses': sum(1 for l in lines if l in COMPILER_CACHE_MISSES),
+        }
+
+  def compiler_cache_stats(self):
+    """Returns the compiler cache's (hits, misses) counters, or None."""
+    if not self.options.compiler_cache_dir:
+      return None
+    env = dict(os.environ, CCACHE_DIR=self.options.compiler_cache_dir)
+    try:
+      out = subprocess.check_output([self.options.compiler_cache, '--print-stats'],
+          env=env, stderr=subprocess.DEVNULL, stdin=open(os.devnull, 'r'), universal_newlines=True)
+      counters = dict(l.split('\t', 1) for l in out.splitlines() if '\t' in l)
+    except (OSError, subprocess.CalledProcessError):
+      # ccache before 3.7: only the human-readable form
+      try:
+        out = subprocess.check_output([self.options.compiler_cache, '-s'],
+            env=env, stderr=subprocess.DEVNULL, stdin=open(os.devnull, 'r'), universal_newlines=True)
+      except (OSError, subprocess.CalledProcessError):
+        return None
+      counters = {}
+      for name, label in (('direct_cache_hit', 'cache hit (direct)'),
+                          ('preprocessed_cache_hit', 'cache hit (preprocessed)'),
+                          ('cache_miss', 'cache miss')):
+        m = re.search(r'^' + re.escape(label) + r'\s+(\d+)', out, re.MULTILINE)
+        if m:
+          counters[name] = m.group(1)
+    return (sum(int(counters.get(k, 0)) for k in COMPILER_CACHE_HITS),
+            sum(int(counters.get(k, 0)) for k in COMPILER_CACHE_MISSES))
+
+  @instrumented_stage
+  def compile(self, product: Product):
+    """Runs make in parallel, so that the install step has little left to do.
+
+    A "make_jobs" count for the product in the configures file wins (use 1 for
+    anything which can't build in parallel); otherwise, when several products
+    are building at once they share one jobserver of --make-jobs slots, and
+    when not, make just gets -j<make-jobs>.
+    """
+    STAGENAME = 'compile'
+    if self._have_done_stage(product, STAGENAME):
+      self._print_already(STAGENAME)
+      return
+    cmdline, env, pass_fds = self._parallel_make(product)
     with open(self._stdout_for_stage(product, STAGENAME), 'wb') as stdout:
       with open(self._stderr_for_stage(product, STAGENAME), 'wb') as stderr:
-        subprocess.check_call(['./configure'] + params,
+        self._make_call(cmdline,
             stdout=stdout, stderr=stderr, stdin=open(os.devnull, 'r'),
-            env=newenv)
+            env=env, pass_fds=pass_fds, cwd=self._builddir(product))
+    self._collect_compiler_cache_stats(product)
     self._record_done_stage(product, STAGENAME)
 
+  def _parallel_make(self, product: Product, target=()):
+    """Returns (cmdline, env, pass_fds) to run make for target, in parallel
+    as described for compile()."""
+    cmdline = ['make']
+    env = self._compiler_cache_env(product, os.environ.copy())
+    pass_fds = ()
+    jobs = self.configures['packages'][product.name].get('make_jobs')
+    if jobs is None and self.jobserver is not None:
+      env = self.jobserver.env(env)
+      pass_fds = self.jobserver.pass_fds()
+    else:
+      cmdline.append('-j{}'.format(jobs or self.options.make_jobs))
+    return cmdline + list(target), env, pass_fds
+
+  def _make_call(self, cmdline, pass_fds=(), **kwargs):
+    """_check_call for a make from _parallel_make; one sharing the jobserver
+    waits for a slot for the job it starts without asking."""
+    if not pass_fds:
+      return self._check_call(cmdline, pass_fds=pass_fds, **kwargs)
+    token = self.jobserver.acquire()
+    try:
+      return self._check_call(cmdline, pass_fds=pass_fds, **kwargs)
+    finally:
+      self.jobserver.release(token)
+
+  def _check_mode(self, product_name):
+    """How to take the product's test suite: None to skip it, 'require' to
+    pass or 'warn' to only report a failure; from --check and the
+    configures file's "check" for the product (true means 'require')."""
+    if not self.options.check:
+      return None
+    mode = self.configures['packages'].get(product_name, {}).get('check', True)
+    if mode is False:
+      return None
+    if mode is True:
+      return 'require'
+    if mode not in CHECK_MODES:
+      raise Error('{}: "check" must be true, false or one of {}, not {!r}'.format(product_name, ' '.join(CHECK_MODES), mode))
+    return mode
+
+  @instrumented_stage
+  def check(self, product: Product):
+    """Runs make check in the build tree; returns how it went.
+
+    This runs once the product is installed, alongside whatever builds next
+    (so in the same make jobserver), and the result is kept with the
+    package in the build cache; a product reused from there is not tested
+    again.  A failure fails the product, unless its "check" is "warn".
+    """
+    STAGENAME = 'check'
+    key = self.input_keys[product.name]
+    result = self._have_done_stage(product, STAGENAME) or self.cache.check_result(key)
+    if result is not None:
+      self._print_already(STAGENAME)
+      result = dict(result, cached=True)
+    else:
+      cmdline, env, pass_fds = self._parallel_make(product, ['check'])
+      result = {'passed': True, 'cached': False}
+      print('\033[36m[{}] Check: \033[3m{}\033[0m'.format(self.options.boxname, product.name), flush=True)
+      try:
+        with open(self._stdout_for_stage(product, STAGENAME), 'wb') as stdout:
+          with open(self._stderr_for_stage(product, STAGENAME), 'wb') as stderr:
+            self._make_call(cmdline,
+                stdout=stdout, stderr=stderr, stdin=open(os.devnull, 'r'),
+                env=env, pass_fds=pass_fds, cwd=self._builddir(product))
+      except subprocess.CalledProcessError as e:
+        if self._check_mode(product.name) != 'warn':
+          raise Error('{}: make check failed ({}); see {}'.format(
+            product.name, e.returncode, self._stdout_for_stage(product, STAGENAME)))
+        result['passed'] = False
+        print('\033[33m[{}] Check failed, carrying on: \033[3m{}\033[0m\033[33m; see {}\033[0m'.format(
+          self.options.boxname, product.name, self._stdout_for_stage(product, STAGENAME)), flush=True)
+      self._collect_compiler_cache_stats(product)
+      self._record_done_stage(product, STAGENAME, content=result)
+    record = getattr(self._stage_local, 'record', None)
+    if record is not None:
+      record['check'] = result
+    return result
+
+  def _new_install_tree(self, product: Product, expect):
+    """A new, empty tree for about expect bytes of installed files."""
+    pattern = 'pkgbuild.{}.'.format(product.filename_base)
+    tmpdir = None
+    if self.scratch is not None:
+      tmpdir = self.scratch.place(product.name, expect)
+    tree = tempfile.mkdtemp(prefix=pattern, dir=tmpdir)
+    if self.scratch is not None:
+      self.scratch.track(product.name, [tree, self._debug_tree(tree)])
+    return tree
+
+  @instrumented_stage
+  def shared_tree(self, product: Product):
+    """Returns a tree ready to package, linked from the artifact store, if a
+    box with our ABI built the product from the same inputs; else None.
+
+    With --check, only a tree which was tested is used, and its test result
+    stands for ours.
+    """
+    STAGENAME = 'shared-tree'
+    already = self._have_done_stage(product, STAGENAME)
+    if already:
+      self._print_already(STAGENAME)
+      return already
+    tree_key = self.tree_keys[product.name]
+    entry = self.artifacts.tree_entry(tree_key)
+    if entry is None or (self._check_mode(product.name) is not None and entry['check'] is None):
+      return None
+    print('\033[36mUsing tree built on {}: \033[1m{}\033[0m  \033[36m[{}]\033[0m'.format(
+      entry['box'], product.name, tree_key[:16]), flush=True)
+    tree = self._new_install_tree(product, self.artifacts.tree_bytes(tree_key, entry))
+    self.artifacts.link_tree(tree_key, tree, self._debug_tree(tree))
+    if self._check_mode(product.name) is not None:
+      self._record_done_stage(product, 'check', content=dict(entry['check'], cached=True))
+    self._record_done_stage(product, STAGENAME, content=tree)
+    return tree
+
+  @instrumented_stage
   def install_temptree(self, product: Product):
     """Returns the tree where the content is."""
     STAGENAME = 'tmpinstall'
-    already = self._have_done_stage(product, STAGENAME, want_content=True)
+    already = self._have_done_stage(product, STAGENAME)
     if already:
       self._print_already(STAGENAME)
-      return already[0]
-    pattern = 'pkgbuild.{}.'.format(product.filename_base)
-    tree = tempfile.mkdtemp(prefix=pattern)
-    # We deliberately never delete the tree;
-    # leave the installs around until VM destruction.
+      return already
+    tree = self._new_install_tree(product, self.pristine.size(product.tarball, self._sha256(product.tarball)))
+    # Outside a tmpfs, the tree is only deleted once stale (see
+    # _discard_stale_stages); leave the installs around until then.
     with open(self._stdout_for_stage(product, STAGENAME), 'wb') as stdout:
       with open(self._stderr_for_stage(product, STAGENAME), 'wb') as stderr:
-        subprocess.check_call(['make', 'install', 'DESTDIR='+tree],
-            stdout=stdout, stderr=stderr, stdin=open(os.devnull, 'r'))
+        self._check_call(['make', 'install', 'DESTDIR='+tree],
+            stdout=stdout, stderr=stderr, stdin=open(os.devnull, 'r'),
+            env=self._compiler_cache_env(product, os.environ.copy()),
+            cwd=self._builddir(product))
+    self._collect_compiler_cache_stats(product)
     self._record_done_stage(product, STAGENAME, content=tree)
     return tree
 
+  @instrumented_stage
   def prepackage_fixup(self, product: Product, temp_tree):
     STAGENAME = 'prepackage-fixup'
     if self._have_done_stage(product, STAGENAME):
@@ -435,73 +3393,246 @@ class BuildPlan(object):
     fixup_list = list(map(lambda s: s.replace('#{temp_tree}', temp_tree),
       self._normalize_list(self.configures['packages'][product.name].get('fixups', []))))
     for fixup in fixup_list:
-      subprocess.check_call(fixup, shell=True,
-          stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+      self._check_call(fixup, shell=True,
+          stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'),
+          cwd=self._workdir(product))
     self._record_done_stage(product, STAGENAME)
 
-  def _pkg_full_version(self, product: Product):
+  def _optimize_settings(self, product_name):
+    """[strip mode, dedupe]: the configures file's "strip" and "dedupe" for
+    the product, defaulting to --strip and true."""
+    pkg_conf = self.configures['packages'].get(product_name, {})
+    strip_mode = pkg_conf.get('strip', self.options.strip)
+    if strip_mode not in STRIP_MODES:
+      raise Error('{}: "strip" must be one of {}, not {!r}'.format(product_name, ' '.join(STRIP_MODES), strip_mode))
+    return [strip_mode, bool(pkg_conf.get('dedupe', True))]
+
+  def _debug_tree(self, temp_tree):
+    return temp_tree + '.dbg'
+
+  @instrumented_stage
+  def optimize_tree(self, product: Product, temp_tree):
+    """Strips binaries, or splits their debug info out into a tree for a
+    -dbg package, then hardlinks identical files; see TreeOptimizer."""
+    STAGENAME = 'optimize'
+    if self._have_done_stage(product, STAGENAME):
+      self._print_already(STAGENAME)
+      return
+    strip_mode, dedupe = self._optimize_settings(product.name)
+    debug_tree = self._debug_tree(temp_tree)
+    if os.path.isdir(debug_tree):
+      shutil.rmtree(debug_tree)  # from an attempt which died part way
+    topdir, exclude = self._pkg_tree_layout()
+    optimizer = TreeOptimizer(temp_tree, topdir, exclude=[exclude],
+        run=lambda cmdline: self._check_call(cmdline, stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r')))
+    if strip_mode != 'none':
+      optimizer.strip(debug_tree if strip_mode == 'split' else None)
+    if dedupe:
+      optimizer.dedupe()
+      if os.path.isdir(debug_tree):
+        optimizer.dedupe(debug_tree)
+    stats = optimizer.stats
+    print('Optimized {}: stripped {} files ({} to -dbg), saving {} bytes; hardlinked {} duplicates, saving {} bytes'.format(
+      product.name, stats['stripped'], stats['split'], stats['strip_saved'], stats['deduped'], stats['dedupe_saved']), flush=True)
+    record = getattr(self._stage_local, 'record', None)
+    if record is not None:
+      record['optimize'] = stats
+    self._record_done_stage(product, STAGENAME)
+
+  def _pkg_full_version(self, product: Product, bumped=True):
     overrides = self.other_versions['overrides'].get(product.name, {})
     pkgver = str(overrides.get('pkg_version', '1'))  # protect against `3` where expected `"3"`
+    if bumped:
+      pkgver = self.pkg_version_bumps.get(product.name, pkgver)
     return '{p.ver}-{opts.pkg_version_ext}{pkgver}'.format(
         p=product, opts=self.options, pkgver=pkgver)
 
-  def _pkg_generated_pathname(self, product: Product):
-    # This depends upon the -p option to `fpm` in .package(), but fpm does interpolation.
-    # FIXME: _amd_64.deb hardcoded:
+  def _pkg_name(self, product: Product, dbg=False):
+    # fpm turns the underscore given to it with -n into a dash
+    return self.options.pkg_prefix + '-' + product.filename_base + ('-dbg' if dbg else '')
+
+  def _pkg_generated_pathname(self, product: Product, dbg=False):
+    # fpm is given NAME_FULLVERSION_ARCH.EXTENSION and an explicit -a, so this
+    # is what it (or our own DebWriter) writes.
     return os.path.join(self.options.results_dir,
-      self.options.pkg_prefix + '-' + product.filename_base + '_' + self._pkg_full_version(product) + '_amd64.deb'
+      self._pkg_name(product, dbg) + '_' + self._pkg_full_version(product) + '_' + _deb_architecture() + '.deb'
       )
 
+  def _pkg_depends(self, product: Product, dbg=False):
+    """Dependencies, in the form fpm -d takes them."""
+    if dbg:
+      return ['{}_{} = {}'.format(self.options.pkg_prefix, product.filename_base, self._pkg_full_version(product))]
+    depends = []
+    for depname in self.direct_needs[product.name]:
+      dependency = self.options.pkg_prefix + '_' + depname
+      if (product.name in self.direct_needs_version_constraints and depname in self.direct_needs_version_constraints[product.name]):
+        dependency += ' ' + self.direct_needs_version_constraints[product.name][depname]
+      depends.append(dependency)
+    depends.extend(self.configures['packages'][product.name].get('os-deps', {}).get(self.options.ostype, []))
+    return depends
+
+  @instrumented_stage
   def package(self, product: Product, temp_tree):
     STAGENAME = 'package'
-    already = self._have_done_stage(product, STAGENAME, want_content=True)
+    already = self._have_done_stage(product, STAGENAME)
     if already:
       self._print_already(STAGENAME)
-      return already[0]
-    with open('.rbenv-gemsets', 'w') as f:
+      return already
+    for dbg in (False, True):
+      if os.path.exists(self._pkg_generated_pathname(product, dbg)):
+        # Built from other inputs; may be hardlinked into the build cache, so
+        # unlink rather than let anything write through it.
+        os.unlink(self._pkg_generated_pathname(product, dbg))
+    topdir, exclude = self._pkg_tree_layout()
+    trees = [(temp_tree, False)]
+    if os.path.isdir(self._debug_tree(temp_tree)):
+      trees.append((self._debug_tree(temp_tree), True))
+    for tree, dbg in trees:
+      if self.options.packager == 'native' and PACKAGE_TYPES[self.options.ostype] == 'deb':
+        self._package_native_deb(product, tree, topdir, exclude, dbg)
+      else:
+        self._package_fpm(product, tree, topdir, exclude, dbg)
+    pkgname = self._pkg_generated_pathname(product)
+    self._record_done_stage(product, STAGENAME, content=pkgname)
+    return pkgname
+
+  def _pkg_tree_layout(self):
+    """Returns (topdir, exclude): the top directory of the installed tree to
+    package, and the one file within it to leave out."""
+    topdir = os.path.normpath(self.configures['prefix']).lstrip(os.path.sep).split(os.path.sep)[0]  # aka: 'opt'
+    exclude = os.path.join(self.configures['prefix'].lstrip(os.path.sep), 'share', 'info', 'dir')
+    return topdir, exclude
+
+  def _package_native_deb(self, product: Product, temp_tree, topdir, exclude, dbg=False):
+    writer = DebWriter(temp_tree, topdir, exclude=[exclude], compression=self.options.deb_compression)
+    # the fields, and defaults, which fpm writes
+    writer.fields['Package'] = self._pkg_name(product, dbg)
+    writer.fields['Version'] = self._pkg_full_version(product)
+    writer.fields['License'] = 'unknown'
+    writer.fields['Vendor'] = 'none'
+    writer.fields['Architecture'] = _deb_architecture()
+    writer.fields['Maintainer'] = self.options.pkg_email
+    writer.fields['Installed-Size'] = ''
+    writer.fields['Depends'] = ''
+    writer.fields['Section'] = 'debug' if dbg else 'default'
+    writer.fields['Priority'] = 'extra'
+    writer.fields['Homepage'] = 'http://example.com/no-uri-given'
+    writer.fields['Description'] = 'no description given'
+    writer.fields[BUILD_KEY_FIELD] = self.build_keys[product.name]
+    writer.depends = self._pkg_depends(product, dbg)
+    writer.write(self._pkg_generated_pathname(product, dbg))
+    print('Created package {}'.format(self._pkg_generated_pathname(product, dbg)), flush=True)
+
+  def _package_fpm(self, product: Product, temp_tree, topdir, exclude, dbg=False):
+    os.makedirs(self._workdir(product), exist_ok=True)  # none, for a shared tree
+    with open(os.path.join(self._workdir(product), '.rbenv-gemsets'), 'w') as f:
       print('fpm', file=f)
-    full_version = self._pkg_full_version(product)
     cmdline = [
       'fpm',
       '-s', 'dir',
       '-t', PACKAGE_TYPES[self.options.ostype],
+      '-a', _deb_architecture(),
       '-m', self.options.pkg_email,
       '-p', os.path.join(self.options.results_dir, 'NAME_FULLVERSION_ARCH.EXTENSION'),
       '-C', temp_tree,
-      '-x', os.path.join(self.configures['prefix'].lstrip(os.path.sep), 'share', 'info', 'dir'),
-      '-n', self.options.pkg_prefix + '_' + product.filename_base,
-      '-v', full_version,
+      '-x', exclude,
+      '-n', self.options.pkg_prefix + '_' + product.filename_base + ('_dbg' if dbg else ''),
+      '-v', self._pkg_full_version(product),
       ]
-    for depname in self.direct_needs[product.name]:
-      dependency = self.options.pkg_prefix + '_' + depname
-      if (product.name in self.direct_needs_version_constraints and depname in self.direct_needs_version_constraints[product.name]):
-        dependency += ' ' + self.direct_needs_version_constraints[product.name][depname]
+    if PACKAGE_TYPES[self.options.ostype] == 'deb':
+      cmdline.extend(['--deb-field', '{}: {}'.format(BUILD_KEY_FIELD, self.build_keys[product.name])])
+    for dependency in self._pkg_depends(product, dbg):
       cmdline.append('-d')
       cmdline.append(dependency)
-    for dep in self.configures['packages'][product.name].get('os-deps', {}).get(self.options.ostype, []):
-      cmdline.append('-d')
-      cmdline.append(dep)
-    cmdline.append(os.path.normpath(self.configures['prefix']).lstrip(os.path.sep).split(os.path.sep)[0])  # aka: 'opt'
-    subprocess.check_call(cmdline,
-        stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
-    pkgname = self._pkg_generated_pathname(product)
-    self._record_done_stage(product, STAGENAME, content=pkgname)
-    return pkgname
+    cmdline.append(topdir)
+    self._check_call(cmdline,
+        stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'),
+        cwd=self._workdir(product))
 
+  @instrumented_stage
   def install_package(self, product: Product, pkgpath):
     STAGENAME = 'install_pkg'
     if self._have_done_stage(product, STAGENAME):
       self._print_already(STAGENAME)
       return
-    subprocess.check_call([PKG_INSTALL_CMD, pkgpath],
-        stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
-    self._record_done_stage(product, STAGENAME)
-    self.installed.add(product.name)
+    with self._install_lock:
+      self._check_call([self.options.pkg_install_cmd, pkgpath],
+          stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+      self._record_done_stage(product, STAGENAME)
+      self.installed.add(product.name)
 
-  def uninstall(self, product: Product):
-    # should we nuke stagenames for this product?
-    subprocess.check_call([PKG_UNINSTALL_CMD, self.options.pkg_prefix + '-' + product.filename_base],
+  def install_prebuilt(self, product_names):
+    """Installs already-built packages with one install command, after one
+    removal of whatever conflicts with them.  If the batch fails, falls back
+    to one at a time, to find which one(s) to blame.
+
+    Returns [(product_name, exception or None)], leaving out any product not
+    tried because something it needs failed.
+    """
+    STAGENAME = 'install_pkg'
+    results = []
+    todo = []
+    for product_name in product_names:
+      product = self.products[product_name]
+      self.cache.record_used(product_name, self.input_keys[product_name])
+      if self._have_done_stage(product, STAGENAME):
+        print('\033[34m[{}] Already: \033[3m{}\033[0m \033[34m{}\033[0m'.format(
+          self.options.boxname, STAGENAME, product_name), flush=True)
+        results.append((product_name, None))
+      else:
+        todo.append(product_name)
+    if not todo:
+      return results
+    started = time.time()
+    record = {'type': 'install_batch', 'box': self.options.boxname, 'products': todo}
+    with self._install_lock:
+      conflicts = self._conflicts_for(todo)
+      try:
+        if conflicts:
+          print('\033[31mConflicting packages installed, removing: \033[1m{}\033[0m'.format(' '.join(conflicts)), flush=True)
+          self.uninstall([self.products[c] for c in conflicts])
+        print('\033[36;1m[{}] Install: \033[3m{}\033[0m'.format(self.options.boxname, ' '.join(todo)), flush=True)
+        self._check_call([self.options.pkg_install_cmd] + [self.prebuilt[p] for p in todo],
+            stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+      except (OSError, subprocess.CalledProcessError) as e:
+        record['failed'] = str(e)
+        if len(todo) == 1:
+          results.append((todo[0], e))
+          todo = []
+        else:
+          print('\033[31mBatch install failed, retrying one at a time\033[0m', flush=True)
+          failed = set()
+          for product_name in todo:
+            if failed & self.needs[product_name]:
+              failed.add(product_name)
+              continue
+            try:
+              self._check_call([self.options.pkg_install_cmd, self.prebuilt[product_name]],
+                  stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+            except (OSError, subprocess.CalledProcessError) as e:
+              failed.add(product_name)
+              results.append((product_name, e))
+          todo = [p for p in todo if p not in failed]
+      for product_name in todo:
+        self._record_done_stage(self.products[product_name], STAGENAME)
+        self.installed.add(product_name)
+        results.append((product_name, None))
+    record['removed'] = conflicts
+    record['wall'] = round(time.time() - started, 3)
+    with self._report_lock:
+      self._append_report(record)
+    return results
+
+  def uninstall(self, products):
+    """Removes the packages for products, with one uninstall command.
+    Caller holds the install lock."""
+    self._check_call([self.options.pkg_uninstall_cmd] + [
+        self.options.pkg_prefix + '-' + product.filename_base for product in products],
         stdout=sys.stdout, stderr=sys.stderr, stdin=open(os.devnull, 'r'))
+    for product in products:
+      self.installed.discard(product.name)
+      # so that a later run with the same inputs installs it again
+      self.stages.forget(product.name, 'install_pkg')
 
   def report(self):
     print('\nFetched {} files'.format(len(self._fetched)), end='')
@@ -519,9 +3650,54 @@ class BuildPlan(object):
         print('  {}'.format(p))
     else:
       print('.')
+    if self.failed:
+      print('\033[31;1mFailed {}:\033[0m'.format(len(self.failed)))
+      for p in sorted(self.failed):
+        print('  {}: {}'.format(p, self.failed[p]))
+    if self.skipped:
+      print('\033[31mSkipped {} because of failures:\033[0m'.format(len(self.skipped)))
+      for p in sorted(self.skipped):
+        print('  {}'.format(p))
 
 
-def _main(args, argv0):
+def _find_published_repo(options):
+  """Returns a PublishedRepo for the options, or None if there's none to use.
+
+  Without --published-repo, we use the first filesystem: endpoint of our box
+  in the machines file for which a --repo-endpoint-root has been given.
+  """
+  roots = dict(r.split('=', 1) for r in options.repo_endpoint_root)
+  spec = options.published_repo
+  if not spec and roots and os.path.exists(options.machines_file):
+    for machine in json.load(open(options.machines_file)):
+      if machine['name'] != options.boxname:
+        continue
+      for endpoint in machine.get('repo_endpoints', []):
+        if endpoint.get('spec', '').startswith('filesystem:') and endpoint['spec'].split(':')[1] in roots:
+          spec = endpoint['spec']
+          break
+  if not spec:
+    return None
+  if spec.startswith('filesystem:'):
+    _, endpoint, path = spec.split(':', 2)
+    if endpoint not in roots:
+      raise Error('no --repo-endpoint-root given for filesystem endpoint {!r}'.format(endpoint))
+    root = os.path.join(roots[endpoint], path)
+  else:
+    root = spec
+  return PublishedRepo(root, options.repo_distribution or options.boxname, _deb_architecture())
+
+
+@functools.lru_cache(maxsize=None)
+def _deb_architecture():
+  try:
+    return subprocess.check_output(['dpkg', '--print-architecture'],
+        stdin=open(os.devnull, 'r'), universal_newlines=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'amd64'
+
+
+def _options_parser():
   parser = argparse.ArgumentParser(
       description=__doc__,
       formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -555,9 +3731,18 @@ def _main(args, argv0):
   parser.add_argument('--gnupg-trust-model',
                       type=str, default='direct',
                       help='GnuPG trust model to use [%(default)s]')
+  parser.add_argument('--verify-cache',
+                      type=str, default='',
+                      help='Cache of gpg signature verifications [<tarballs-dir>/{}]'.format(VERIFY_CACHE_FN))
   parser.add_argument('--pkg-install-cmd',
                       type=str, default=PKG_INSTALL_CMD,
-                      help='Command to install a package [%(default)s]')
+                      help='Command to install packages, given one or more [%(default)s]')
+  parser.add_argument('--pkg-uninstall-cmd',
+                      type=str, default=PKG_UNINSTALL_CMD,
+                      help='Command to uninstall packages, given one or more names [%(default)s]')
+  parser.add_argument('--fetch-jobs',
+                      type=int, default=FETCH_JOBS,
+                      help='How many downloads to run at once [%(default)s]')
   parser.add_argument('--mirror',
                       type=str, default=os.environ.get('MIRROR', MIRROR_URL),
                       help='GnuPG download mirror [%(default)s]')
@@ -581,37 +3766,174 @@ def _main(args, argv0):
                       help='Do stuff we want outside the VMs')
   parser.add_argument('--run-inside',
                       action='store_true', default=False,
-                      help='Only stuff we want inside the VMs')  # added as noop, but Vagrant uses, so is available as a guard
+                      help='Only stuff we want inside the VMs: use the plan from --prepare-outside, if it is current')
+  parser.add_argument('--plan-file',
+                      type=str, default='',
+                      help='Build plan written by --prepare-outside [<tarballs-dir>/{}]'.format(PLAN_FN))
+  parser.add_argument('--pristine-dir',
+                      type=str, default=os.environ.get('PT_PRISTINE_DIR', ''),
+                      help='Extracted source trees, shareable across boxes [<base-dir>/{}]'.format(PRISTINE_DIRNAME))
+  parser.add_argument('--vpath',
+                      action='store_true', default=False,
+                      help='Build every product out-of-tree (per product: "vpath": true in configures)')
+  parser.add_argument('--configure-cache',
+                      action='store_true', default=bool(os.environ.get('PT_CONFIGURE_CACHE')),
+                      help='Share autoconf cache results between products (per product: "configure_cache": false to opt out)')
+  parser.add_argument('--configure-cache-dir',
+                      type=str, default='',
+                      help='Where shared autoconf caches are kept [<results-dir>/{}]'.format(CONFIGURE_CACHE_DIRNAME))
+  parser.add_argument('--packager',
+                      type=str, choices=PACKAGERS, default=os.environ.get('PT_PACKAGER', 'native'),
+                      help='Build packages with our own writer (deb only) or with fpm [%(default)s]')
+  parser.add_argument('--deb-compression',
+                      type=str, choices=sorted(DEB_COMPRESSORS), default='xz',
+                      help='Compression for data.tar in native debs (zstd needs dpkg 1.21.18+) [%(default)s]')
+  parser.add_argument('--strip',
+                      type=str, choices=STRIP_MODES, default=os.environ.get('PT_STRIP', 'none'),
+                      help='Strip binaries before packaging, or split debug info into -dbg packages (per product: "strip") [%(default)s]')
+  parser.add_argument('--check',
+                      action='store_true', default=bool(os.environ.get('PT_CHECK')),
+                      help='Run each product\'s test suite, make check (per product: "check": false, or "warn")')
+  parser.add_argument('--make-jobs',
+                      type=int, default=int(os.environ.get('PT_MAKE_JOBS', os.cpu_count() or 1)),
+                      help='Parallel make jobs, shared across products building at once [%(default)s]')
+  parser.add_argument('--compiler-cache-dir',
+                      type=str, default=os.environ.get('PT_CCACHE_DIR', ''),
+                      help='Compile via a compiler cache kept in this dir (shared across boxes) [none]')
+  parser.add_argument('--compiler-cache',
+                      type=str, default=COMPILER_CACHE_CMD,
+                      help='ccache-compatible compiler cache command [%(default)s]')
+  parser.add_argument('--artifact-store',
+                      type=str, default=os.environ.get('PT_ARTIFACT_STORE', ''),
+                      help='Share built trees and packages with other boxes of the same ABI, via this dir [none]')
+  parser.add_argument('--cache-dir',
+                      type=str, default=os.environ.get('PT_BUILD_CACHE_DIR', ''),
+                      help='Build cache, keyed by hash of inputs [<results-dir>/{}]'.format(CACHE_DIRNAME))
+  parser.add_argument('--published-repo',
+                      type=str, default=os.environ.get('PT_PUBLISHED_REPO', ''),
+                      help='Apt repo to reuse packages from: a directory, or filesystem:<endpoint>:<path> [from machines file]')
+  parser.add_argument('--repo-endpoint-root',
+                      type=str, action='append', default=[], metavar='ENDPOINT=DIR',
+                      help='Local directory holding an aptly filesystem endpoint (repeatable)')
+  parser.add_argument('--repo-distribution',
+                      type=str, default='',
+                      help='Distribution name within the published repo [boxname]')
+  parser.add_argument('--machines-file',
+                      type=str, default=MACHINES_FN,
+                      help='Machines definitions, for repo endpoints [%(default)s]')
+  parser.add_argument('--jobs', '-j',
+                      type=int, default=int(os.environ.get('PT_BUILD_JOBS', '1')),
+                      help='How many products to build at once [%(default)s]')
+  parser.add_argument('--tmpfs-dir',
+                      type=str, default=os.environ.get('PT_TMPFS_DIR', ''),
+                      help='RAM-backed filesystem to put work and DESTDIR trees in, while they fit [none]')
+  parser.add_argument('--tmpfs-cap',
+                      type=_parse_mib, default=os.environ.get('PT_TMPFS_CAP', '0'),
+                      help='How much of the tmpfs dir to use, in MiB (or with a K/M/G suffix); 0 for three quarters of it [%(default)s]')
+  parser.add_argument('--mem-budget',
+                      type=_parse_mib, default=os.environ.get('PT_MEM_BUDGET', str(_memory_mib())),
+                      help='Memory, in MiB (or with a K/M/G suffix), for products building at once; 0 for no limit [%(default)s]')
+  parser.add_argument('--cpu-budget',
+                      type=float, default=float(os.environ.get('PT_CPU_BUDGET', os.cpu_count() or 1)),
+                      help='CPUs for products building at once; 0 for no limit [%(default)s]')
+  parser.add_argument('--stats-file',
+                      type=str, default='',
+                      help='Per-product resource history, to schedule by [<results-dir>/{}]'.format(STATS_FN))
+  parser.add_argument('--watch',
+                      action='store_true', default=False,
+                      help='After building, stay running and rebuild whatever changes to the inputs affect')
+  parser.add_argument('--watch-poll',
+                      type=float, default=0,
+                      help='With --watch, look for changes every this many seconds instead of using inotify [inotify, if we can]')
+  parser.add_argument('--profile',
+                      action='store_true', default=False,
+                      help='Print where the time went, along the critical path')
   parser.add_argument('--boxname',
-                      type=str, default=os.environ.get('PT_BOX_NAME', platform.node()),
+                      type=str, default=os.environ.get('PT_BOX_NAME', os.uname().nodename),
                       help='Box name for conditional flags')
+  return parser
 
-  options = parser.parse_args(args=args)
+
+def _main(args, argv0):
+  options = _options_parser().parse_args(args=args)
 
   # will double-expand `~` if the shell already did that; acceptable.
   os.chdir(os.path.expanduser(options.base_dir))
 
   plan = BuildPlan(options)
-  plan.process_swdb()
-  plan.process_versions_conf()
-  plan.process_configures()
+  if not (options.run_inside and plan.load_plan()):
+    plan.process_swdb()
+    plan.process_versions_conf()
+    plan.process_configures()
 
-  plan.ensure_have_each()
+    plan.ensure_have_each()
 
   if options.prepare_outside:
+    plan.write_plan()
     plan.report()
     return
 
+  if options.watch:
+    return _watch(plan, options)
+  return _build(plan, options)
+
+
+def _build(plan, options):
   print('FIXME: load in patch-levels, load in per-product patch paths!', flush=True)
+  plan.compute_input_keys()
+  repo = _find_published_repo(options)
+  if repo is not None:
+    print('\033[36mPublished repo index: \033[3m{}\033[0m'.format(repo.index_path), flush=True)
+    plan.resolve_published(repo)
+  plan.stages.adopt_flag_files(os.path.expanduser(options.base_dir), plan.input_keys)
+  if plan.nothing_to_do():
+    plan.write_build_report()
+    plan.report()
+    return 0
+  plan.report_stale()
   plan.build_each()
 
   # json.dump(plan.products, fp=sys.stdout, indent=2, cls=OurJSONEncoder)
   # print()
+  plan.write_build_report()
   plan.report()
+  if options.profile:
+    plan.print_profile()
 
+  if plan.failed:
+    return 1
   return 0
 
 
+def _watch(plan, options):
+  """Build, then each time the inputs change, rebuild what that makes stale
+  (see BuildPlan.report_stale); until interrupted.  Returns how the last
+  build went."""
+  watcher = InputWatcher(
+      [options.swdb_file, options.versions_file, options.configures_file, options.dependencies_file, options.mutex_file],
+      [options.patches_dir, options.tarballs_dir], poll=options.watch_poll)
+  rv = 0
+  changed = None
+  try:
+    while True:
+      try:
+        if changed is not None:
+          plan.reload()
+        rv = _build(plan, options)
+      except (Error, OSError, ValueError, subprocess.CalledProcessError) as e:
+        # eg, a config caught half-edited; the next change may fix it
+        print('\033[31;1m[{}] Failed: \033[0m\033[31m{}\033[0m'.format(options.boxname, e), flush=True)
+        rv = 1
+      # downloading into the tarballs dir is no reason to build again
+      watcher.written(plan.fetched())
+      print('\033[36m[{}] Watching for changes ({})\033[0m'.format(options.boxname, watcher.method), flush=True)
+      changed = watcher.wait()
+      print('\033[35m[{}] Changed: \033[3m{}\033[0m'.format(options.boxname, ' '.join(changed)), flush=True)
+  except KeyboardInterrupt:
+    print(flush=True)
+  return rv
+
+
 if __name__ == '__main__':
   argv0 = sys.argv[0].rsplit('/')[-1]
   rv = _main(sys.argv[1:], argv0=argv0)